@@ -0,0 +1,142 @@
+import argparse
+import configparser
+
+from backends import get_backend
+from profiling import execute
+from sql_queries import aggregate_refresh_queries
+
+CONFIG_FILE = 'dwh.cfg'
+
+aggregate_freshness_select = ("""SELECT (SELECT MAX(refreshed_through) FROM etl_aggregate_watermark),
+                                        (SELECT MAX(loaded_at) FROM factSongplay)
+""")
+
+# Dashboard queries, each answered from an aggregate or, with the same result, from factSongplay.
+# Maps a query name to its (aggregate query, raw query). Parameters are passed as %s.
+ANALYTICS_QUERIES = {
+    # Song plays in every hour of a day, by level: (hour, level, plays)
+    'plays_per_hour': ("""SELECT play_hour, level, plays
+                          FROM agg_hourly_plays
+                          WHERE play_hour >= CAST(%s AS date) AND play_hour < CAST(%s AS date) + 1
+                          ORDER BY play_hour, level
+    """, """SELECT DATE_TRUNC('hour', f.start_time) AS play_hour, COALESCE(f.level, 'unknown') AS level,
+                   COUNT(*) AS plays
+            FROM factSongplay f
+            WHERE f.start_time >= CAST(%s AS date) AND f.start_time < CAST(%s AS date) + 1
+            GROUP BY DATE_TRUNC('hour', f.start_time), COALESCE(f.level, 'unknown')
+            ORDER BY play_hour, level
+    """),
+    # The ten most played songs of a day: (title, artist, plays)
+    'top_songs': ("""SELECT s.title, ar.name, a.plays
+                     FROM agg_daily_song_plays a
+                     JOIN dimSong s ON s.song_id = a.song_id
+                     JOIN dimArtist ar ON ar.artist_id = s.artist_id
+                     WHERE a.play_date = CAST(%s AS date)
+                     ORDER BY a.plays DESC, s.title
+                     LIMIT 10
+    """, """SELECT s.title, ar.name, COUNT(*) AS plays
+            FROM factSongplay f
+            JOIN dimSong s ON s.song_id = f.song_id
+            JOIN dimArtist ar ON ar.artist_id = s.artist_id
+            WHERE CAST(f.start_time AS date) = CAST(%s AS date)
+            GROUP BY s.title, ar.name
+            ORDER BY plays DESC, s.title
+            LIMIT 10
+    """),
+    # Free and paid activity between two days, inclusive: (level, active users, plays)
+    'activity_by_level': ("""SELECT level, COUNT(DISTINCT user_id) AS users, SUM(plays) AS plays
+                             FROM agg_daily_user_plays
+                             WHERE play_date BETWEEN CAST(%s AS date) AND CAST(%s AS date)
+                             GROUP BY level
+                             ORDER BY level
+    """, """SELECT COALESCE(f.level, 'unknown') AS level, COUNT(DISTINCT f.user_id) AS users, COUNT(*) AS plays
+            FROM factSongplay f
+            WHERE CAST(f.start_time AS date) BETWEEN CAST(%s AS date) AND CAST(%s AS date)
+            GROUP BY COALESCE(f.level, 'unknown')
+            ORDER BY level
+    """),
+}
+
+# Parameters of each query, in order. plays_per_hour takes its day twice.
+QUERY_PARAMETERS = {'plays_per_hour': ['day', 'day'], 'top_songs': ['day'], 'activity_by_level': ['first_day', 'last_day']}
+
+
+def refresh_aggregates(cur, conn, profiler=None):
+    '''
+    Adds the song plays loaded since the last refresh to every aggregate, in a single transaction.
+    The aggregates are never rebuilt, so a refresh only reads the newly loaded song plays.
+    '''
+    try:
+        for query in aggregate_refresh_queries:
+            execute(cur, query, profiler)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def aggregates_are_fresh(cur):
+    '''
+    Returns True if the aggregates include every song play of factSongplay.
+    '''
+    cur.execute(aggregate_freshness_select)
+    refreshed_through, last_loaded_at = cur.fetchone()
+    return last_loaded_at is None or (refreshed_through is not None and refreshed_through >= last_loaded_at)
+
+
+def run_query(cur, name, use_aggregates=True, check_freshness=True, **params):
+    '''
+    Runs one of ANALYTICS_QUERIES with the given parameters, and returns its rows and 'aggregate' or 'raw'.
+
+    The query is routed to its aggregate when the aggregates are up to date with factSongplay,
+    and to factSongplay otherwise, or when use_aggregates is False. A caller running several queries
+    can check aggregates_are_fresh() once and pass check_freshness=False.
+    '''
+    aggregate_query, raw_query = ANALYTICS_QUERIES[name]
+    fresh = not check_freshness or aggregates_are_fresh(cur)
+    source = 'aggregate' if use_aggregates and fresh else 'raw'
+    cur.execute(aggregate_query if source == 'aggregate' else raw_query,
+                tuple(params[param] for param in QUERY_PARAMETERS[name]))
+    return cur.fetchall(), source
+
+
+def plays_per_hour(cur, day, use_aggregates=True, check_freshness=True):
+    return run_query(cur, 'plays_per_hour', use_aggregates, check_freshness, day=day)
+
+
+def top_songs(cur, day, use_aggregates=True, check_freshness=True):
+    return run_query(cur, 'top_songs', use_aggregates, check_freshness, day=day)
+
+
+def activity_by_level(cur, first_day, last_day, use_aggregates=True, check_freshness=True):
+    return run_query(cur, 'activity_by_level', use_aggregates, check_freshness, first_day=first_day, last_day=last_day)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refreshes the analytics aggregates, or runs a dashboard query on them.")
+    parser.add_argument('query', nargs='?', choices=sorted(ANALYTICS_QUERIES), help="query to run, refresh only if omitted")
+    parser.add_argument('days', nargs='*', help="the day, or first and last days, of the query, as YYYY-MM-DD")
+    parser.add_argument('--backend', choices=['redshift', 'duckdb', 'postgres'],
+                        help="execution backend, defaults to BACKEND in the [ETL] section of dwh.cfg")
+    parser.add_argument('--raw', action='store_true', help="run the query on factSongplay instead of the aggregates")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    backend = get_backend(config, args.backend)
+    conn = backend.connect()
+    cur = conn.cursor()
+    if args.query is None:
+        print("Refreshing aggregates.")
+        refresh_aggregates(cur, conn)
+        print("Finished!\n")
+    else:
+        names = sorted(set(QUERY_PARAMETERS[args.query]), key=QUERY_PARAMETERS[args.query].index)
+        if len(args.days) != len(names):
+            parser.error(f"{args.query} takes {len(names)} day(s): {', '.join(names)}")
+        rows, source = run_query(cur, args.query, not args.raw, **dict(zip(names, args.days)))
+        print(f"{args.query} ({source}):")
+        for row in rows:
+            print('  ' + '  '.join(str(value) for value in row))
+    conn.close()
+    backend.close()
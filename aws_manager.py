@@ -1,16 +1,26 @@
 import configparser
-import boto3
-from time import sleep
 import json
+import os
+import random
+import threading
+from datetime import datetime
+from time import sleep, time
 
 FIRST = 0
-SLEEP_TIME = 5
+SLEEP_TIME = 5          # first delay between two status polls, in seconds
+MAX_SLEEP_TIME = 60     # the delay doubles after every poll, up to this cap
+WAIT_TIMEOUT = 45 * 60  # give up waiting for a cluster status after this many seconds
+
+# Cluster fields kept in the metadata cache. The rest of describe_clusters' answer is not used by the pipeline.
+CLUSTER_METADATA_FIELDS = ['ClusterIdentifier', 'ClusterStatus', 'Endpoint', 'IamRoles', 'NodeType', 'NumberOfNodes']
 
 class AWSManager:
     '''
     A Helper class designed to handle interactions with the AWS API when setting up/tearing down resources.
     
     The class reads in a config file that define all the required parameters.
+    The AWS clients are only created when first used, and the cluster metadata is fetched with a single
+    describe call and reused, optionally through an on-disk cache shared by every script.
     '''
     def __init__(self, config_file='dwh.cfg'):
         config = configparser.ConfigParser()
@@ -26,32 +36,80 @@ class AWSManager:
         self._DWH_DB_USER            = config.get("CLUSTER","DB_USER")
         self._DWH_DB_PASSWORD        = config.get("CLUSTER","DB_PASSWORD")
         self._DWH_PORT               = config.get("CLUSTER","DB_PORT")
+        self._METADATA_CACHE         = config.get("CLUSTER", "METADATA_CACHE", fallback="")
+        self._METADATA_CACHE_TTL     = config.getint("CLUSTER", "METADATA_CACHE_TTL", fallback=600)
+        self._SNAPSHOT_IDENTIFIER    = config.get("CLUSTER", "SNAPSHOT_IDENTIFIER", fallback="")
         self._DWH_IAM_ROLE_NAME      = config.get("IAM", "DWH_IAM_ROLE_NAME")
         self._DWH_IAM_POLICY         = config.get("IAM", "DWH_IAM_POLICY")
         self._REGION_NAME            = config.get("REGION", "REGION_NAME")
-        self._redshift =  boto3.client('redshift', 
-                                       region_name=self._REGION_NAME,
-                                       aws_access_key_id=self._KEY,
-                                       aws_secret_access_key=self._SECRET)
-        self._iam = boto3.client('iam',aws_access_key_id=self._KEY,
-                     aws_secret_access_key=self._SECRET,
-                     region_name=self._REGION_NAME)
+        self._clients = {}
+        self._clients_lock = threading.Lock()
+        self._cluster = None
+    
+    def _client(self, service):
+        '''
+        Returns the boto3 client of the service, creating it on first use.
+        boto3 is imported here as well, since importing it takes a large part of every script's start-up time.
+        Clients are created under a lock, since the default boto3 session is not thread-safe.
+        '''
+        with self._clients_lock:
+            if service not in self._clients:
+                import boto3
+
+                self._clients[service] = boto3.client(service,
+                                                      region_name=self._REGION_NAME,
+                                                      aws_access_key_id=self._KEY,
+                                                      aws_secret_access_key=self._SECRET)
+            return self._clients[service]
+    
+    @property
+    def _redshift(self):
+        return self._client('redshift')
+    
+    @property
+    def _iam(self):
+        return self._client('iam')
+    
+    @property
+    def _s3(self):
+        return self._client('s3')
     
     def cluster_exists(self):
         '''
         Evaluates if the cluster was succesfully created on the account.
         '''
-        try:
-            self._redshift.describe_clusters(ClusterIdentifier=self._DWH_CLUSTER_IDENTIFIER)['Clusters']
-            return True
-        except redshift.exceptions.ClusterNotFoundFault:
-            return False
+        return self.get_cluster(refresh=True) is not None
     
-    def create_cluster(self):
+    def _read_metadata_cache(self):
+        if not self._METADATA_CACHE or not os.path.exists(self._METADATA_CACHE):
+            return None
+        with open(self._METADATA_CACHE) as f:
+            cache = json.load(f)
+        if cache['cluster']['ClusterIdentifier'] != self._DWH_CLUSTER_IDENTIFIER:
+            return None
+        if time() - cache['fetched_at'] > self._METADATA_CACHE_TTL:
+            return None
+        return cache['cluster']
+    
+    def _write_metadata_cache(self, cluster):
+        if not self._METADATA_CACHE:
+            return
+        with open(self._METADATA_CACHE, 'w') as f:
+            json.dump({'fetched_at': time(), 'cluster': cluster}, f)
+    
+    def clear_cluster_cache(self):
+        '''
+        Forgets the cluster metadata, in memory and on disk, after the cluster was created, deleted or changed.
+        '''
+        self._cluster = None
+        if self._METADATA_CACHE and os.path.exists(self._METADATA_CACHE):
+            os.remove(self._METADATA_CACHE)
+    
+    def create_cluster(self, iam_role=None):
         '''
         Creates an AWS cluster using the parameters defined by the config file 
         '''
-        IAM_ROLE = self._iam.get_role(RoleName=self._DWH_IAM_ROLE_NAME)['Role']['Arn']
+        IAM_ROLE = iam_role or self.get_iam_role_arn()
         try:
             response = self._redshift.create_cluster(        
                 #HW
@@ -70,44 +128,232 @@ class AWSManager:
             )
         except Exception as e:
             print(e)
+        self.clear_cluster_cache()
+
+    def restore_cluster(self, snapshot_identifier, iam_role=None):
+        '''
+        Creates the cluster from a snapshot, which is much faster than creating an empty cluster and reloading it.
+        '''
+        self._redshift.restore_from_cluster_snapshot(ClusterIdentifier=self._DWH_CLUSTER_IDENTIFIER,
+                                                     SnapshotIdentifier=snapshot_identifier,
+                                                     NodeType=self._DWH_NODE_TYPE,
+                                                     NumberOfNodes=int(self._DWH_NUM_NODES),
+                                                     IamRoles=[iam_role or self.get_iam_role_arn()])
+        self.clear_cluster_cache()
+    
+    def find_cluster_snapshot(self):
+        '''
+        Returns the snapshot to restore the cluster from, as set by SNAPSHOT_IDENTIFIER in the config file,
+        or None to create an empty cluster.
 
-    def wait_for_cluster_creation(self):
+        With SNAPSHOT_IDENTIFIER=latest, the most recent available snapshot of the cluster is used, if any.
+        '''
+        if not self._SNAPSHOT_IDENTIFIER:
+            return None
+        if self._SNAPSHOT_IDENTIFIER != 'latest':
+            return self._SNAPSHOT_IDENTIFIER
+        try:
+            snapshots = self._redshift.describe_cluster_snapshots(ClusterIdentifier=self._DWH_CLUSTER_IDENTIFIER)['Snapshots']
+        except self._redshift.exceptions.ClusterNotFoundFault:
+            return None
+        snapshots = [snapshot for snapshot in snapshots if snapshot['Status'] == 'available']
+        if not snapshots:
+            return None
+        return max(snapshots, key=lambda snapshot: snapshot['SnapshotCreateTime'])['SnapshotIdentifier']
+    
+    def _wait_for_cluster(self, is_ready, expected, timeout):
+        '''
+        Polls the cluster metadata until is_ready returns True for it, and returns how many seconds it took.
+
+        Polls back off exponentially from SLEEP_TIME up to MAX_SLEEP_TIME seconds, with equal jitter: half of
+        every delay is fixed and half is random, so polls are spread out but never follow each other immediately.
+        Raises TimeoutError if the cluster is not ready within timeout seconds.
+        '''
+        start = time()
+        attempt = 0
+        cluster = self.get_cluster(refresh=True)
+        while cluster is None or not is_ready(cluster):
+            if cluster is None:
+                raise RuntimeError(f"Redshift cluster '{self._DWH_CLUSTER_IDENTIFIER}' does not exist.")
+            remaining = timeout - (time() - start)
+            if remaining <= 0:
+                raise TimeoutError(f"Redshift cluster '{self._DWH_CLUSTER_IDENTIFIER}' still '{cluster['ClusterStatus']}' "
+                                   f"after {timeout}s, expected {expected}.")
+            delay = min(MAX_SLEEP_TIME, SLEEP_TIME * 2 ** attempt)
+            sleep(min(delay / 2 + random.uniform(0, delay / 2), remaining))
+            attempt += 1
+            cluster = self.get_cluster(refresh=True)
+        return time() - start
+    
+    def wait_for_cluster_status(self, target_status='available', timeout=WAIT_TIMEOUT):
+        '''
+        Polls the cluster until it reaches the target status, and returns how many seconds it took.
+        '''
+        return self._wait_for_cluster(lambda cluster: cluster['ClusterStatus'] == target_status,
+                                      f"'{target_status}'", timeout)
+    
+    def wait_for_cluster_size(self, node_type, num_nodes, timeout=WAIT_TIMEOUT):
+        '''
+        Polls the cluster until it is available with the given node type and number of nodes,
+        and returns how many seconds it took.
+        '''
+        return self._wait_for_cluster(lambda cluster: (cluster['ClusterStatus'] == 'available'
+                                                       and (cluster['NodeType'], cluster['NumberOfNodes']) == (node_type, num_nodes)),
+                                      f"'available' with {num_nodes} x {node_type}", timeout)
+    
+    def wait_for_cluster_creation(self, timeout=WAIT_TIMEOUT):
         '''
         Helper function that keeps looping until the cluster shows to be available in the AWS account.
+        Returns how many seconds it took.
         '''
-        AVAILABLE_STATUS = 'available'
-        if self.cluster_exists():
-            cluster = self.get_cluster()
-        else:
-            raise self._redshift.exceptions.ClusterNotFoundFault
-        while cluster['ClusterStatus'] != AVAILABLE_STATUS:
-            sleep(SLEEP_TIME)
-            cluster = self.get_cluster()
+        return self.wait_for_cluster_status('available', timeout)
+    
+    def get_cluster(self, refresh=False):
+        '''
+        Returns the metadata of the Redshift cluster used throughout this ETL pipeline, or None if it does not exist.
+
+        The metadata of an available cluster comes from memory or from the on-disk cache while it is fresh.
+        Otherwise, or with refresh, it is fetched with a single describe_clusters call. Clusters in any other
+        state are not cached, since their endpoint may not be known yet.
+        '''
+        if not refresh:
+            if self._cluster is None:
+                self._cluster = self._read_metadata_cache()
+            if self._cluster is not None and self._cluster['ClusterStatus'] == 'available':
+                return self._cluster
+
+        try:
+            cluster = self._redshift.describe_clusters(ClusterIdentifier=self._DWH_CLUSTER_IDENTIFIER)['Clusters'][FIRST]
+        except self._redshift.exceptions.ClusterNotFoundFault:
+            self.clear_cluster_cache()
+            return None
+        self._cluster = {field: cluster[field] for field in CLUSTER_METADATA_FIELDS if field in cluster}
+        if self._cluster['ClusterStatus'] == 'available':
+            self._write_metadata_cache(self._cluster)
+        return self._cluster
     
-    def get_cluster(self):
+    def _require_cluster(self):
+        cluster = self.get_cluster()
+        if cluster is None:
+            raise RuntimeError(f"Redshift cluster '{self._DWH_CLUSTER_IDENTIFIER}' does not exist. Run set_up_aws_resources.py first.")
+        return cluster
+    
+    def get_cluster_status(self, refresh=True):
+        '''
+        Returns the current status of the Redshift cluster, e.g. 'creating' or 'available'.
+        '''
+        cluster = self.get_cluster(refresh)
+        return cluster['ClusterStatus'] if cluster is not None else None
+    
+    def get_cluster_size(self):
+        '''
+        Returns the (node type, number of nodes) of the Redshift cluster.
+        '''
+        cluster = self._require_cluster()
+        return cluster['NodeType'], cluster['NumberOfNodes']
+    
+    def resize_cluster(self, node_type=None, num_nodes=None):
+        '''
+        Starts an elastic resize of the cluster to the given node type and/or number of nodes.
+
+        Returns False if the cluster already has that size. Otherwise returns True without waiting:
+        wait_for_cluster_size tells when the cluster is available again.
         '''
-        Returns the Redshift cluster used throughout this ETL pipeline.
+        current_node_type, current_num_nodes = self.get_cluster_size()
+        node_type = node_type or current_node_type
+        num_nodes = int(num_nodes or current_num_nodes)
+        if (node_type, num_nodes) == (current_node_type, current_num_nodes):
+            return False
+        self._redshift.resize_cluster(ClusterIdentifier=self._DWH_CLUSTER_IDENTIFIER,
+                                      ClusterType='multi-node' if num_nodes > 1 else 'single-node',
+                                      NodeType=node_type,
+                                      NumberOfNodes=num_nodes,
+                                      Classic=False)
+        self.clear_cluster_cache()
+        return True
+    
+    def pause_cluster(self):
+        '''
+        Pauses the cluster, which stops the compute billing until it is resumed. Returns without waiting.
+        '''
+        self._redshift.pause_cluster(ClusterIdentifier=self._DWH_CLUSTER_IDENTIFIER)
+        self.clear_cluster_cache()
+    
+    def resume_cluster(self):
         '''
-        if self.cluster_exists():
-            return self._redshift.describe_clusters(ClusterIdentifier=self._DWH_CLUSTER_IDENTIFIER)['Clusters'][FIRST]
+        Resumes a paused cluster. Returns without waiting: wait_for_cluster_creation tells when it is available.
+        '''
+        self._redshift.resume_cluster(ClusterIdentifier=self._DWH_CLUSTER_IDENTIFIER)
+        self.clear_cluster_cache()
     
     def get_cluster_endpoint(self):
         '''
         Returns the Redshift cluster endpoint used when connecting to the database.
         '''
-        cluster = self.get_cluster()
-        return cluster['Endpoint']['Address']
+        return self._require_cluster()['Endpoint']['Address']
     
     def get_cluster_iam_role(self):
         '''
         Returns the Redshift cluster IAM role used when loading data.
         '''
-        cluster = self.get_cluster()
-        return cluster['IamRoles'][FIRST]['IamRoleArn']
+        return self._require_cluster()['IamRoles'][FIRST]['IamRoleArn']
         
     def get_region_name(self):
         return self._REGION_NAME
     
+    def list_s3_objects(self, s3_uri):
+        '''
+        Returns the full s3:// URI and size in bytes of every object stored under the given S3 prefix.
+        '''
+        bucket, _, prefix = s3_uri[len('s3://'):].partition('/')
+        objects = []
+        paginator = self._s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                if not obj['Key'].endswith('/'):
+                    objects.append((f"s3://{bucket}/{obj['Key']}", obj['Size']))
+        return objects
+    
+    def list_s3_keys(self, s3_uri):
+        '''
+        Returns the full s3:// URI of every object stored under the given S3 prefix.
+        '''
+        return [uri for uri, _ in self.list_s3_objects(s3_uri)]
+    
+    def put_s3_object(self, s3_uri, body):
+        '''
+        Uploads body to the given s3:// URI.
+        '''
+        bucket, _, key = s3_uri[len('s3://'):].partition('/')
+        self._s3.put_object(Bucket=bucket, Key=key, Body=body)
+    
+    def get_s3_object(self, s3_uri):
+        '''
+        Returns the content of the object stored at the given s3:// URI as bytes.
+        '''
+        bucket, _, key = s3_uri[len('s3://'):].partition('/')
+        return self._s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+    
+    def upload_s3_file(self, path, s3_uri):
+        '''
+        Uploads a local file to the given s3:// URI, using multipart uploads for large files.
+        '''
+        bucket, _, key = s3_uri[len('s3://'):].partition('/')
+        self._s3.upload_file(path, bucket, key)
+    
+    def delete_s3_objects(self, s3_uri):
+        '''
+        Deletes every object stored under the given S3 prefix.
+        '''
+        bucket, _, _ = s3_uri[len('s3://'):].partition('/')
+        keys = [uri[len(f's3://{bucket}/'):] for uri in self.list_s3_keys(s3_uri)]
+        # A DeleteObjects request removes at most 1000 objects.
+        for start in range(0, len(keys), 1000):
+            self._s3.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in keys[start:start + 1000]]})
+    
+    def get_iam_role_arn(self):
+        return self._iam.get_role(RoleName=self._DWH_IAM_ROLE_NAME)['Role']['Arn']
+    
     def create_iam_role(self):
         '''
         Creates a new IAM role that will be used throughout this ETL pipeline.
@@ -138,6 +384,19 @@ class AWSManager:
         except self._iam.exceptions.NoSuchEntityException:
             print("IAM Role does not exist.")
     
-    def delete_cluster(self):
-        if self.cluster_exists():
-            self._redshift.delete_cluster(ClusterIdentifier=self._DWH_CLUSTER_IDENTIFIER,  SkipFinalClusterSnapshot=True)
\ No newline at end of file
+    def delete_cluster(self, final_snapshot=False):
+        '''
+        Deletes the cluster. With final_snapshot, a snapshot is taken first so that the cluster can later be
+        restored from it, and its identifier is returned.
+        '''
+        if not self.cluster_exists():
+            return None
+        if final_snapshot:
+            snapshot_identifier = f"{self._DWH_CLUSTER_IDENTIFIER}-final-{datetime.utcnow():%Y%m%d%H%M%S}".lower()
+            self._redshift.delete_cluster(ClusterIdentifier=self._DWH_CLUSTER_IDENTIFIER, SkipFinalClusterSnapshot=False,
+                                          FinalClusterSnapshotIdentifier=snapshot_identifier)
+        else:
+            snapshot_identifier = None
+            self._redshift.delete_cluster(ClusterIdentifier=self._DWH_CLUSTER_IDENTIFIER,  SkipFinalClusterSnapshot=True)
+        self.clear_cluster_cache()
+        return snapshot_identifier
\ No newline at end of file
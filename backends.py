@@ -0,0 +1,472 @@
+import os
+import re
+
+import storage
+from connections import ConnectionManager, connect_postgres, get_connection_manager
+from manifest_loader import ManifestLoader, get_slice_count
+from sql_queries import (LOG_DATA, SONG_DATA, staging_events_copy_from, staging_songs_copy_from,
+                         compacted_copy_from, staging_table_columns)
+
+# The COPY of each staging table is named f'{table}_copy' in the query graphs of sql_queries.py.
+STAGING_TABLES = ['staging_events', 'staging_songs']
+
+
+class RedshiftBackend:
+    '''
+    Runs the pipeline on the Redshift cluster, loading the staging tables from S3.
+    '''
+    name = 'redshift'
+
+    def __init__(self, config, aws_manager=None):
+        from aws_manager import AWSManager
+
+        self._config = config
+        self.aws_manager = aws_manager or AWSManager()
+        self._host = None
+        # Queries are tagged with a query group, which routes them to a WLM queue.
+        self.connections = get_connection_manager(self._open_connection, config, 'query_group')
+
+    def connect(self, query_group=None):
+        '''
+        Returns a pooled connection to the Redshift database, tagged with the query group if given.
+        '''
+        return self.connections.connect(query_group)
+
+    def close(self):
+        self.connections.close_all()
+
+    def _open_connection(self):
+        DWH_DB                 = self._config.get("CLUSTER","DB_NAME")
+        DWH_DB_USER            = self._config.get("CLUSTER","DB_USER")
+        DWH_DB_PASSWORD        = self._config.get("CLUSTER","DB_PASSWORD")
+        DWH_PORT               = self._config.get("CLUSTER","DB_PORT")
+
+        if self._host is None:
+            self._host = self.aws_manager.get_cluster_endpoint()
+        return connect_postgres(self._config, host=self._host, dbname=DWH_DB, user=DWH_DB_USER, password=DWH_DB_PASSWORD,
+                                port=DWH_PORT)
+
+    def get_staging_sources(self):
+        '''
+        Returns the (staging table, S3 prefix, COPY query builder) of every data source.
+
+        When COMPACTED_DATA is set, the staging tables are loaded from the files written by
+        compaction.py instead of the raw JSON files.
+        '''
+        COMPACTED_DATA         = self._config.get("S3", "COMPACTED_DATA", fallback="")
+        COMPACTION_FORMAT      = self._config.get("ETL", "COMPACTION_FORMAT", fallback="parquet")
+
+        if COMPACTED_DATA:
+            return [(table, storage.join(COMPACTED_DATA, table) + '/', compacted_copy_from(table, COMPACTION_FORMAT))
+                    for table in STAGING_TABLES]
+        return [('staging_events', LOG_DATA, staging_events_copy_from),
+                ('staging_songs', SONG_DATA, staging_songs_copy_from)]
+
+    def list_files(self, source):
+        return self.aws_manager.list_s3_objects(source)
+
+    def get_manifest_loader(self, cur):
+        '''
+        Returns the loader splitting COPYs into manifest batches, or None when MANIFEST_PREFIX is not set.
+        '''
+        MANIFEST_PREFIX        = self._config.get("S3", "MANIFEST_PREFIX", fallback="")
+        FILES_PER_SLICE        = self._config.getint("ETL", "FILES_PER_SLICE", fallback=64)
+        PARALLEL_COPY          = self._config.getboolean("ETL", "PARALLEL_COPY", fallback=True)
+
+        if not MANIFEST_PREFIX:
+            return None
+        # The cluster may have been resized for the load, so its current size is used rather than dwh.cfg.
+        node_type, num_nodes = self.aws_manager.get_cluster_size()
+        slice_count = get_slice_count(node_type, num_nodes, cur)
+        return ManifestLoader(self.aws_manager, MANIFEST_PREFIX, slice_count, FILES_PER_SLICE, PARALLEL_COPY)
+
+
+# Rewrites applied to Redshift SQL before it runs on a local database, in order.
+# Keys and references are informational in Redshift, so they are dropped rather than enforced.
+LOCAL_REWRITES = [
+    (re.compile(r'\bdiststyle\s+(all|even|auto|key)\b', re.IGNORECASE), ''),
+    (re.compile(r'\b(compound\s+|interleaved\s+)?sortkey\s*\([^)]*\)', re.IGNORECASE), ''),
+    (re.compile(r'\b(distkey|sortkey)\b(\s*\([^)]*\))?', re.IGNORECASE), ''),
+    (re.compile(r'\bencode\s+\w+', re.IGNORECASE), ''),
+    (re.compile(r'\bPRIMARY KEY\b', re.IGNORECASE), ''),
+    (re.compile(r'\bREFERENCES\s+\w+\s*\(\w+\)', re.IGNORECASE), ''),
+]
+DUCKDB_REWRITES = LOCAL_REWRITES + [
+    (re.compile(r'\bgetdate\(\)', re.IGNORECASE), 'current_timestamp'),
+    (re.compile(r'(\bts)/1000\b'), r'\1//1000'),
+    (re.compile(r'\b(row_number\(\)\s+OVER\s+\([^)]*\))(?!\s+AS\b)', re.IGNORECASE), r'\1 AS row_number'),
+    # DuckDB has no LOCK. A database file is opened by a single process at a time anyway.
+    (re.compile(r'^\s*LOCK\s+(\w+)\s*$', re.IGNORECASE), r'SELECT COUNT(*) FROM \1'),
+    (re.compile(r'\bVACUUM\s+(FULL|SORT\s+ONLY|DELETE\s+ONLY)\b', re.IGNORECASE), 'VACUUM'),
+]
+CREATE_TABLE = re.compile(r'CREATE TABLE IF NOT EXISTS (\w+)', re.IGNORECASE)
+IDENTITY_COLUMN = re.compile(r'\b(\w+)\s+(\w+)\s+IDENTITY\((\d+),\s*(\d+)\)', re.IGNORECASE)
+FLOAT_TYPE = re.compile(r'\bfloat\b', re.IGNORECASE)
+DML_STATEMENT = re.compile(r'\s*(INSERT|UPDATE|DELETE)\b', re.IGNORECASE)
+CHANGED_TABLE = re.compile(r'\s*(?:(INSERT)\s+INTO|(UPDATE)|(DELETE)\s+FROM)\s+(\w+)', re.IGNORECASE)
+MAINTAINED_TABLE = re.compile(r'\s*(ANALYZE|VACUUM|TRUNCATE|DROP\s+TABLE(?:\s+IF\s+EXISTS)?)\s+(?:TABLE\s+)?(\w+)',
+                              re.IGNORECASE)
+
+# Stand-ins for the Redshift system tables read by profiling.py and maintenance.py, so those stages work locally.
+# The query history tables stay empty. DuckDB keeps no statistics of the changes to a table, so the cursor logs
+# the rows each statement changes in local_table_changes, and ANALYZE and VACUUM reset them. Like the rows
+# Redshift marks for deletion, DuckDB counts deleted rows in the estimated size of a table until it is rewritten.
+# DuckDB tables have no sort key, so nothing is unsorted.
+DUCKDB_SYSTEM_TABLES = [
+    "CREATE MACRO IF NOT EXISTS pg_last_query_id() AS -1",
+    "CREATE TABLE IF NOT EXISTS stl_load_commits (query int, filename varchar, lines_scanned bigint, errors int)",
+    ("CREATE TABLE IF NOT EXISTS svl_query_summary (query int, maxtime bigint, rows bigint, bytes bigint, "
+     "workmem bigint, is_diskbased varchar)"),
+    ("CREATE TABLE IF NOT EXISTS stl_load_errors (query int, filename varchar, line_number bigint, colname varchar, "
+     "err_code int, err_reason varchar)"),
+    "CREATE TABLE IF NOT EXISTS local_table_changes (table_name varchar, modified bigint, deleted bigint)",
+    ("CREATE OR REPLACE VIEW svv_table_info AS SELECT 'public' AS schema, lower(t.table_name) AS \"table\", "
+     "'EVEN' AS diststyle, NULL AS sortkey1, 0 AS size, t.estimated_size AS tbl_rows, "
+     "GREATEST(t.estimated_size - COALESCE(c.deleted, 0), 0) AS estimated_visible_rows, 0.0 AS skew_rows, "
+     "0.0 AS unsorted, 100.0 * COALESCE(c.modified, 0) / GREATEST(t.estimated_size - COALESCE(c.deleted, 0), 1) "
+     "AS stats_off "
+     "FROM duckdb_tables() t "
+     "LEFT JOIN (SELECT table_name, SUM(modified) AS modified, SUM(deleted) AS deleted FROM local_table_changes "
+     "           GROUP BY table_name) c ON c.table_name = lower(t.table_name) "
+     "WHERE t.schema_name = 'main' AND t.table_name <> 'local_table_changes'"),
+]
+
+# Statements keeping local_table_changes up to date. Changes are logged as new rows, so that concurrent
+# loads of the same table don't conflict. As on Redshift, an UPDATE deletes the rows it replaces.
+local_table_change_insert = "INSERT INTO local_table_changes VALUES (?, ?, ?)"
+local_table_maintenance = {'analyze':  "UPDATE local_table_changes SET modified = 0 WHERE table_name = ?",
+                           'vacuum':   "UPDATE local_table_changes SET deleted = 0 WHERE table_name = ?",
+                           'truncate': "DELETE FROM local_table_changes WHERE table_name = ?",
+                           'drop':     "DELETE FROM local_table_changes WHERE table_name = ?"}
+
+
+def translate_to_duckdb(query):
+    '''
+    Rewrites a Redshift statement into one or more statements DuckDB can run.
+    '''
+    statements = []
+    for pattern, replacement in DUCKDB_REWRITES:
+        query = pattern.sub(replacement, query)
+
+    create = CREATE_TABLE.search(query)
+    if create:
+        # Redshift floats are double precision, DuckDB floats are not.
+        query = FLOAT_TYPE.sub('double', query)
+        table = create.group(1).lower()
+
+        def identity_default(match):
+            column, column_type, start, step = match.groups()
+            sequence = f'{table}_{column}_seq'.lower()
+            statements.append(f'CREATE SEQUENCE IF NOT EXISTS {sequence} INCREMENT BY {step} MINVALUE {start} START WITH {start}')
+            return f"{column} {column_type} DEFAULT nextval('{sequence}')"
+        query = IDENTITY_COLUMN.sub(identity_default, query)
+    statements.append(query)
+    return statements
+
+
+class DuckDBCursor:
+    '''
+    The subset of the psycopg2 cursor API used by the pipeline, translating Redshift SQL on the fly.
+    '''
+    def __init__(self, connection):
+        self._connection = connection
+        self._duckdb = connection._duckdb
+        self.rowcount = -1
+
+    def execute(self, query, params=None):
+        self._connection._begin()
+        self.rowcount = -1
+        for statement in translate_to_duckdb(query):
+            if params is not None:
+                self._duckdb.execute(statement.replace('%s', '?'), params)
+            else:
+                self._duckdb.execute(statement)
+        # DuckDB returns the rows affected by a DML statement as a single 'Count' row.
+        if DML_STATEMENT.match(statement):
+            row = self._duckdb.fetchone()
+            self.rowcount = row[0] if row else -1
+        self._log_changes(statement)
+
+    def _log_changes(self, statement):
+        '''
+        Logs the rows changed by the statement in local_table_changes, or resets them after maintenance.
+        '''
+        changed = CHANGED_TABLE.match(statement)
+        if changed and self.rowcount > 0:
+            insert, _, _, table = changed.groups()
+            self._duckdb.execute(local_table_change_insert,
+                                 (table.lower(), self.rowcount, 0 if insert else self.rowcount))
+            return
+        maintained = MAINTAINED_TABLE.match(statement)
+        if maintained:
+            operation, table = maintained.groups()
+            self._duckdb.execute(local_table_maintenance[operation.split()[0].lower()], (table.lower(),))
+
+    @property
+    def description(self):
+        return self._duckdb.description
+
+    def fetchone(self):
+        return self._duckdb.fetchone()
+
+    def fetchmany(self, size):
+        return self._duckdb.fetchmany(size)
+
+    def fetchall(self):
+        return self._duckdb.fetchall()
+
+    def close(self):
+        pass
+
+
+class DuckDBConnection:
+    '''
+    The subset of the psycopg2 connection API used by the pipeline, on top of a DuckDB connection.
+
+    Like psycopg2, a transaction is opened by the first statement and ended by commit() or rollback(),
+    unless autocommit is set.
+    '''
+    def __init__(self, duckdb_connection):
+        self._duckdb = duckdb_connection
+        self._in_transaction = False
+        self.autocommit = False
+
+    def _begin(self):
+        if not self._in_transaction and not self.autocommit:
+            self._duckdb.begin()
+            self._in_transaction = True
+
+    def cursor(self, name=None):
+        # DuckDB fetches the rows of a result in chunks on its own, so a named (server-side) cursor is a plain one.
+        return DuckDBCursor(self)
+
+    def commit(self):
+        if self._in_transaction:
+            self._duckdb.commit()
+            self._in_transaction = False
+
+    def rollback(self):
+        if self._in_transaction:
+            self._duckdb.rollback()
+            self._in_transaction = False
+
+    def close(self):
+        self.rollback()
+        self._duckdb.close()
+
+
+class DuckDBBackend:
+    '''
+    Runs the pipeline on a local DuckDB database, loading the staging tables from local JSON files.
+
+    Every connection shares the same database, so the scheduler can run queries concurrently.
+    Requires duckdb.
+    '''
+    name = 'duckdb'
+
+    def __init__(self, database=':memory:', log_data=None, song_data=None, config=None):
+        import duckdb
+
+        if config is not None:
+            database = config.get("LOCAL", "DATABASE", fallback=database)
+            log_data = log_data or config.get("LOCAL", "LOG_DATA")
+            song_data = song_data or config.get("LOCAL", "SONG_DATA")
+        self._database = duckdb.connect(database)
+        for statement in DUCKDB_SYSTEM_TABLES:
+            self._database.execute(statement)
+        self._sources = {'staging_events': log_data, 'staging_songs': song_data}
+        # DuckDB runs in process and has no statement timeout or query groups, so its connections are only pooled.
+        self.connections = ConnectionManager(lambda: DuckDBConnection(self._database.cursor()))
+
+    def connect(self, query_group=None):
+        return self.connections.connect(query_group)
+
+    def close(self):
+        self.connections.close_all()
+        self._database.close()
+
+    def get_staging_sources(self):
+        return [(table, self._sources[table], self._copy_builder(table)) for table in STAGING_TABLES]
+
+    def list_files(self, source):
+        # Only JSON files are loaded, so other files in the directory are not recorded as loaded either.
+        return [(path, size) for path, size in storage.list_files(source) if path.endswith('.json')]
+
+    def get_manifest_loader(self, cur):
+        return None
+
+    def _copy_builder(self, table):
+        '''
+        Returns a COPY query builder, like staging_events_copy_from, that loads local JSON files into the table.
+
+        The raw values are converted the way COPY would: keys are matched case-insensitively,
+        empty strings become NULL and a value that is not a number fails the load.
+        '''
+        casts = {'varchar': 'VARCHAR', 'int': 'INTEGER', 'bigint': 'BIGINT', 'float': 'DOUBLE'}
+        columns = ', '.join(f'CAST(CAST(NULLIF(CAST("{name}" AS VARCHAR), \'\') AS DOUBLE) AS {casts[column_type]})'
+                            if column_type != 'varchar' else f'NULLIF(CAST("{name}" AS VARCHAR), \'\')'
+                            for name, column_type in staging_table_columns[table])
+
+        def copy_from(source, manifest=False):
+            path = os.path.join(source, '**', '*.json') if os.path.isdir(source) else source
+            return (f"INSERT INTO {table} SELECT {columns} "
+                    f"FROM read_json_auto('{path}', format='newline_delimited', union_by_name=true)")
+        return copy_from
+
+
+# Rewrites applied to Redshift SQL before it runs on PostgreSQL, in order.
+POSTGRES_REWRITES = LOCAL_REWRITES + [
+    (re.compile(r'\bgetdate\(\)', re.IGNORECASE), 'now()'),
+    (re.compile(r'\bIDENTITY\((\d+),\s*(\d+)\)', re.IGNORECASE),
+     r'GENERATED BY DEFAULT AS IDENTITY (START WITH \1 MINVALUE \1 INCREMENT BY \2)'),
+    (re.compile(r'\bEXTRACT\(weekday\b', re.IGNORECASE), 'EXTRACT(dow'),
+    (re.compile(r'\bVACUUM\s+(SORT|DELETE)\s+ONLY\b', re.IGNORECASE), 'VACUUM'),
+]
+
+# Stand-ins for the Redshift system tables read by profiling.py and maintenance.py. Table health comes from
+# the PostgreSQL statistics collector: dead tuples stand for deleted rows and changes since the last
+# analyze for stale statistics. PostgreSQL tables are never sorted, so nothing is unsorted.
+POSTGRES_SYSTEM_TABLES = [
+    "CREATE OR REPLACE FUNCTION pg_last_query_id() RETURNS int LANGUAGE sql AS 'SELECT -1'",
+    "CREATE TABLE IF NOT EXISTS stl_load_commits (query int, filename varchar, lines_scanned bigint, errors int)",
+    ("CREATE TABLE IF NOT EXISTS svl_query_summary (query int, maxtime bigint, rows bigint, bytes bigint, "
+     "workmem bigint, is_diskbased varchar)"),
+    ("CREATE TABLE IF NOT EXISTS stl_load_errors (query int, filename varchar, line_number bigint, colname varchar, "
+     "err_code int, err_reason varchar)"),
+    ("CREATE OR REPLACE VIEW svv_table_info AS SELECT schemaname::varchar AS schema, relname::varchar AS \"table\", "
+     "'EVEN'::varchar AS diststyle, NULL::varchar AS sortkey1, "
+     "(pg_total_relation_size(relid) / 1048576)::bigint AS size, n_live_tup + n_dead_tup AS tbl_rows, "
+     "n_live_tup AS estimated_visible_rows, 0.0 AS skew_rows, 0.0 AS unsorted, "
+     "100.0 * n_mod_since_analyze / GREATEST(n_live_tup, 1) AS stats_off "
+     "FROM pg_stat_user_tables"),
+]
+
+
+def translate_to_postgres(query):
+    '''
+    Rewrites a Redshift statement into one PostgreSQL can run.
+    '''
+    for pattern, replacement in POSTGRES_REWRITES:
+        query = pattern.sub(replacement, query)
+    return query
+
+
+class PostgresCursor:
+    '''
+    A psycopg2 cursor translating Redshift SQL to PostgreSQL on the fly.
+    '''
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, query, params=None):
+        self._cursor.execute(translate_to_postgres(query), params)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class PostgresConnection:
+    '''
+    A psycopg2 connection whose cursors translate Redshift SQL to PostgreSQL on the fly.
+    '''
+    def __init__(self, connection):
+        self._connection = connection
+
+    def cursor(self, *args, **kwargs):
+        return PostgresCursor(self._connection.cursor(*args, **kwargs))
+
+    @property
+    def autocommit(self):
+        return self._connection.autocommit
+
+    @autocommit.setter
+    def autocommit(self, value):
+        self._connection.autocommit = value
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+class PostgresBackend:
+    '''
+    Runs the pipeline on a local PostgreSQL database, loading the staging tables from local JSON files.
+
+    Redshift is derived from PostgreSQL, so this backend is the closest local stand-in for the cluster's
+    catalog and transactions. The server reads the JSON files itself with pg_read_file, so it must run
+    on this machine as a user allowed to read them. Requires psycopg2.
+    '''
+    name = 'postgres'
+
+    def __init__(self, dsn=None, log_data=None, song_data=None, config=None):
+        if config is not None:
+            dsn = dsn or config.get("LOCAL", "POSTGRES_DSN")
+            log_data = log_data or config.get("LOCAL", "LOG_DATA")
+            song_data = song_data or config.get("LOCAL", "SONG_DATA")
+        self._dsn = dsn
+        self._config = config
+        self._sources = {'staging_events': log_data, 'staging_songs': song_data}
+        # PostgreSQL has no WLM queues, so the query group is shown as the application name in pg_stat_activity.
+        self.connections = get_connection_manager(self._open_connection, config, 'application_name')
+
+        conn = self.connect()
+        cur = conn.cursor()
+        for statement in POSTGRES_SYSTEM_TABLES:
+            cur.execute(statement)
+        conn.commit()
+        conn.close()
+
+    def connect(self, query_group=None):
+        return self.connections.connect(query_group)
+
+    def close(self):
+        self.connections.close_all()
+
+    def _open_connection(self):
+        return PostgresConnection(connect_postgres(self._config, self._dsn))
+
+    def get_staging_sources(self):
+        return [(table, self._sources[table], self._copy_builder(table)) for table in STAGING_TABLES]
+
+    def list_files(self, source):
+        # Only JSON files are loaded, so other files in the directory are not recorded as loaded either.
+        return [(path, size) for path, size in storage.list_files(source) if path.endswith('.json')]
+
+    def get_manifest_loader(self, cur):
+        return None
+
+    def _copy_builder(self, table):
+        '''
+        Returns a COPY query builder, like staging_events_copy_from, that loads local JSON files into the table.
+
+        Like the DuckDB builder, keys are matched case-insensitively, empty strings become NULL and a value
+        that is not a number fails the load.
+        '''
+        casts = {'varchar': 'varchar', 'int': 'int', 'bigint': 'bigint', 'float': 'double precision'}
+        columns = ', '.join(f"CAST(CAST(NULLIF(record->>'{name}', '') AS double precision) AS {casts[column_type]})"
+                            if column_type != 'varchar' else f"NULLIF(record->>'{name}', '')"
+                            for name, column_type in staging_table_columns[table])
+
+        def copy_from(source, manifest=False):
+            paths = [source] if os.path.isfile(source) else [path for path, _ in storage.list_files(source)
+                                                             if path.endswith('.json')]
+            paths = ', '.join(f"'{os.path.abspath(path)}'" for path in paths)
+            return (f"INSERT INTO {table} SELECT {columns} "
+                    f"FROM (SELECT (SELECT jsonb_object_agg(lower(key), value) FROM jsonb_each(line::jsonb)) AS record "
+                    f"      FROM unnest(ARRAY[{paths}]::text[]) AS files(path) "
+                    f"      CROSS JOIN LATERAL regexp_split_to_table(pg_read_file(files.path), E'\\n') AS line "
+                    f"      WHERE btrim(line) <> '') AS records")
+        return copy_from
+
+
+def get_backend(config, name=None):
+    '''
+    Returns the execution backend selected by name, or by BACKEND in the [ETL] section of the config.
+    '''
+    name = name or config.get("ETL", "BACKEND", fallback="redshift")
+    if name == 'redshift':
+        return RedshiftBackend(config)
+    if name == 'duckdb':
+        return DuckDBBackend(config=config)
+    if name == 'postgres':
+        return PostgresBackend(config=config)
+    raise ValueError(f"Unknown backend '{name}'.")
@@ -0,0 +1,241 @@
+import argparse
+import configparser
+import json
+import os
+import re
+import sys
+from datetime import datetime
+from time import perf_counter
+
+from aggregates import ANALYTICS_QUERIES, aggregates_are_fresh, refresh_aggregates, run_query
+from backends import DuckDBBackend, STAGING_TABLES
+from etl import expand_copies
+from scheduler import run_query_graph
+from sql_queries import (load_query_graph, create_table_queries, drop_table_queries,
+                         create_control_table_queries, drop_control_table_queries, song_lookup_insert,
+                         songplay_table_insert)
+
+CONFIG_FILE = 'dwh.cfg'
+STAGES = ['drop', 'create', 'copy', 'insert']
+TABLES = STAGING_TABLES + ['dimUser', 'dimSong', 'dimArtist', 'dimTime', 'song_lookup', 'factSongplay']
+TABLE_NAME = re.compile(r'TABLE (?:IF (?:NOT )?EXISTS )?(\w+)', re.IGNORECASE)
+
+# factSongplay as it was built before the song lookup: joined to the staged songs on their title alone.
+TITLE_JOIN_SONGPLAY_INSERT = ("""INSERT INTO factSongplay (start_time, user_id, level, song_id, artist_id, session_id, item_in_session, location, user_agent)
+                                 SELECT '1970-01-01'::date + e.ts/1000 * interval '1 second',
+                                        e.userId,
+                                        e.level,
+                                        s.song_id,
+                                        s.artist_id,
+                                        e.sessionId,
+                                        e.itemInSession,
+                                        e.location,
+                                        e.userAgent
+                                 FROM staging_events e
+                                 LEFT JOIN staging_songs s ON s.title = e.song
+                                 WHERE e.page = 'NextSong'
+""")
+
+
+def subgraph(graph, names):
+    '''
+    Returns the part of the graph made of the given queries. Dependencies on other queries are assumed to be met.
+    '''
+    return {name: (graph[name][0], [dependency for dependency in graph[name][1] if dependency in names])
+            for name in names}
+
+
+def time_statements(cur, conn, prefix, queries):
+    '''
+    Runs and commits each DDL statement, returning the wall time of each one keyed by the table it acts on.
+    '''
+    timings = {}
+    for query in queries:
+        start = perf_counter()
+        cur.execute(query)
+        conn.commit()
+        timings[f'{prefix}_{TABLE_NAME.search(query).group(1)}'] = perf_counter() - start
+    return timings
+
+
+def time_fact_builds(cur, conn):
+    '''
+    Rebuilds factSongplay from the loaded staging tables with the title join, then with the song lookup,
+    and returns the wall time and row count of each build. The song lookup build includes filling song_lookup.
+    '''
+    builds = {}
+    for build, queries in [('title_join', [TITLE_JOIN_SONGPLAY_INSERT]),
+                           ('song_lookup', [song_lookup_insert, songplay_table_insert])]:
+        cur.execute("DELETE FROM factSongplay")
+        cur.execute("DELETE FROM song_lookup")
+        conn.commit()
+        start = perf_counter()
+        for query in queries:
+            cur.execute(query)
+        conn.commit()
+        elapsed = perf_counter() - start
+        cur.execute("SELECT COUNT(*) FROM factSongplay")
+        builds[build] = {'seconds': elapsed, 'rows': cur.fetchone()[0]}
+    return builds
+
+
+def time_analytics_queries(cur, conn, repeat=3):
+    '''
+    Refreshes the aggregates, then runs every analytics query of aggregates.py on its aggregate and on
+    factSongplay, and returns the best of repeat wall times of each, keyed by query and source.
+    The check of whether the aggregates are up to date, which routing a query runs first, is timed on its own.
+    The queries cover the first day of song plays, or every day of them.
+    '''
+    def best_time(run):
+        elapsed = []
+        for _ in range(repeat):
+            start = perf_counter()
+            run()
+            elapsed.append(perf_counter() - start)
+        return min(elapsed)
+
+    refresh_aggregates(cur, conn)
+    cur.execute("SELECT CAST(MIN(start_time) AS date), CAST(MAX(start_time) AS date) FROM factSongplay")
+    first_day, last_day = (str(day) for day in cur.fetchone())
+    params = {'day': first_day, 'first_day': first_day, 'last_day': last_day}
+
+    timings = {'freshness_check': best_time(lambda: aggregates_are_fresh(cur))}
+    for name in ANALYTICS_QUERIES:
+        timings[name] = {source: best_time(lambda: run_query(cur, name, use_aggregates, False, **params))
+                         for source, use_aggregates in [('aggregate', True), ('raw', False)]}
+    return timings
+
+
+def benchmark_data(backend, max_concurrency):
+    '''
+    Runs the drop, create, copy and insert stages of a full load on the backend.
+    Returns the wall time of each stage and of each query, the row count of each table, the
+    factSongplay build with the title join against the song lookup, and the latency of the
+    analytics queries on the aggregates against factSongplay.
+    '''
+    conn = backend.connect()
+    cur = conn.cursor()
+    stages, queries = {}, {}
+
+    for stage, stage_queries in [('drop', drop_table_queries + drop_control_table_queries),
+                                 ('create', create_table_queries + create_control_table_queries)]:
+        start = perf_counter()
+        queries.update(time_statements(cur, conn, stage, stage_queries))
+        stages[stage] = perf_counter() - start
+
+    sources = backend.get_staging_sources()
+    files = {table: backend.list_files(source) for table, source, _ in sources}
+    # The benchmark doesn't record the loaded files, so each table is copied from its whole prefix.
+    copies = {f'{table}_copy': {f'{table}_copy': (copy_from(source), [])} for table, source, copy_from in sources}
+    graph = expand_copies(dict(load_query_graph), copies)
+    copy_names = [name for entries in copies.values() for name in entries]
+
+    for stage, names in [('copy', copy_names), ('insert', [name for name in graph if name not in copy_names])]:
+        start = perf_counter()
+        queries.update(run_query_graph(subgraph(graph, names), backend.connect, max_concurrency))
+        stages[stage] = perf_counter() - start
+
+    rows = {}
+    for table in TABLES:
+        cur.execute(f"SELECT COUNT(*) FROM {table}")
+        rows[table] = cur.fetchone()[0]
+    fact_builds = time_fact_builds(cur, conn)
+    analytics_queries = time_analytics_queries(cur, conn)
+    conn.close()
+
+    return {'input_files': sum(len(table_files) for table_files in files.values()),
+            'input_bytes': sum(size for table_files in files.values() for _, size in table_files),
+            'stages': stages, 'queries': queries, 'rows': rows, 'fact_builds': fact_builds,
+            'analytics_queries': analytics_queries}
+
+
+def find_regressions(report, baseline, tolerance):
+    '''
+    Returns a description of every stage that got slower than in the baseline report by more than tolerance.
+    Runs are matched by their data label.
+    '''
+    regressions = []
+    baseline_runs = {run['data']: run for run in baseline['runs']}
+    for run in report['runs']:
+        if run['data'] not in baseline_runs:
+            continue
+        for stage, elapsed in run['stages'].items():
+            before = baseline_runs[run['data']]['stages'].get(stage)
+            if before and elapsed > before * (1 + tolerance):
+                regressions.append(f"{run['data']} {stage}: {before:.3f}s -> {elapsed:.3f}s")
+    return regressions
+
+
+def print_report(report):
+    print(f"{'data':<30}{'files':>8}{'MiB':>10}" + ''.join(f'{stage:>10}' for stage in STAGES) + f"{'songplays':>12}"
+          + f"{'title join':>12}{'lookup':>10}")
+    for run in report['runs']:
+        fact_builds = run['fact_builds']
+        print(f"{run['data']:<30}{run['input_files']:>8}{run['input_bytes'] / 2**20:>10.1f}"
+              + ''.join(f"{run['stages'][stage]:>10.3f}" for stage in STAGES)
+              + f"{run['rows']['factSongplay']:>12}"
+              + f"{fact_builds['title_join']['seconds']:>12.3f}{fact_builds['song_lookup']['seconds']:>10.3f}")
+    print("title join and lookup: factSongplay build time joining songs on their title, and on the song lookup key")
+
+    print(f"\n{'data':<30}{'analytics query':<20}{'aggregate':>12}{'raw':>12}{'speed-up':>10}")
+    for run in report['runs']:
+        timings = run['analytics_queries']
+        for name in ANALYTICS_QUERIES:
+            print(f"{run['data']:<30}{name:<20}{timings[name]['aggregate'] * 1000:>10.1f}ms"
+                  f"{timings[name]['raw'] * 1000:>10.1f}ms{timings[name]['raw'] / timings[name]['aggregate']:>9.1f}x")
+        print(f"{run['data']:<30}{'freshness check':<20}{timings['freshness_check'] * 1000:>10.1f}ms")
+
+
+def run_benchmark(data_dirs=None, output='benchmark_report.json', max_concurrency=None, baseline=None, tolerance=0.2):
+    '''
+    Benchmarks a full load on a local DuckDB database for every data directory, and writes a JSON report.
+
+    Each data directory holds log_data and song_data subdirectories. Without data directories, the
+    LOG_DATA and SONG_DATA of the [LOCAL] section of the config are used. Returns the stages that
+    regressed against the baseline report, if one is given.
+    '''
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+
+    MAX_CONCURRENCY        = max_concurrency or config.getint("ETL", "MAX_CONCURRENCY", fallback=4)
+
+    if data_dirs:
+        datasets = [(data_dir, os.path.join(data_dir, 'log_data'), os.path.join(data_dir, 'song_data'))
+                    for data_dir in data_dirs]
+    else:
+        datasets = [('local', config.get("LOCAL", "LOG_DATA"), config.get("LOCAL", "SONG_DATA"))]
+
+    report = {'backend': DuckDBBackend.name, 'generated_at': datetime.utcnow().isoformat(),
+              'max_concurrency': MAX_CONCURRENCY, 'runs': []}
+    for label, log_data, song_data in datasets:
+        print(f"Benchmarking {label}. Please wait...")
+        backend = DuckDBBackend(log_data=log_data, song_data=song_data)
+        run = benchmark_data(backend, MAX_CONCURRENCY)
+        backend.close()
+        run['data'] = label
+        report['runs'].append(run)
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print_report(report)
+    print(f"Report written to {output}\n")
+
+    if baseline is None:
+        return []
+    with open(baseline) as f:
+        regressions = find_regressions(report, json.load(f), tolerance)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the pipeline stages on a local DuckDB database.")
+    parser.add_argument('data_dirs', nargs='*', help="directories holding log_data and song_data, one per data scale")
+    parser.add_argument('--output', default='benchmark_report.json', help="path of the JSON report")
+    parser.add_argument('--max-concurrency', type=int, help="defaults to MAX_CONCURRENCY in dwh.cfg")
+    parser.add_argument('--baseline', help="JSON report to compare the stage times against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown against the baseline, as a fraction")
+    args = parser.parse_args()
+    regressions = run_benchmark(args.data_dirs, args.output, args.max_concurrency, args.baseline, args.tolerance)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,272 @@
+import argparse
+import configparser
+import csv
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from time import perf_counter
+
+import storage
+from aws_manager import AWSManager
+from sql_queries import staging_table_columns
+
+CONFIG_FILE = 'dwh.cfg'
+FILE_EXTENSIONS = {'parquet': '.parquet', 'json': '.json.gz', 'csv': '.csv.gz'}
+PARQUET_TYPES = {'varchar': 'string', 'int': 'int32', 'bigint': 'int64', 'float': 'float64'}
+PARQUET_ROW_GROUP_SIZE = 100000
+FILES_IN_FLIGHT_PER_WORKER = 4
+STATE_DIR = '_state'
+STATE_FILE = 'compacted.json'     # the raw files compacted by the finished runs, under STATE_DIR/<table>/
+
+_worker_aws_manager = None
+
+
+def _init_worker(config_file):
+    global _worker_aws_manager
+    _worker_aws_manager = AWSManager(config_file)
+
+
+def coerce(value, column_type):
+    '''
+    Converts a raw JSON value to the type of its staging column. Empty strings become NULL.
+    '''
+    if value is None or value == '':
+        return None
+    if column_type == 'varchar':
+        return str(value)
+    if column_type in ('int', 'bigint'):
+        return int(float(value))
+    return float(value)
+
+
+def read_records(uri, columns):
+    '''
+    Reads a raw JSON file holding one object per line and returns its records as tuples of staging column values.
+    '''
+    records = []
+    for line in storage.read_file(uri, _worker_aws_manager).splitlines():
+        if not line.strip():
+            continue
+        record = {key.lower(): value for key, value in json.loads(line).items()}
+        records.append(tuple(coerce(record.get(name), column_type) for name, column_type in columns))
+    return records
+
+
+def iter_file_records(files, columns, workers):
+    '''
+    Yields the (uri, records) of every (uri, size) file, in order, parsing files on a process pool.
+
+    At most FILES_IN_FLIGHT_PER_WORKER files per worker are read ahead of the consumer, so memory
+    use does not depend on the number of files.
+    '''
+    files = iter(files)
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(CONFIG_FILE,)) as executor:
+        pending = deque((uri, executor.submit(read_records, uri, columns))
+                        for uri, _ in islice(files, workers * FILES_IN_FLIGHT_PER_WORKER))
+        while pending:
+            uri, future = pending.popleft()
+            for next_uri, _ in islice(files, 1):
+                pending.append((next_uri, executor.submit(read_records, next_uri, columns)))
+            yield uri, future.result()
+
+
+class GzipJsonWriter:
+    '''
+    Writes records as gzip compressed JSON, one object per line.
+    '''
+    def __init__(self, path, columns):
+        self._names = [name for name, _ in columns]
+        self._file = gzip.open(path, 'wt', encoding='utf-8')
+        self.raw_bytes = 0
+
+    def write(self, record):
+        self.raw_bytes += self._file.write(json.dumps(dict(zip(self._names, record))) + '\n')
+
+    def close(self):
+        self._file.close()
+
+
+class GzipCsvWriter:
+    '''
+    Writes records as gzip compressed CSV, without a header, with NULLs as empty fields.
+    '''
+    def __init__(self, path, columns):
+        self._file = gzip.open(path, 'wt', encoding='utf-8', newline='')
+        self._writer = csv.writer(self._file)
+        self.raw_bytes = 0
+
+    def write(self, record):
+        self.raw_bytes += self._writer.writerow(record)
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetWriter:
+    '''
+    Writes records as a Parquet file, buffering at most PARQUET_ROW_GROUP_SIZE records at a time.
+
+    Requires pyarrow.
+    '''
+    def __init__(self, path, columns):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._schema = pa.schema([(name, PARQUET_TYPES[column_type]) for name, column_type in columns])
+        self._writer = pq.ParquetWriter(path, self._schema, compression='snappy')
+        self._buffer = []
+        self.raw_bytes = 0
+
+    def write(self, record):
+        self._buffer.append(record)
+        self.raw_bytes += len(repr(record))
+        if len(self._buffer) >= PARQUET_ROW_GROUP_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            arrays = [self._pa.array(values, type=field.type)
+                      for values, field in zip(zip(*self._buffer), self._schema)]
+            self._writer.write_table(self._pa.Table.from_arrays(arrays, schema=self._schema))
+            self._buffer = []
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+WRITERS = {'parquet': ParquetWriter, 'json': GzipJsonWriter, 'csv': GzipCsvWriter}
+
+
+def read_compacted_sources(state_dir, aws_manager=None):
+    '''
+    Returns the raw files already compacted, as recorded by the state files under state_dir.
+    '''
+    compacted = set()
+    for uri, _ in storage.list_files(state_dir, aws_manager):
+        if uri.endswith('.json'):
+            compacted.update(json.loads(storage.read_file(uri, aws_manager)))
+    return compacted
+
+
+def compact(table, source, destination, compaction_format, chunk_mb, workers, aws_manager=None):
+    '''
+    Merges the raw JSON files under source that were not compacted yet into evenly sized compressed chunks.
+
+    Chunks are written to destination/table and hold the staging columns of the table. A chunk is
+    closed after the first raw file that brings it to chunk_mb MiB of uncompressed records, then
+    copied to the destination and removed locally. Returns the input and output file counts and byte counts.
+
+    The raw files of every chunk are recorded under destination/_state/table as soon as it is copied,
+    so a failed run only compacts the files of its unfinished chunk again. A chunk is named after its raw
+    files, so a chunk copied but not recorded before a failure is overwritten by the next run rather than
+    duplicated. Once the run finishes, the chunk records are merged into STATE_FILE, which only keeps the
+    raw files still under source.
+    '''
+    columns = staging_table_columns[table]
+    extension = FILE_EXTENSIONS[compaction_format]
+    state_dir = storage.join(destination, STATE_DIR, table, '')
+    legacy_state_uri = storage.join(destination, STATE_DIR, f'{table}.json')
+    compacted = read_compacted_sources(state_dir, aws_manager)
+    if storage.exists(legacy_state_uri, aws_manager):
+        compacted.update(json.loads(storage.read_file(legacy_state_uri, aws_manager)))
+    listed = storage.list_files(source, aws_manager)
+    files = [(uri, size) for uri, size in listed if uri not in compacted]
+
+    stats = {'table': table, 'input_files': len(files), 'input_bytes': sum(size for _, size in files),
+             'output_files': 0, 'output_bytes': 0, 'records': 0}
+    start = perf_counter()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, f'chunk{extension}')
+        writer = None
+        chunk_sources = []
+
+        def finish_chunk():
+            chunk_id = hashlib.sha1('\n'.join(chunk_sources).encode()).hexdigest()[:16]
+            if writer is not None:
+                writer.close()
+                stats['output_files'] += 1
+                stats['output_bytes'] += os.path.getsize(path)
+                storage.upload_file(path, storage.join(destination, table, chunk_id + extension), aws_manager)
+                os.remove(path)
+            storage.write_file(storage.join(state_dir, f'chunk-{chunk_id}.json'), json.dumps(chunk_sources).encode(),
+                               aws_manager)
+            compacted.update(chunk_sources)
+
+        for uri, records in iter_file_records(files, columns, workers):
+            for record in records:
+                if writer is None:
+                    writer = WRITERS[compaction_format](path, columns)
+                writer.write(record)
+                stats['records'] += 1
+            chunk_sources.append(uri)
+            # Chunks are only closed between raw files, so every raw file is in a single chunk.
+            if writer is not None and writer.raw_bytes >= chunk_mb * 2**20:
+                finish_chunk()
+                writer = None
+                chunk_sources = []
+        if chunk_sources:
+            finish_chunk()
+
+    listed_uris = {uri for uri, _ in listed}
+    storage.write_file(storage.join(state_dir, STATE_FILE), json.dumps(sorted(compacted & listed_uris)).encode(),
+                       aws_manager)
+    for uri, _ in storage.list_files(state_dir, aws_manager):
+        if not uri.endswith(STATE_FILE):
+            storage.delete(uri, aws_manager)
+    storage.delete(legacy_state_uri, aws_manager)
+    stats['elapsed'] = perf_counter() - start
+    return stats
+
+
+def print_stats(stats):
+    elapsed = stats['elapsed'] or 1e-9
+    print(f"{stats['table']}: {stats['input_files']} files ({stats['input_bytes'] / 2**20:.1f} MiB) -> "
+          f"{stats['output_files']} files ({stats['output_bytes'] / 2**20:.1f} MiB), "
+          f"{stats['records']} records in {stats['elapsed']:.1f}s "
+          f"({stats['input_bytes'] / 2**20 / elapsed:.1f} MiB/s, {stats['records'] / elapsed:.0f} records/s)")
+
+
+def run_compaction(compaction_format=None, chunk_mb=None, workers=None):
+    '''
+    Compacts the new raw event and song files into COMPACTED_DATA, so etl.py can load them with a few large COPYs.
+    '''
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+
+    LOG_DATA               = config.get("S3", "LOG_DATA")
+    SONG_DATA              = config.get("S3", "SONG_DATA")
+    COMPACTED_DATA         = config.get("S3", "COMPACTED_DATA", fallback="")
+    COMPACTION_FORMAT      = compaction_format or config.get("ETL", "COMPACTION_FORMAT", fallback="parquet")
+    COMPACTION_CHUNK_MB    = chunk_mb or config.getint("ETL", "COMPACTION_CHUNK_MB", fallback=256)
+    WORKERS                = workers or os.cpu_count()
+
+    if not COMPACTED_DATA:
+        print("COMPACTED_DATA is not set, skipping compaction.\n")
+        return []
+
+    aws_manager = AWSManager(CONFIG_FILE)
+    all_stats = []
+    for table, source in [('staging_events', LOG_DATA), ('staging_songs', SONG_DATA)]:
+        print(f"Compacting {source} into {COMPACTION_FORMAT} chunks. Please wait...")
+        stats = compact(table, source, COMPACTED_DATA, COMPACTION_FORMAT, COMPACTION_CHUNK_MB, WORKERS, aws_manager)
+        print_stats(stats)
+        all_stats.append(stats)
+    print("Finished!\n")
+    return all_stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compacts the raw Sparkify JSON files into large compressed chunks.")
+    parser.add_argument('--format', choices=sorted(WRITERS), help="output format, defaults to COMPACTION_FORMAT")
+    parser.add_argument('--chunk-mb', type=int, help="uncompressed size of each chunk, defaults to COMPACTION_CHUNK_MB")
+    parser.add_argument('--workers', type=int, help="number of parsing processes, defaults to the CPU count")
+    args = parser.parse_args()
+    run_compaction(args.format, args.chunk_mb, args.workers)
@@ -0,0 +1,235 @@
+import configparser
+import random
+import threading
+from collections import deque
+from time import sleep
+
+# SQLSTATE codes of failures that are worth retrying: the server is shutting down or out of connections,
+# or the transaction lost a serialization or deadlock conflict. Class 08 (connection exception) is retried too.
+TRANSIENT_SQLSTATES = {'40001', '40P01', '53300', '57P01', '57P02', '57P03'}
+QUERY_CANCELED = '57014'
+MAX_BACKOFF = 30.0      # longest delay between two retries, in seconds
+
+
+def is_transient(error):
+    '''
+    Returns True if a database error is likely to succeed when retried on a new connection.
+
+    Redshift cancels a query with QUERY_CANCELED when it times out in a WLM queue, with a message naming
+    WLM in either case. A query canceled by its own statement_timeout or by a user has the same code, but
+    would fail again, so it is not retried.
+    '''
+    if not type(error).__module__.startswith('psycopg2'):
+        return False
+    pgcode = getattr(error, 'pgcode', None)
+    if pgcode is None:
+        # The connection was lost or could not be opened, so the server sent no SQLSTATE.
+        return type(error).__name__ in ('OperationalError', 'InterfaceError')
+    if pgcode == QUERY_CANCELED:
+        return 'wlm' in str(error).lower()
+    return pgcode.startswith('08') or pgcode in TRANSIENT_SQLSTATES
+
+
+def backoff_delay(attempt, backoff, max_backoff=MAX_BACKOFF):
+    '''
+    Returns the delay before the given retry: exponential from backoff up to max_backoff seconds, with equal
+    jitter. Half of the delay is fixed, so a retry never follows the failure immediately.
+    '''
+    delay = min(max_backoff, backoff * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def connect_postgres(config=None, dsn='', **params):
+    '''
+    Opens a psycopg2 connection to the DSN and/or connection parameters, with the connect timeout and
+    TCP keepalives of the [CONNECTION] section of the config. Keepalives detect a connection dropped
+    during a long COPY, instead of waiting on it forever.
+    '''
+    import psycopg2
+
+    config = config or configparser.ConfigParser()
+    CONNECT_TIMEOUT        = config.getint("CONNECTION", "CONNECT_TIMEOUT", fallback=10)
+    KEEPALIVES_IDLE        = config.getint("CONNECTION", "KEEPALIVES_IDLE", fallback=60)
+    KEEPALIVES_INTERVAL    = config.getint("CONNECTION", "KEEPALIVES_INTERVAL", fallback=10)
+    KEEPALIVES_COUNT       = config.getint("CONNECTION", "KEEPALIVES_COUNT", fallback=5)
+
+    return psycopg2.connect(dsn, connect_timeout=CONNECT_TIMEOUT, keepalives=1, keepalives_idle=KEEPALIVES_IDLE,
+                            keepalives_interval=KEEPALIVES_INTERVAL, keepalives_count=KEEPALIVES_COUNT, **params)
+
+
+def get_connection_manager(open_connection, config=None, query_group_setting=None):
+    '''
+    Returns a ConnectionManager configured by the [CONNECTION] section of the config.
+    '''
+    if config is None:
+        return ConnectionManager(open_connection)
+
+    STATEMENT_TIMEOUT      = config.getint("CONNECTION", "STATEMENT_TIMEOUT", fallback=0)
+    QUERY_GROUP            = config.get("CONNECTION", "QUERY_GROUP", fallback="")
+    MAX_RETRIES            = config.getint("CONNECTION", "MAX_RETRIES", fallback=3)
+    RETRY_BACKOFF          = config.getfloat("CONNECTION", "RETRY_BACKOFF", fallback=1.0)
+    MAX_IDLE               = config.getint("CONNECTION", "MAX_IDLE", fallback=8)
+
+    session_statements = [f"SET statement_timeout TO {STATEMENT_TIMEOUT}"] if STATEMENT_TIMEOUT else []
+    return ConnectionManager(open_connection, session_statements, query_group_setting, QUERY_GROUP or None,
+                             MAX_RETRIES, RETRY_BACKOFF, max_idle=MAX_IDLE)
+
+
+class ManagedConnection:
+    '''
+    A connection handed out by a ConnectionManager. Closing it returns it to the manager's idle pool.
+    '''
+    def __init__(self, manager, connection, query_group=None):
+        self._manager = manager
+        self._connection = connection
+        self.query_group = query_group
+
+    @property
+    def autocommit(self):
+        return self._connection.autocommit
+
+    @autocommit.setter
+    def autocommit(self, value):
+        self._connection.autocommit = value
+
+    def set_query_group(self, query_group):
+        '''
+        Tags the following queries of the connection with the query group, which routes them to a WLM queue.
+        None sets the manager's default query group. Must be called outside of a transaction.
+        '''
+        self._manager._set_query_group(self, query_group or self._manager.default_query_group)
+
+    def discard(self):
+        '''
+        Closes the connection for good, e.g. after it failed, instead of returning it to the pool.
+        '''
+        self._manager._release(self, discard=True)
+
+    def close(self):
+        self._manager._release(self)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+class ConnectionManager:
+    '''
+    Opens and pools the connections to one database.
+
+    - open_connection is a callable opening a new DB-API connection
+    - session_statements run once on every new connection, e.g. to set its statement timeout
+    - query_group_setting names the session setting tagging the queries of a connection with a query group:
+      query_group on Redshift, where it routes them to a WLM queue. Connections get default_query_group
+      unless another one is requested.
+    - opening a connection is retried max_retries times on transient errors, with jittered exponential backoff
+
+    Closed connections are kept idle, at most max_idle of them, and handed out again by connect(),
+    so the stages of a run reuse the same connections. close_all() closes them for good.
+    '''
+    def __init__(self, open_connection, session_statements=(), query_group_setting=None, default_query_group=None,
+                 max_retries=3, backoff=1.0, max_backoff=MAX_BACKOFF, max_idle=8):
+        self._open_connection = open_connection
+        self._session_statements = list(session_statements)
+        self._query_group_setting = query_group_setting
+        self.default_query_group = default_query_group
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._max_idle = max_idle
+        self._idle = deque()
+        self._lock = threading.Lock()
+
+    def retry(self, operation, description='operation'):
+        '''
+        Runs the operation, retrying it on transient errors. Returns its result.
+        '''
+        attempt = 0
+        while True:
+            try:
+                return operation()
+            except Exception as e:
+                if attempt >= self.max_retries or not is_transient(e):
+                    raise
+                delay = backoff_delay(attempt, self.backoff, self.max_backoff)
+                print(f"  {description} failed ({str(e).strip().splitlines()[0]}), retrying in {delay:.1f}s")
+                sleep(delay)
+                attempt += 1
+
+    def _open(self):
+        connection = self._open_connection()
+        try:
+            if self._session_statements:
+                cur = connection.cursor()
+                for statement in self._session_statements:
+                    cur.execute(statement)
+                connection.commit()
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    def connect(self, query_group=None):
+        '''
+        Returns an idle connection, or a newly opened one, tagged with the query group.
+        '''
+        conn = None
+        with self._lock:
+            while self._idle and conn is None:
+                conn = self._idle.popleft()
+                # A connection closed by a failure while idle is dropped.
+                if getattr(conn._connection, 'closed', False):
+                    conn = None
+        if conn is None:
+            conn = ManagedConnection(self, self.retry(self._open, 'connecting'))
+        try:
+            conn.set_query_group(query_group)
+        except Exception:
+            conn.discard()
+            raise
+        return conn
+
+    def _set_query_group(self, conn, query_group):
+        if self._query_group_setting is None or query_group == conn.query_group:
+            return
+        cur = conn.cursor()
+        if query_group is None:
+            cur.execute(f"RESET {self._query_group_setting}")
+        else:
+            quoted = query_group.replace("'", "''")
+            cur.execute(f"SET {self._query_group_setting} TO '{quoted}'")
+        # A SET is undone by the rollback of its transaction, so it is committed right away.
+        conn.commit()
+        conn.query_group = query_group
+
+    def _release(self, conn, discard=False):
+        raw = conn._connection
+        if raw is None:
+            return
+        if getattr(raw, 'closed', False):
+            discard = True
+        if not discard:
+            try:
+                raw.rollback()
+                raw.autocommit = False
+            except Exception:
+                discard = True
+        with self._lock:
+            if not discard and len(self._idle) < self._max_idle:
+                self._idle.append(ManagedConnection(self, raw, conn.query_group))
+                raw = None
+        # The released wrapper is detached, so a second close() can't hand the connection out twice.
+        conn._connection = None
+        if raw is not None:
+            try:
+                raw.close()
+            except Exception:
+                pass
+
+    def close_all(self):
+        '''
+        Closes every idle connection.
+        '''
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for conn in idle:
+            conn._connection.close()
@@ -1,50 +1,53 @@
 import configparser
-import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
-import boto3
-from aws_manager import AWSManager
+from sql_queries import create_table_queries, drop_table_queries, create_control_table_queries, drop_control_table_queries
+from backends import get_backend
+from profiling import execute
 
-def drop_tables(cur, conn):
+def drop_tables(cur, conn, profiler=None):
     '''
     Drops all tables in the Redshift database so that the ETL script can be rerun.
+    This includes the incremental load state, so the next run of etl.py reloads everything.
+    All tables are dropped in a single transaction.
     '''
-    for query in drop_table_queries:
-        cur.execute(query)
-        conn.commit()
+    for query in drop_table_queries + drop_control_table_queries:
+        execute(cur, query, profiler)
+    conn.commit()
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, profiler=None):
     '''
-    Creates all Redshift tables.
+    Creates all Redshift tables that do not exist yet, in a single transaction.
+    To change the schema of existing tables without dropping their rows, use migrations.py instead.
     '''
-    for query in create_table_queries:
-        cur.execute(query)
-        conn.commit()
+    for query in create_table_queries + create_control_table_queries:
+        execute(cur, query, profiler)
+    conn.commit()
 
 
-def run_initial_setup():
+def run_initial_setup(backend=None, profiler=None):
     '''
-    - Drops all tables in the Redshift database so that the ETL script can be rerun.
-    - Creates all Redshift tables. 
+    - Drops all tables in the database so that the ETL script can be rerun.
+    - Creates all tables. 
+
+    Runs on the Redshift cluster, unless another execution backend is given.
+    If a profiler is given, the drop and create stages are recorded with it.
     '''
-    config = configparser.ConfigParser()
-    CONFIG_FILE = 'dwh.cfg'
-    config.read(CONFIG_FILE)
-    
-    DWH_DB                 = config.get("CLUSTER","DB_NAME")
-    DWH_DB_USER            = config.get("CLUSTER","DB_USER")
-    DWH_DB_PASSWORD        = config.get("CLUSTER","DB_PASSWORD")
-    DWH_PORT               = config.get("CLUSTER","DB_PORT")
+    if backend is None:
+        config = configparser.ConfigParser()
+        CONFIG_FILE = 'dwh.cfg'
+        config.read(CONFIG_FILE)
+        backend = get_backend(config)
 
-    aws_manager = AWSManager()
-    HOST = aws_manager.get_cluster_endpoint()
-    
-    conn = psycopg2.connect(f"host={HOST} dbname={DWH_DB} user={DWH_DB_USER} password={DWH_DB_PASSWORD} port={DWH_PORT}")
+    conn = backend.connect()
     cur = conn.cursor()
 
     print("Resetting Tables.")
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
+    for stage, run_stage in [('drop', drop_tables), ('create', create_tables)]:
+        if profiler is not None:
+            profiler.start_stage(stage)
+        run_stage(cur, conn, profiler)
+        if profiler is not None:
+            profiler.end_stage(cur)
     print("Finished!\n")
     
     conn.close()
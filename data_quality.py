@@ -0,0 +1,299 @@
+import argparse
+import configparser
+import json
+import sys
+from time import perf_counter
+
+from backends import get_backend
+from migrations import parse_table_ddl
+from sql_queries import create_table_queries
+
+CONFIG_FILE = 'dwh.cfg'
+CHECK_KINDS = ['row_counts', 'unique_keys', 'foreign_keys', 'null_rates']
+# Tables whose primary keys, references and null rates are checked.
+CHECKED_TABLES = ['factSongplay', 'dimUser', 'dimSong', 'dimArtist', 'dimTime', 'song_lookup']
+
+EVENT_TIME = "'1970-01-01'::date + e.ts/1000 * interval '1 second'"
+# Only the final rows in the time range of the staged events are joined, so incremental loads don't read
+# the whole history.
+STAGED_TIME_RANGE = "start_time BETWEEN r.first_time AND r.last_time"
+STAGED_RANGE = """staged_range AS (
+                      SELECT '1970-01-01'::date + MIN(ts/1000) * interval '1 second' AS first_time,
+                             '1970-01-01'::date + MAX(ts/1000) * interval '1 second' AS last_time
+                      FROM staging_events
+                  )"""
+
+# The rows of each final table that the checks read after a load: those the staged rows could have
+# reached, so that the checks don't scan the whole history on every incremental run. Maps each checked
+# table to its (column, condition on the column).
+IN_STAGED_RANGE = "{column} BETWEEN (SELECT first_time FROM staged_range) AND (SELECT last_time FROM staged_range)"
+CHECK_SCOPES = {
+    'factSongplay': ('start_time', IN_STAGED_RANGE),
+    'dimTime':      ('start_time', IN_STAGED_RANGE),
+    'dimUser':      ('user_id', "{column} IN (SELECT userId FROM staging_events)"),
+    'dimSong':      ('song_id', "{column} IN (SELECT song_id FROM staging_songs)"),
+    'dimArtist':    ('artist_id', "{column} IN (SELECT artist_id FROM staging_songs)"),
+    'song_lookup':  ('song_key', "{column} IN (SELECT song_key FROM song_lookup "
+                                 "WHERE song_id IN (SELECT song_id FROM staging_songs))"),
+}
+
+# Row-count reconciliation: one query per staging table counts the staged rows, and the staged rows
+# whose key did not reach its final table. The final keys are made distinct before the join, so
+# every staged row matches at most once. Maps each staging table to its query and, for every
+# reconciled final table, the (final table, column of missing rows, column of staged rows).
+RECONCILIATIONS = {
+    'staging_events': (f"""WITH {STAGED_RANGE}
+                           SELECT COUNT(*),
+                                  SUM(CASE WHEN e.page = 'NextSong' THEN 1 ELSE 0 END),
+                                  SUM(CASE WHEN e.page = 'NextSong' AND f.start_time IS NULL THEN 1 ELSE 0 END),
+                                  COUNT(e.userId),
+                                  SUM(CASE WHEN e.userId IS NOT NULL AND u.user_id IS NULL THEN 1 ELSE 0 END),
+                                  SUM(CASE WHEN t.start_time IS NULL THEN 1 ELSE 0 END)
+                           FROM staging_events e
+                           LEFT JOIN (SELECT DISTINCT start_time, user_id, session_id, item_in_session
+                                      FROM factSongplay, staged_range r WHERE {STAGED_TIME_RANGE}) f
+                                  ON e.page = 'NextSong' AND f.start_time = {EVENT_TIME} AND f.user_id = e.userId
+                                 AND COALESCE(f.session_id, -1) = COALESCE(e.sessionId, -1)
+                                 AND COALESCE(f.item_in_session, -1) = COALESCE(e.itemInSession, -1)
+                           LEFT JOIN (SELECT DISTINCT user_id FROM dimUser) u ON u.user_id = e.userId
+                           LEFT JOIN (SELECT DISTINCT start_time FROM dimTime, staged_range r WHERE {STAGED_TIME_RANGE}) t
+                                  ON t.start_time = {EVENT_TIME}
+                           WHERE e.ts IS NOT NULL
+    """, [('factSongplay', 2, 1), ('dimUser', 4, 3), ('dimTime', 5, 0)]),
+    'staging_songs': ("""SELECT COUNT(*),
+                                COUNT(s.song_id),
+                                SUM(CASE WHEN s.song_id IS NOT NULL AND d.song_id IS NULL THEN 1 ELSE 0 END),
+                                COUNT(s.artist_id),
+                                SUM(CASE WHEN s.artist_id IS NOT NULL AND a.artist_id IS NULL THEN 1 ELSE 0 END)
+                         FROM staging_songs s
+                         LEFT JOIN (SELECT DISTINCT song_id FROM dimSong) d ON d.song_id = s.song_id
+                         LEFT JOIN (SELECT DISTINCT artist_id FROM dimArtist) a ON a.artist_id = s.artist_id
+    """, [('dimSong', 2, 1), ('dimArtist', 4, 3)]),
+}
+
+
+class DataQualityError(Exception):
+    '''
+    Raised when a data quality check fails and the run is set to fail. Holds the report.
+    '''
+    def __init__(self, report):
+        failed = [f"{check['table']}.{check['column'] or '*'} {check['check']}"
+                  for check in report['checks'] if not check['passed']]
+        super().__init__(f"{len(failed)} data quality check(s) failed: {', '.join(failed)}")
+        self.report = report
+
+
+def parse_null_rates(setting):
+    '''
+    Parses NULL_RATES, a comma-separated list of table.column:max_rate, into {(table, column): max_rate},
+    with lower-case names.
+    '''
+    null_rates = {}
+    for item in setting.split(','):
+        if item.strip():
+            column, _, max_rate = item.strip().partition(':')
+            table, _, column = column.strip().lower().partition('.')
+            null_rates[(table, column)] = float(max_rate)
+    return null_rates
+
+
+def scope_condition(table, column=None):
+    '''
+    Returns the condition limiting the table to the rows the staged rows could have reached, on the given
+    column of its scope, or None if the table has no scope.
+    '''
+    if table not in CHECK_SCOPES:
+        return None
+    scope_column, condition = CHECK_SCOPES[table]
+    return condition.format(column=column or scope_column)
+
+
+def compile_table_checks(table, kinds, null_rates, columns=None, primary_key=None, references=None, scoped=False):
+    '''
+    Compiles the checks of one table into a single aggregate query, which scans the table once
+    and joins it to the distinct keys of each referenced table. When scoped, only the rows of the table in
+    its scope are checked, and they are joined only to the referenced keys they could match.
+
+    Returns the query and, for every check, a (check, column, threshold, detail) tuple: its result is
+    the column of the query at the same position, after the row count in the first column.
+    '''
+    columns = columns or []
+    references = references or {}
+    selects, checks, joins = ["COUNT(*)"], [], []
+    scope = scope_condition(table, f"t.{CHECK_SCOPES[table][0]}") if scoped and table in CHECK_SCOPES else None
+    if 'unique_keys' in kinds and primary_key:
+        selects.append(f"COUNT(t.{primary_key}) - COUNT(DISTINCT t.{primary_key})")
+        checks.append(('unique_keys', primary_key, 0, 'duplicate keys'))
+    if 'foreign_keys' in kinds:
+        for i, (column, (referenced_table, referenced_column)) in enumerate(sorted(references.items())):
+            referenced_keys = f"SELECT DISTINCT {referenced_column} FROM {referenced_table}"
+            if scope is not None:
+                # A referenced table scoped on the same time range is read in that range, which its sort key
+                # prunes. Any other one is read only for the keys of the checked rows.
+                if (CHECK_SCOPES.get(referenced_table) == (referenced_column, IN_STAGED_RANGE)
+                        and CHECK_SCOPES[table] == (column, IN_STAGED_RANGE)):
+                    referenced_keys += f" WHERE {scope_condition(referenced_table)}"
+                else:
+                    checked_rows = scope_condition(table, f"s.{CHECK_SCOPES[table][0]}")
+                    referenced_keys += (f" WHERE {referenced_column} IN "
+                                        f"(SELECT s.{column} FROM {table} s WHERE {checked_rows})")
+            joins.append(f"LEFT JOIN ({referenced_keys}) r{i} ON r{i}.{referenced_column} = t.{column}")
+            selects.append(f"SUM(CASE WHEN t.{column} IS NOT NULL AND r{i}.{referenced_column} IS NULL THEN 1 ELSE 0 END)")
+            checks.append(('foreign_keys', column, 0, f"orphans of {referenced_table}.{referenced_column}"))
+    if 'null_rates' in kinds:
+        for column in columns:
+            max_rate = 0.0 if column == primary_key else null_rates.get((table.lower(), column.lower()))
+            if max_rate is not None:
+                selects.append(f"SUM(CASE WHEN t.{column} IS NULL THEN 1 ELSE 0 END)")
+                checks.append(('null_rates', column, max_rate, 'null rate'))
+    query = ' '.join([f"SELECT {', '.join(selects)} FROM {table} t"] + joins)
+    if scope is not None:
+        query = f"{query} WHERE {scope}"
+        if 'staged_range' in query:
+            query = f"WITH {STAGED_RANGE}\n{query}"
+    return query, checks
+
+
+def get_table_checks(kinds, null_rates, scoped=True):
+    '''
+    Returns the compiled checks of every checked table, from its CREATE TABLE statement in sql_queries.py,
+    and of every staging table with a null rate to check. When scoped, the checks of the final tables read
+    only the rows the staged rows could have reached, and otherwise the whole tables.
+    '''
+    compiled = {}
+    for query in create_table_queries:
+        parsed = parse_table_ddl(query)
+        table = parsed['table']
+        checked = table in CHECKED_TABLES
+        if not checked and not any(key[0] == table.lower() for key in null_rates):
+            continue
+        references = {column: (referenced_table, parsed['referenced_columns'][column])
+                      for column, referenced_table in parsed['references'].items()} if checked else {}
+        columns = [name for name, _, _ in parsed['columns']]
+        compiled[table] = compile_table_checks(table, kinds, null_rates, columns,
+                                               parsed['primary_key'] if checked else None, references, scoped)
+    return compiled
+
+
+def run_quality_checks(cur, kinds=CHECK_KINDS, null_rates=None, scoped=True):
+    '''
+    Runs the data quality checks of the given kinds, with one aggregate query per table:
+
+    - row_counts: every staged song play, user and timestamp of staging_events, and every song and artist
+      of staging_songs, reached its final table
+    - unique_keys: no primary key value appears twice. Redshift does not enforce primary keys.
+    - foreign_keys: every value of a column referencing another table exists in that table
+    - null_rates: the share of NULLs of each column in null_rates stays below its maximum,
+      and primary keys have none
+
+    When scoped, the final tables are checked only in the rows the staged rows could have reached:
+    song plays and timestamps in the time range of the staged events, and the staged users, songs and artists.
+
+    Returns a report with the outcome of every check, and whether they all passed.
+    '''
+    null_rates = null_rates or {}
+    report = {'passed': True, 'checks': [], 'row_counts': {}, 'queries': []}
+
+    def add_check(table, check, column, value, rows, threshold, detail):
+        passed = value <= threshold
+        report['checks'].append({'table': table, 'check': check, 'column': column, 'value': value,
+                                 'rows': rows, 'threshold': threshold, 'detail': detail, 'passed': passed})
+        report['passed'] = report['passed'] and passed
+
+    def run(name, query):
+        start = perf_counter()
+        cur.execute(query)
+        row = cur.fetchone()
+        report['queries'].append({'name': name, 'elapsed': perf_counter() - start})
+        # Sums come back as decimals from PostgreSQL.
+        return [int(value or 0) for value in row]
+
+    if 'row_counts' in kinds:
+        for staging_table, (query, reconciled) in RECONCILIATIONS.items():
+            row = run(f"{staging_table} reconciliation", query)
+            report['row_counts'][staging_table] = row[0]
+            for table, missing, staged in reconciled:
+                add_check(table, 'row_counts', None, row[missing], row[staged], 0,
+                          f"staged rows of {staging_table} missing")
+
+    for table, (query, checks) in get_table_checks(kinds, null_rates, scoped).items():
+        row = run(f"{table} checks", query)
+        rows = row[0]
+        report['row_counts'][table] = rows
+        for (check, column, threshold, detail), value in zip(checks, row[1:]):
+            if check == 'null_rates':
+                value = value / rows if rows else 0.0
+            add_check(table, check, column, value, rows, threshold, detail)
+    return report
+
+
+def print_report(report):
+    print(f"  {'table':<16}{'column':<14}{'check':<14}{'value':>10}{'threshold':>11}{'rows':>10}  result")
+    for check in report['checks']:
+        value, threshold = check['value'], check['threshold']
+        if check['check'] == 'null_rates':
+            value, threshold = f"{100 * value:.1f}%", f"{100 * threshold:.1f}%"
+        print(f"  {check['table']:<16}{check['column'] or '':<14}{check['check']:<14}{value:>10}{threshold:>11}"
+              f"{check['rows']:>10}  {'ok' if check['passed'] else 'FAILED: ' + check['detail']}")
+    elapsed = sum(query['elapsed'] for query in report['queries'])
+    failed = sum(1 for check in report['checks'] if not check['passed'])
+    print(f"{len(report['checks'])} checks in {len(report['queries'])} queries ({elapsed:.2f}s), {failed} failed.\n")
+
+
+def get_quality_settings(config):
+    '''
+    Returns the check kinds, null rates, whether a failed check fails the run and the report file,
+    from the [QUALITY] section of the config.
+    '''
+    CHECKS                 = config.get("QUALITY", "CHECKS", fallback=','.join(CHECK_KINDS))
+    NULL_RATES             = config.get("QUALITY", "NULL_RATES", fallback="")
+    FAIL_RUN               = config.getboolean("QUALITY", "FAIL_RUN", fallback=True)
+    REPORT_FILE            = config.get("QUALITY", "REPORT_FILE", fallback="")
+
+    kinds = [kind.strip() for kind in CHECKS.split(',') if kind.strip()]
+    unknown = set(kinds) - set(CHECK_KINDS)
+    if unknown:
+        raise ValueError(f"Unknown data quality check(s) {', '.join(sorted(unknown))} in CHECKS.")
+    return kinds, parse_null_rates(NULL_RATES), FAIL_RUN, REPORT_FILE
+
+
+def validate_load(cur, config, report_file=None, scoped=True):
+    '''
+    Runs the data quality checks set in the [QUALITY] section of the config, prints the report and writes it
+    to the report file, or to REPORT_FILE, if set. Raises DataQualityError if a check failed and FAIL_RUN is set.
+    Unless scoped is False, the final tables are checked only in the rows of the staged data. Returns the report.
+    '''
+    kinds, null_rates, fail_run, REPORT_FILE = get_quality_settings(config)
+    report = run_quality_checks(cur, kinds, null_rates, scoped)
+    print_report(report)
+    report_file = report_file or REPORT_FILE
+    if report_file:
+        with open(report_file, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Data quality report written to {report_file}\n")
+    if fail_run and not report['passed']:
+        raise DataQualityError(report)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks the quality of the data loaded by etl.py.")
+    parser.add_argument('--backend', choices=['redshift', 'duckdb', 'postgres'],
+                        help="execution backend, defaults to BACKEND in the [ETL] section of dwh.cfg")
+    parser.add_argument('--report', help="write the report to this JSON file, defaults to REPORT_FILE in dwh.cfg")
+    parser.add_argument('--all', action='store_true',
+                        help="check every row of the final tables, instead of the rows of the staged data")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    backend = get_backend(config, args.backend)
+    conn = backend.connect()
+    try:
+        validate_load(conn.cursor(), config, args.report, scoped=not args.all)
+    except DataQualityError as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        conn.close()
+        backend.close()
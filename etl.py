@@ -1,59 +1,450 @@
+import argparse
 import configparser
-import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
-import boto3
-from aws_manager import AWSManager
+import os
+import socket
+from time import perf_counter
+from sql_queries import (load_query_graph, merge_query_graph, songplay_table_append, watermark_update,
+                         loaded_files_insert, loaded_files_select, watermark_select, truncate_staging_queries,
+                         song_match_select, load_lock_table_create, load_lock_table_lock, load_lock_select,
+                         load_lock_delete, load_lock_insert, load_lock_release)
+from backends import STAGING_TABLES, get_backend
+from create_tables import run_initial_setup
+from aggregates import refresh_aggregates
+from data_quality import validate_load
+from maintenance import LOADED_TABLES, run_maintenance
+from migrations import migrate_schema
+from profiling import QueryProfiler, execute
+from scheduler import run_query_graph
 
-def load_staging_tables(cur, conn):
+DEFAULT_LOCK_EXPIRY = 6 * 3600    # seconds after which a load lock left by a dead load is taken over
+
+
+class LoadLockedError(Exception):
+    '''
+    Raised when another load holds the load lock.
+    '''
+
+
+def get_lock_owner(program):
     '''
-    Loads raw staging tables collected from S3 storage. 
+    Returns the name of this process in the load lock.
     '''
-    for query in copy_table_queries:
-        cur.execute(query)
+    return f"{program} on {socket.gethostname()} (pid {os.getpid()})"
+
+
+def acquire_load_lock(backend, owner, expiry=DEFAULT_LOCK_EXPIRY):
+    '''
+    Takes the load lock, so that only one load at a time, etl.py or a batch of streaming.py, empties and
+    fills the staging tables and records the loaded files. The lock table is locked while it is read and
+    written, so two loads can't take the lock together. A lock taken more than expiry seconds ago is
+    taken over, since its load died without releasing it. Raises LoadLockedError if another load holds it.
+    '''
+    conn = backend.connect()
+    try:
+        cur = conn.cursor()
+        cur.execute(load_lock_table_create)
+        conn.commit()
+        cur.execute(load_lock_table_lock)
+        cur.execute(load_lock_select)
+        row = cur.fetchone()
+        if row and row[0] != owner and (row[2] - row[1]).total_seconds() < expiry:
+            raise LoadLockedError(f"The load lock is held by {row[0]} since {row[1]:%Y-%m-%d %H:%M:%S}.")
+        cur.execute(load_lock_delete)
+        cur.execute(load_lock_insert, (owner,))
         conn.commit()
+    finally:
+        conn.close()
 
 
-def insert_tables(cur, conn):
+def release_load_lock(backend, owner):
     '''
-    Loads the final dimensional tables
+    Releases the load lock, if the owner still holds it.
     '''
-    for query in insert_table_queries:
-        cur.execute(query)
+    conn = backend.connect()
+    try:
+        conn.cursor().execute(load_lock_release, (owner,))
         conn.commit()
+    finally:
+        conn.close()
+
+
+def release_lock_after_failure(backend, owner):
+    '''
+    Releases the load lock after a failed load. A failure to release it is printed rather than raised,
+    so it doesn't hide the error of the load; the lock then expires.
+    '''
+    try:
+        release_load_lock(backend, owner)
+    except Exception as e:
+        print(f"Could not release the load lock: {str(e).strip().splitlines()[0]}")
+
+
+def prepare_tables(cur, conn, physical_design=False, profiler=None):
+    '''
+    Migrates the schema to the DDL of sql_queries.py, creating any missing table without dropping loaded rows,
+    and empties the staging tables, so they only hold the files loaded by this run.
+    '''
+    migrate_schema(cur, conn, physical_design, profiler=profiler)
+    for query in truncate_staging_queries:
+        execute(cur, query, profiler)
+    conn.commit()
+
+
+def get_load_state(cur):
+    '''
+    Returns the files already loaded into each staging table and the current event timestamp watermark.
+    '''
+    loaded_keys = {}
+    for table in STAGING_TABLES:
+        cur.execute(loaded_files_select, (table,))
+        loaded_keys[table] = {row[0] for row in cur.fetchall()}
+
+    cur.execute(watermark_select)
+    row = cur.fetchone()
+    watermark = row[0] if row else 0
+    return loaded_keys, watermark
+
+
+def report_song_matches(cur):
+    '''
+    Prints how many of the staged song plays matched a song on its title, artist and duration, and how many a
+    join on the title alone would have matched, and duplicated through songs sharing a title.
+    Returns the counts.
+    '''
+    cur.execute(song_match_select)
+    events, matched, title_matched, title_join_rows = cur.fetchone()
+    if events:
+        print(f"Song matches: {matched} of {events} song plays ({100.0 * matched / events:.1f}%) on title, artist "
+              f"and duration. A join on the title alone would have matched {title_matched} and added "
+              f"{title_join_rows - events} duplicate row(s).\n")
+    return {'events': events, 'matched': matched, 'title_matched': title_matched,
+            'title_join_fan_out': title_join_rows - events}
+
+
+def expand_copies(graph, copies):
+    '''
+    Replaces whole-prefix COPY queries of the graph with the given per-file or per-batch COPYs.
+
+    copies maps the name of a COPY in the graph to the graph entries replacing it. Queries that
+    depended on the original COPY depend on all of its replacements instead.
+    '''
+    expanded = {}
+    for name, (query, dependencies) in graph.items():
+        if name in copies:
+            continue
+        expanded_dependencies = []
+        for dependency in dependencies:
+            expanded_dependencies.extend(copies[dependency] if dependency in copies else [dependency])
+        expanded[name] = (query, expanded_dependencies)
+    for entries in copies.values():
+        expanded.update(entries)
+    return expanded
+
+
+def plan_copies(sources, new_objects, manifest_loader=None):
+    '''
+    Decides how the new (uri, size) files of each source are copied into staging.
+
+    - with a manifest loader, the objects are loaded in slice-balanced manifest batches
+    - otherwise, every new object gets its own COPY
+
+    Only the listed files are copied, never a whole prefix, so a file landing after the listing is neither
+    loaded nor recorded as loaded, and is found by the next run.
+    '''
+    copies = {}
+    for table, source, copy_from in sources:
+        name = f'{table}_copy'
+        objects = new_objects[table]
+        if not objects:
+            copies[name] = {}
+        elif manifest_loader is not None:
+            copies[name] = manifest_loader.build_copies(name, objects, copy_from)
+        else:
+            copies[name] = {f'{name}:{uri}': (copy_from(uri), []) for uri, _ in objects}
+    return copies
+
+
+def build_load_graph(full_refresh, sources, new_objects, watermark, manifest_loader=None):
+    '''
+    Returns the query graph loading the new files into staging and processing them into the final tables:
+    load_query_graph after a full refresh, merge_query_graph otherwise. The song play query also records
+    the new load state, the loaded files and the event timestamp watermark, and commits them together
+    with the song plays, so a failed run can't leave song plays whose files would be loaded again.
+    '''
+    if full_refresh:
+        graph = dict(load_query_graph)
+        last_query = 'songplay_table_insert'
+    else:
+        graph = dict(merge_query_graph)
+        last_query = 'songplay_table_append'
+        graph[last_query] = (songplay_table_append(watermark), graph[last_query][1])
+    graph = expand_copies(graph, plan_copies(sources, new_objects, manifest_loader))
+
+    record_state = watermark_update(watermark)
+    for table, objects in new_objects.items():
+        record_state += loaded_files_insert([uri for uri, _ in objects], table)
+    query, dependencies = graph[last_query]
+    graph[last_query] = ([query] + record_state, dependencies)
+    return graph
+
 
+def load_tables(graph, backend, max_concurrency, manifest_loader=None, profiler=None, copy_query_group=None,
+                quiet=False):
+    '''
+    Loads the raw staging tables and processes them into the final dimensional tables.
+
+    Each query starts as soon as the queries it depends on have finished, with at most
+    max_concurrency queries (and connections) running at the same time. With copy_query_group,
+    the COPYs run in that query group, so long COPYs can have their own WLM queue. Transient
+    failures are retried as configured in the [CONNECTION] section of dwh.cfg.
+    Unless quiet, the time of every finished query is printed.
+    '''
+    def report(name, elapsed):
+        if manifest_loader is None or not manifest_loader.report(name, elapsed):
+            print(f"  {name} finished in {elapsed:.1f}s")
 
-def run_etl():
+    copy_names = {f'{table}_copy' for table in STAGING_TABLES}
+
+    def query_group(name):
+        # The COPYs of a staging table are named f'{table}_copy', or f'{table}_copy:{file or batch}'.
+        return copy_query_group if name.split(':')[0] in copy_names else None
+
+    connections = backend.connections
+    return run_query_graph(graph, backend.connect, max_concurrency, on_complete=None if quiet else report,
+                           profiler=profiler, query_groups=query_group if copy_query_group else None,
+                           max_retries=connections.max_retries, retry_backoff=connections.backoff)
+
+
+def resize_cluster(aws_manager, node_type, num_nodes):
+    '''
+    Elastically resizes the cluster and waits until it is available again. Returns how long it took in seconds.
     '''
-    - Connects to the Redshift database
-    - Loads staging tables to be used to further processing
-    - Processes the staging tables  and loads them into the final star schema
+    start = perf_counter()
+    if aws_manager.resize_cluster(node_type, num_nodes):
+        print(f"Resizing the cluster to {num_nodes} x {node_type}. Please wait...")
+        aws_manager.wait_for_cluster_size(node_type, num_nodes)
+    elapsed = perf_counter() - start
+    print(f"  cluster at {num_nodes} x {node_type} after {elapsed:.1f}s")
+    return elapsed
+
+
+def print_load_window(phases, input_bytes):
+    '''
+    Prints the wall time and node-hours of each (phase, seconds, nodes) of the load window.
+    Nodes are billed during a resize, so node-hours show what a faster load costs.
+    '''
+    print("Load window:")
+    for phase, elapsed, nodes in phases:
+        print(f"  {phase:<16}{elapsed:>10.1f}s{nodes:>6} nodes{nodes * elapsed / 3600:>8.2f} node-hours")
+    total = sum(elapsed for _, elapsed, _ in phases)
+    node_hours = sum(nodes * elapsed for _, elapsed, nodes in phases) / 3600
+    load_elapsed = dict((phase, elapsed) for phase, elapsed, _ in phases)['load']
+    print(f"  {'total':<16}{total:>10.1f}s{'':>12}{node_hours:>8.2f} node-hours")
+    print(f"  load throughput {input_bytes / 2**20 / load_elapsed:.1f} MiB/s, "
+          f"{input_bytes / 2**20 / node_hours:.0f} MiB per node-hour\n")
+
+
+def run_etl(full_refresh=False, backend=None, metrics_file=None, summary=False, load_num_nodes=None, load_node_type=None,
+            maintenance=True, quality=True):
+    '''
+    - Connects to the database
+    - Finds the data files that have not been loaded yet
+    - Loads them into the staging tables to be used for further processing
+    - Merges the staging tables into the final star schema and records the new load state
+
+    With full_refresh, all tables are dropped first and every file is reloaded.
+    Runs on the execution backend selected in dwh.cfg, unless one is given. The load lock is held from the
+    start until the aggregates are refreshed, so streaming.py doesn't load a batch meanwhile.
+
+    When a metrics file is given, or METRICS_FILE is set in dwh.cfg, every statement is profiled
+    and the timings and system table statistics of each stage are written to it as JSON.
+    With summary, a table of the statement timings is also printed.
+
+    When a load-time number of nodes or node type is given, or LOAD_NUM_NODES / LOAD_NODE_TYPE are set
+    in dwh.cfg, the Redshift cluster is elastically resized before the files are loaded and resized
+    back afterwards. The time and node-hours of each phase are printed.
+
+    Unless quality is False, the data quality checks of data_quality.py then run on the loaded tables,
+    as set in the [QUALITY] section, and the run fails if one of them fails and FAIL_RUN is set.
+
+    The aggregates of aggregates.py are then refreshed with the newly loaded song plays.
+
+    Unless maintenance is False, the loaded tables whose statistics are stale, or which have too many
+    unsorted or deleted rows, are then analyzed and vacuumed, as set in the [MAINTENANCE] section.
     '''
     config = configparser.ConfigParser()
     CONFIG_FILE = 'dwh.cfg'
     config.read(CONFIG_FILE)
-    
-
-    DWH_DB                 = config.get("CLUSTER","DB_NAME")
-    DWH_DB_USER            = config.get("CLUSTER","DB_USER")
-    DWH_DB_PASSWORD        = config.get("CLUSTER","DB_PASSWORD")
-    DWH_PORT               = config.get("CLUSTER","DB_PORT")
-
-    aws_manager = AWSManager()
-    HOST = aws_manager.get_cluster_endpoint()
-    
-    conn = psycopg2.connect(f"host={HOST} dbname={DWH_DB} user={DWH_DB_USER} password={DWH_DB_PASSWORD} port={DWH_PORT}")
-    cur = conn.cursor()
-    
-    print("Loading Staging tables. Please wait...")
-    load_staging_tables(cur, conn)
-    print("Finished!\n")
-    
-    print("Loading dimensional tables. Please wait...")
-    insert_tables(cur, conn)
-    print("Finished!\n")
-    
-    conn.close()
+
+    MAX_CONCURRENCY        = config.getint("ETL", "MAX_CONCURRENCY", fallback=4)
+    METRICS_FILE           = metrics_file or config.get("ETL", "METRICS_FILE", fallback="")
+    LOAD_NUM_NODES         = load_num_nodes or config.get("ETL", "LOAD_NUM_NODES", fallback="")
+    LOAD_NODE_TYPE         = load_node_type or config.get("ETL", "LOAD_NODE_TYPE", fallback="")
+    STATS_OFF_PCT          = config.getfloat("MAINTENANCE", "STATS_OFF_PCT", fallback=10)
+    UNSORTED_PCT           = config.getfloat("MAINTENANCE", "UNSORTED_PCT", fallback=10)
+    DELETED_PCT            = config.getfloat("MAINTENANCE", "DELETED_PCT", fallback=10)
+    COPY_QUERY_GROUP       = config.get("CONNECTION", "COPY_QUERY_GROUP", fallback="")
+    LOAD_LOCK_EXPIRY       = config.getfloat("ETL", "LOAD_LOCK_EXPIRY", fallback=DEFAULT_LOCK_EXPIRY)
+
+    if backend is None:
+        backend = get_backend(config)
+    profiler = QueryProfiler() if METRICS_FILE or summary else None
+    resize = bool(LOAD_NUM_NODES or LOAD_NODE_TYPE)
+    # Only the redshift backend has an AWS manager, which resizes its cluster.
+    if resize and getattr(backend, 'aws_manager', None) is None:
+        raise ValueError("Resizing the cluster for the load requires the redshift backend.")
+
+    lock_owner = get_lock_owner('etl.py')
+    acquire_load_lock(backend, lock_owner, LOAD_LOCK_EXPIRY)
+    try:
+        if full_refresh:
+            run_initial_setup(backend, profiler)
+
+        conn = backend.connect()
+        cur = conn.cursor()
+        if profiler is not None:
+            profiler.start_stage('prepare')
+        prepare_tables(cur, conn, backend.name == 'redshift', profiler)
+        if profiler is not None:
+            profiler.end_stage(cur)
+        loaded_keys, watermark = get_load_state(cur)
+        conn.close()
+
+        sources = backend.get_staging_sources()
+        new_objects = {}
+        for table, source, _ in sources:
+            new_objects[table] = [(uri, size) for uri, size in backend.list_files(source)
+                                  if uri not in loaded_keys[table]]
+            print(f"{len(new_objects[table])} new file(s) to load into {table}.")
+    except Exception:
+        release_lock_after_failure(backend, lock_owner)
+        raise
+    if not any(new_objects.values()):
+        release_load_lock(backend, lock_owner)
+        print("Nothing to load.\n")
+        backend.connections.close_all()
+        report_profile(profiler, METRICS_FILE, summary)
+        return
+
+    if resize:
+        aws_manager = backend.aws_manager
+        original_size = aws_manager.get_cluster_size()
+        load_size = (LOAD_NODE_TYPE or original_size[0], int(LOAD_NUM_NODES or original_size[1]))
+        resize_nodes = max(original_size[1], load_size[1])
+        phases = []
+
+    start = load_end = None
+    load_failed = True
+    try:
+        # The resize runs inside the try, so that a resize which fails or times out midway is still resized back.
+        if resize:
+            phases.append(('resize for load', resize_cluster(aws_manager, *load_size), resize_nodes))
+        start = perf_counter()
+        # The manifest batches are sized to the slices of the cluster, so they are planned after any resize.
+        conn = backend.connect()
+        manifest_loader = backend.get_manifest_loader(conn.cursor())
+        conn.close()
+
+        graph = build_load_graph(full_refresh, sources, new_objects, watermark, manifest_loader)
+
+        print("Loading staging and dimensional tables. Please wait...")
+        if profiler is not None:
+            profiler.start_stage('load')
+        load_tables(graph, backend, MAX_CONCURRENCY, manifest_loader, profiler, COPY_QUERY_GROUP or None)
+        if profiler is not None:
+            conn = backend.connect()
+            profiler.end_stage(conn.cursor())
+            conn.close()
+        print("Finished!\n")
+
+        conn = backend.connect()
+        cur = conn.cursor()
+        report_song_matches(cur)
+        if quality:
+            print("Checking the quality of the loaded data. Please wait...")
+            if profiler is not None:
+                profiler.start_stage('quality')
+            validate_load(cur, config)
+            if profiler is not None:
+                profiler.end_stage(cur)
+        print("Refreshing the aggregates with the new song plays. Please wait...")
+        if profiler is not None:
+            profiler.start_stage('aggregates')
+        refresh_aggregates(cur, conn, profiler)
+        if profiler is not None:
+            profiler.end_stage(cur)
+        print("Finished!\n")
+        conn.close()
+        release_load_lock(backend, lock_owner)
+        load_end = perf_counter()
+
+        # Maintenance runs before any resize back, while the cluster is at its load-time size.
+        if maintenance:
+            print("Analyzing and vacuuming the loaded tables that need it. Please wait...")
+            if profiler is not None:
+                profiler.start_stage('maintenance')
+            run_maintenance(backend, LOADED_TABLES, STATS_OFF_PCT, UNSORTED_PCT, DELETED_PCT, profiler)
+            if profiler is not None:
+                conn = backend.connect()
+                profiler.end_stage(conn.cursor())
+                conn.close()
+            print("Finished!\n")
+        load_failed = False
+    finally:
+        if load_end is None:
+            release_lock_after_failure(backend, lock_owner)
+        if resize:
+            if start is not None:
+                phases.append(('load', (load_end or perf_counter()) - start, load_size[1]))
+            if load_end is not None and maintenance:
+                phases.append(('maintenance', perf_counter() - load_end, load_size[1]))
+            try:
+                phases.append(('resize back', resize_cluster(aws_manager, *original_size), resize_nodes))
+            except Exception as e:
+                print(f"Could not resize the cluster back to {original_size[1]} x {original_size[0]}: {e}")
+                # A failed load is the error to report. The resize back fails the run on its own otherwise.
+                if not load_failed:
+                    raise
+
+    if resize:
+        print_load_window(phases, sum(size for objects in new_objects.values() for _, size in objects))
+    # The stages reused the pooled connections, which are no longer needed.
+    backend.connections.close_all()
+    report_profile(profiler, METRICS_FILE, summary)
+
+
+def report_profile(profiler, metrics_file, summary):
+    '''
+    Writes the profiled stages to the metrics file and prints their summary, as requested.
+    '''
+    if profiler is None:
+        return
+    if summary:
+        profiler.print_summary()
+    if metrics_file:
+        profiler.write(metrics_file)
+        print(f"Metrics written to {metrics_file}\n")
 
 
 if __name__ == "__main__":
-    run_etl()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Loads the Sparkify event and song data into Redshift.")
+    parser.add_argument('--full-refresh', action='store_true',
+                        help="drop and recreate every table, then reload all files instead of only the new ones")
+    parser.add_argument('--backend', choices=['redshift', 'duckdb', 'postgres'], help="execution backend, defaults to BACKEND in dwh.cfg")
+    parser.add_argument('--metrics', help="profile every statement and write the metrics to this JSON file, "
+                                          "defaults to METRICS_FILE in dwh.cfg")
+    parser.add_argument('--summary', action='store_true', help="profile every statement and print a summary table")
+    parser.add_argument('--skip-maintenance', action='store_true', help="do not analyze or vacuum the loaded tables")
+    parser.add_argument('--skip-quality', action='store_true', help="do not run the data quality checks")
+    parser.add_argument('--load-nodes', type=int, help="resize the cluster to this number of nodes for the load, "
+                                                       "defaults to LOAD_NUM_NODES in dwh.cfg")
+    parser.add_argument('--load-node-type', help="resize the cluster to this node type for the load, "
+                                                 "defaults to LOAD_NODE_TYPE in dwh.cfg")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    run_etl(full_refresh=args.full_refresh, backend=get_backend(config, args.backend),
+            metrics_file=args.metrics, summary=args.summary,
+            load_num_nodes=args.load_nodes, load_node_type=args.load_node_type,
+            maintenance=not args.skip_maintenance, quality=not args.skip_quality)
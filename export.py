@@ -0,0 +1,346 @@
+import argparse
+import configparser
+import json
+import os
+import tempfile
+import uuid
+from datetime import datetime
+from time import perf_counter
+
+import storage
+from backends import get_backend
+from migrations import parse_table_ddl
+from scheduler import run_query_graph
+from sql_queries import (create_table_queries, export_tables, EXPORT_PARTITIONS, export_watermark_select,
+                         changed_months_select, export_select, table_unload)
+
+CONFIG_FILE = 'dwh.cfg'
+MANIFEST_FILE = 'manifest.json'
+RUNS_DIR = 'runs'   # every export writes its files under RUNS_DIR/<run id>/ of the destination
+# The table being exported by partitions, whose rows are stamped with the time they were loaded.
+INCREMENTAL_TABLE = 'factSongplay'
+PARQUET_TYPES = {'varchar': 'string', 'char': 'string', 'int': 'int32', 'integer': 'int32', 'smallint': 'int16',
+                 'bigint': 'int64', 'float': 'float64', 'timestamp': 'timestamp[us]', 'date': 'date32'}
+
+
+def get_export_columns(table):
+    '''
+    Returns the (name, type) of every column of a table, from its CREATE TABLE statement in sql_queries.py.
+    '''
+    for query in create_table_queries:
+        parsed = parse_table_ddl(query)
+        if parsed['table'] == table:
+            return [(name, column_type.split('(')[0].lower()) for name, column_type, _ in parsed['columns']]
+    raise ValueError(f"Unknown table '{table}'.")
+
+
+def partition_path(table, values):
+    '''
+    Returns the Hive-style directory of a partition, like year=2018/month=11, the way UNLOAD names it.
+    '''
+    return '/'.join(f"{name}={int(value)}" for (name, _), value in zip(EXPORT_PARTITIONS[table], values))
+
+
+def read_export_manifest(uri, aws_manager=None):
+    '''
+    Returns the manifest of the previous export, or None if there was none.
+    '''
+    if not storage.exists(uri, aws_manager):
+        return None
+    return json.loads(storage.read_file(uri, aws_manager))
+
+
+def get_changed_months(cur, previous):
+    '''
+    Returns the months of factSongplay to export again since the previous export, or None if every
+    partition must be exported, because there was no previous export or it did not record a watermark.
+    '''
+    if previous is None or previous.get('exported_through') is None:
+        return None
+    cur.execute(changed_months_select, (previous['exported_through'],))
+    return sorted(row[0] for row in cur.fetchall())
+
+
+def entries_outside_months(table, months, entries):
+    '''
+    Returns the manifest entries of the exported files of a table that are not in the given months.
+    '''
+    paths = [partition_path(table, (month.year, month.month)) for month in months]
+    return [entry for entry in entries if not any(f"/{path}/" in entry['url'] for path in paths)]
+
+
+def delete_replaced_files(destination, previous, manifest, aws_manager=None):
+    '''
+    Deletes the files of the previous export that the new manifest no longer lists, and the run directories
+    left by failed exports. Runs once the new manifest is written, so a reader never finds a listed file missing.
+    '''
+    listed = {entry['url'] for table in manifest['tables'].values() for entry in table['entries']}
+    if previous is not None:
+        for table in previous['tables'].values():
+            for entry in table['entries']:
+                if entry['url'] not in listed:
+                    storage.delete(entry['url'], aws_manager)
+
+    runs_prefix = storage.join(destination, RUNS_DIR, '')
+    listed_runs = {url[len(runs_prefix):].split('/')[0] for url in listed if url.startswith(runs_prefix)}
+    runs = {uri[len(runs_prefix):].split('/')[0] for uri, _ in storage.list_files(runs_prefix, aws_manager)}
+    for run_id in sorted(runs - listed_runs):
+        storage.delete(storage.join(runs_prefix, run_id) + '/', aws_manager)
+
+
+class PartitionWriter:
+    '''
+    Streams rows into Parquet files, one directory per partition, starting a new file once max_file_mb
+    MiB were written. Rows must arrive grouped by partition. Each file is written to a local temporary
+    directory, then copied to the destination and removed.
+
+    Requires pyarrow.
+    '''
+    def __init__(self, destination, columns, tmp_dir, max_file_mb, aws_manager=None):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self._pq = pq
+        self._schema = pa.schema([(name, PARQUET_TYPES[column_type]) for name, column_type in columns])
+        self._destination = destination
+        self._tmp_dir = tmp_dir
+        self._max_bytes = max_file_mb * 2**20
+        self._aws_manager = aws_manager
+        self._partition = None
+        self._sink = self._writer = None
+        self.entries = []
+
+    def write(self, partition, rows):
+        '''
+        Writes a batch of rows of the given partition directory ('' for an unpartitioned table) as one row group.
+        '''
+        if partition != self._partition:
+            self._finish_file()
+            self._partition = partition
+            self._file_number = 0
+        if self._writer is None:
+            self._path = os.path.join(self._tmp_dir, f"{self._file_number:04d}_part_00.parquet")
+            self._sink = self._pa.OSFile(self._path, 'wb')
+            self._writer = self._pq.ParquetWriter(self._sink, self._schema, compression='snappy')
+            self._records = 0
+        arrays = [self._pa.array(values, type=field.type) for values, field in zip(zip(*rows), self._schema)]
+        self._writer.write_table(self._pa.Table.from_arrays(arrays, schema=self._schema))
+        self._records += len(rows)
+        if self._sink.tell() >= self._max_bytes:
+            self._finish_file()
+
+    def _finish_file(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._sink.close()
+        directory = storage.join(self._destination, self._partition) if self._partition else self._destination
+        uri = storage.join(directory, os.path.basename(self._path))
+        storage.upload_file(self._path, uri, self._aws_manager)
+        self.entries.append({'url': uri, 'meta': {'content_length': os.path.getsize(self._path),
+                                                  'record_count': self._records}})
+        os.remove(self._path)
+        self._writer = None
+        self._file_number += 1
+
+    def close(self):
+        self._finish_file()
+
+
+def stream_table(conn, table, destination, max_file_mb, fetch_rows, months=None, aws_manager=None):
+    '''
+    Exports a table to Parquet files by reading it through a server-side cursor, fetch_rows rows at a time,
+    so memory use does not depend on the size of the table. Stands in for UNLOAD on the local backends.
+    Returns the manifest entries of the written files.
+    '''
+    columns = get_export_columns(table)
+    names = [name for name, _ in columns]
+    partitions = EXPORT_PARTITIONS.get(table, [])
+    # The partition values follow the exported columns, unless the partition is a column of the table.
+    positions, derived = [], len(names)
+    for name, expression in partitions:
+        if expression == name:
+            positions.append(names.index(name))
+        else:
+            positions.append(derived)
+            derived += 1
+    query = export_select(table, names, months)
+    if partitions:
+        query += f" ORDER BY {', '.join(str(position + 1) for position in positions)}"
+
+    cur = conn.cursor(name=f"export_{table.lower()}")
+    cur.execute(query)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        writer = PartitionWriter(storage.join(destination, table), columns, tmp_dir, max_file_mb, aws_manager)
+        rows = cur.fetchmany(fetch_rows)
+        while rows:
+            # A batch is split where the partition changes, so a row group never spans two partitions.
+            start = 0
+            while start < len(rows):
+                key = tuple(rows[start][position] for position in positions)
+                end = start + 1
+                while end < len(rows) and tuple(rows[end][position] for position in positions) == key:
+                    end += 1
+                writer.write(partition_path(table, key) if partitions else '',
+                             [row[:len(names)] for row in rows[start:end]])
+                start = end
+            rows = cur.fetchmany(fetch_rows)
+        writer.close()
+    cur.close()
+    conn.commit()
+    return writer.entries
+
+
+def unload_tables(backend, tables, destination, max_file_mb, max_concurrency, months=None, aws_manager=None):
+    '''
+    Exports the tables with concurrent UNLOADs, which also write the files of each table in parallel
+    from every slice, under destination/table/. Returns the manifest entries of each table, read from
+    the manifest written by UNLOAD.
+    '''
+    graph = {}
+    for table in tables:
+        table_months = months if table == INCREMENTAL_TABLE else None
+        prefix = storage.join(destination, table) + '/'
+        graph[f"{table}_unload"] = (table_unload(table, [name for name, _ in get_export_columns(table)], prefix,
+                                                 max_file_mb, table_months), [])
+    run_query_graph(graph, backend.connect, max_concurrency, max_retries=backend.connections.max_retries,
+                    retry_backoff=backend.connections.backoff)
+
+    entries = {}
+    for table in tables:
+        # UNLOAD writes its manifest next to the files, where it would be read as data, so it is removed.
+        manifest_uri = storage.join(destination, table, 'manifest')
+        manifest = json.loads(storage.read_file(manifest_uri, aws_manager))
+        entries[table] = [{'url': entry['url'], 'meta': {'content_length': entry['meta']['content_length'],
+                                                          'record_count': entry['meta'].get('record_count')}}
+                          for entry in manifest['entries']]
+        storage.delete(manifest_uri, aws_manager)
+    return entries
+
+
+def export_tables_to(backend, destination, changed_only=False, max_file_mb=256, fetch_rows=10000, max_concurrency=4,
+                     aws_manager=None):
+    '''
+    Exports the star schema to Parquet files under the destination, and writes the manifest of every exported
+    file to MANIFEST_FILE in the destination.
+
+    With changed_only, only the months of factSongplay holding song plays loaded since the previous export
+    are exported again. The dimensions have no load time, so they are always exported in full.
+    Returns the files, records and bytes exported for each table.
+
+    The files are written under a directory of their own, RUNS_DIR/<run id>/, and the files they replace are
+    only deleted once the new manifest is written. Until then the previous manifest and its files stay valid,
+    so a failed export leaves the previous one in place.
+    '''
+    manifest_uri = storage.join(destination, MANIFEST_FILE)
+    previous = read_export_manifest(manifest_uri, aws_manager)
+    conn = backend.connect()
+    cur = conn.cursor()
+    cur.execute(export_watermark_select)
+    exported_through = cur.fetchone()[0]
+    months = get_changed_months(cur, previous) if changed_only else None
+    conn.commit()
+    if changed_only and months is None:
+        print("No previous export to update, exporting every partition.")
+
+    entries = {}
+    if months is not None:
+        print(f"{len(months)} changed month(s) of {INCREMENTAL_TABLE} to export.")
+        entries[INCREMENTAL_TABLE] = entries_outside_months(
+            INCREMENTAL_TABLE, months, previous['tables'].get(INCREMENTAL_TABLE, {}).get('entries', []))
+
+    # Without changed months, factSongplay has nothing to export.
+    tables = [table for table in export_tables if not (table == INCREMENTAL_TABLE and months == [])]
+    exported_at = datetime.utcnow()
+    # The random suffix keeps exports started in the same second out of each other's run directory.
+    run_id = f"{exported_at:%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+    run_destination = storage.join(destination, RUNS_DIR, run_id)
+    start = perf_counter()
+    if backend.name == 'redshift':
+        conn.close()
+        new_entries = unload_tables(backend, tables, run_destination, max_file_mb, max_concurrency, months,
+                                    aws_manager)
+    else:
+        new_entries = {}
+        for table in tables:
+            table_months = months if table == INCREMENTAL_TABLE else None
+            new_entries[table] = stream_table(conn, table, run_destination, max_file_mb, fetch_rows, table_months,
+                                              aws_manager)
+        conn.close()
+    elapsed = perf_counter() - start
+
+    manifest = {'exported_at': exported_at.isoformat(),
+                'exported_through': exported_through.isoformat() if exported_through else None,
+                'tables': {}}
+    stats = []
+    for table in export_tables:
+        written = new_entries.get(table, [])
+        table_entries = entries.get(table, []) + written
+        manifest['tables'][table] = {'partition_by': [name for name, _ in EXPORT_PARTITIONS.get(table, [])],
+                                     'entries': table_entries}
+        stats.append({'table': table, 'files': len(written),
+                      'records': sum(entry['meta']['record_count'] or 0 for entry in written),
+                      'bytes': sum(entry['meta']['content_length'] for entry in written),
+                      'total_files': len(table_entries), 'elapsed': elapsed})
+    storage.write_file(manifest_uri, json.dumps(manifest, indent=2).encode(), aws_manager)
+    delete_replaced_files(destination, previous, manifest, aws_manager)
+    return stats
+
+
+def print_stats(stats):
+    elapsed = stats[0]['elapsed'] if stats else 0
+    print(f"Exported {sum(table_stats['records'] for table_stats in stats)} records in {elapsed:.1f}s.")
+    for table_stats in stats:
+        print(f"{table_stats['table']}: {table_stats['files']} file(s) written, {table_stats['records']} records, "
+              f"{table_stats['bytes'] / 2**20:.1f} MiB ({table_stats['total_files']} file(s) in the export)")
+
+
+def run_export(backend_name=None, destination=None, changed_only=False, max_file_mb=None):
+    '''
+    Exports the loaded tables to EXPORT_DATA, in the [S3] section of dwh.cfg for the redshift backend
+    and in the [LOCAL] section otherwise.
+    '''
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+
+    backend = get_backend(config, backend_name)
+    section = 'S3' if backend.name == 'redshift' else 'LOCAL'
+    EXPORT_DATA            = destination or config.get(section, "EXPORT_DATA", fallback="")
+    EXPORT_MAX_FILE_MB     = max_file_mb or config.getint("ETL", "EXPORT_MAX_FILE_MB", fallback=256)
+    EXPORT_FETCH_ROWS      = config.getint("ETL", "EXPORT_FETCH_ROWS", fallback=10000)
+    MAX_CONCURRENCY        = config.getint("ETL", "MAX_CONCURRENCY", fallback=4)
+
+    if not EXPORT_DATA:
+        print("EXPORT_DATA is not set, skipping the export.\n")
+        backend.close()
+        return []
+    if backend.name == 'redshift' and not storage.is_s3(EXPORT_DATA):
+        raise ValueError("UNLOAD can only export to S3, EXPORT_DATA must be an s3:// prefix.")
+
+    aws_manager = getattr(backend, 'aws_manager', None)
+    if storage.is_s3(EXPORT_DATA) and aws_manager is None:
+        from aws_manager import AWSManager
+        aws_manager = AWSManager(CONFIG_FILE)
+
+    print(f"Exporting the tables to {EXPORT_DATA}. Please wait...")
+    try:
+        stats = export_tables_to(backend, EXPORT_DATA, changed_only, EXPORT_MAX_FILE_MB, EXPORT_FETCH_ROWS,
+                                 MAX_CONCURRENCY, aws_manager)
+    finally:
+        backend.close()
+    print_stats(stats)
+    print("Finished!\n")
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports the Sparkify star schema to partitioned Parquet files.")
+    parser.add_argument('--backend', choices=['redshift', 'duckdb', 'postgres'],
+                        help="execution backend, defaults to BACKEND in the [ETL] section of dwh.cfg")
+    parser.add_argument('--destination', help="directory or s3:// prefix to export to, defaults to EXPORT_DATA")
+    parser.add_argument('--changed-only', action='store_true',
+                        help="only export the months of factSongplay with song plays loaded since the last export")
+    parser.add_argument('--max-file-mb', type=int, help="size cap of each file, defaults to EXPORT_MAX_FILE_MB")
+    args = parser.parse_args()
+    run_export(args.backend, args.destination, args.changed_only, args.max_file_mb)
@@ -0,0 +1,319 @@
+import argparse
+import configparser
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+from time import perf_counter
+
+import numpy as np
+
+import storage
+from aws_manager import AWSManager
+
+CONFIG_FILE = 'dwh.cfg'
+
+# Approximate size of the udacity-dend sample data, multiplied by the scale factor.
+SAMPLE_SIZE = {'users': 100, 'songs': 15000, 'artists': 10000, 'sessions': 800}
+START_DATE = datetime(2018, 11, 1)
+DAYS = 30
+EVENTS_PER_SESSION = 10
+SONG_EVENT_RATE = 0.8
+GUEST_SESSION_RATE = 0.05
+MS_PER_DAY = 24 * 3600 * 1000
+
+ID_CHARACTERS = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'))
+WORDS = ['Love', 'Night', 'Heart', 'Fire', 'Dream', 'Blue', 'Rain', 'Summer', 'Road', 'Time', 'Light', 'Dance',
+         'Home', 'Gold', 'River', 'Moon', 'Wild', 'Stone', 'Song', 'Shadow', 'City', 'Girl', 'Boy', 'Sky',
+         'Ocean', 'Ghost', 'Train', 'Sweet', 'Little', 'Lonely', 'Electric', 'Midnight', 'Silver', 'Paradise',
+         'Angel', 'Baby', 'Black', 'Broken', 'Crazy', 'Dark', 'Day', 'Desert', 'Diamond', 'Echo', 'Falling', 'Forever',
+         'Free', 'Garden', 'Glass', 'Golden', 'Green', 'Highway', 'Honey', 'Island', 'King', 'Last', 'Lost', 'Magic',
+         'Memory', 'Mountain', 'Neon', 'Orange', 'Queen', 'Radio', 'Red', 'Rock', 'Rose', 'Run', 'Secret', 'Snow',
+         'Soul', 'Star', 'Storm', 'Street', 'Sun', 'Thunder', 'Tonight', 'Velvet', 'Water', 'White', 'Wind', 'Young']
+FIRST_NAMES = ['Lily', 'Jacob', 'Kate', 'Ryan', 'Chloe', 'Aiden', 'Tegan', 'Jayden', 'Matthew', 'Layla',
+               'Mohammad', 'Sara', 'Kaylee', 'Ava', 'Lucas', 'Emily', 'Noah', 'Avery', 'Wyatt', 'Harper']
+LAST_NAMES = ['Koch', 'Klein', 'Harrell', 'Smith', 'Cruz', 'Levine', 'Rodriguez', 'Summers', 'Garrison', 'Moore',
+              'Williams', 'Ruiz', 'Hall', 'Lee', 'Chen', 'Diaz', 'Owens', 'Nguyen', 'Porter', 'Scott']
+LOCATIONS = ['Chicago-Naperville-Elgin, IL-IN-WI', 'San Francisco-Oakland-Hayward, CA',
+             'New York-Newark-Jersey City, NY-NJ-PA', 'Lansing-East Lansing, MI', 'Atlanta-Sandy Springs-Roswell, GA',
+             'Portland-South Portland, ME', 'Tampa-St. Petersburg-Clearwater, FL', 'Houston-The Woodlands-Sugar Land, TX']
+USER_AGENTS = ['"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+               '"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.125 Safari/537.36"',
+               'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0',
+               '"Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) AppleWebKit/537.51.2 (KHTML, like Gecko) Version/7.0 Mobile/11D257 Safari/9537.53"']
+USER_PAGES = ['Home', 'Settings', 'About', 'Help', 'Logout', 'Upgrade', 'Downgrade', 'Add to Playlist', 'Thumbs Up']
+GUEST_PAGES = ['Home', 'Login', 'About', 'Help']
+
+# Events are formatted and written this many at a time, so memory does not grow with the size of a day.
+EVENT_CHUNK = 20000
+
+_catalog = None
+_aws_manager = None
+
+
+def zipf_weights(n, exponent, rng):
+    '''
+    Returns n shuffled probabilities following Zipf's law: the k-th most popular item is drawn about k**exponent times less often than the first.
+    '''
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+    rng.shuffle(weights)
+    return weights / weights.sum()
+
+
+def random_ids(prefix, n, rng):
+    codes = ID_CHARACTERS[rng.integers(0, len(ID_CHARACTERS), size=(n, 16))]
+    return [prefix + ''.join(code) for code in codes]
+
+
+def random_names(words, n, rng, min_words, max_words):
+    lengths = rng.integers(min_words, max_words + 1, size=n)
+    picks = rng.choice(words, size=(n, max_words))
+    return [' '.join(row[:length]) for row, length in zip(picks, lengths)]
+
+
+def json_array(values):
+    '''
+    Returns the JSON encoding of every value, as a numpy object array so it can be indexed by an array of ids.
+    '''
+    return np.array([json.dumps(str(value)) for value in values], dtype=object)
+
+
+def generate_catalog(users, songs, artists, song_skew, user_skew, seed):
+    '''
+    Generates the users, songs and artists, with JSON-encoded text fields so events can be written without re-encoding.
+    '''
+    rng = np.random.default_rng(seed)
+
+    artist_ids = random_ids('AR', artists, rng)
+    artist_names = random_names(WORDS + LAST_NAMES, artists, rng, 1, 3)
+    has_location = rng.random(artists) < 0.5
+    artist_locations = np.where(has_location, rng.choice(LOCATIONS, artists), '')
+    latitudes = np.where(has_location, rng.uniform(-60, 70, artists).round(5), np.nan)
+    longitudes = np.where(has_location, rng.uniform(-150, 150, artists).round(5), np.nan)
+
+    # A few artists release most of the songs.
+    song_artists = rng.choice(artists, size=songs, p=zipf_weights(artists, 0.8, rng))
+    song_ids = random_ids('SO', songs, rng)
+    titles = random_names(WORDS, songs, rng, 2, 4)
+    durations = rng.lognormal(np.log(230), 0.35, songs).round(5)
+    years = np.where(rng.random(songs) < 0.5, 0, rng.integers(1950, 2019, songs))
+
+    genders = rng.choice(['M', 'F'], users)
+    return {
+        'artists': {'id': artist_ids, 'name': artist_names, 'location': artist_locations,
+                    'latitude': latitudes, 'longitude': longitudes},
+        'songs': {'id': song_ids, 'artist': song_artists, 'title': titles, 'duration': durations, 'year': years,
+                  'title_json': json_array(titles),
+                  'artist_json': json_array(artist_names[artist] for artist in song_artists),
+                  'duration_json': durations.astype(str).astype(object),
+                  'weights': zipf_weights(songs, song_skew, rng)},
+        'users': {'first_name': json_array(rng.choice(FIRST_NAMES, users)),
+                  'last_name': json_array(rng.choice(LAST_NAMES, users)),
+                  'gender': json_array(genders),
+                  'level': json_array(rng.choice(['free', 'paid'], users, p=[0.7, 0.3])),
+                  'location': json_array(rng.choice(LOCATIONS, users)),
+                  'user_agent': json_array(rng.choice(USER_AGENTS, users)),
+                  'registration': np.array([f'{value:.1f}' for value in rng.integers(
+                      int(1.5e12), int(START_DATE.timestamp() * 1000), users).astype(float)], dtype=object),
+                  # Heavy users: a few users account for most of the activity.
+                  'weights': zipf_weights(users, user_skew, rng)},
+    }
+
+
+def _init_worker(catalog, config_file):
+    global _catalog, _aws_manager
+    _catalog = catalog
+    _aws_manager = AWSManager(config_file)
+
+
+def write_parts(chunks, directory, name, extension, max_file_bytes):
+    '''
+    Writes chunks of lines to one or more files, starting a new file once one reaches max_file_bytes, so that at most
+    one file is held in memory. Returns the number of files and of bytes written.
+    '''
+    files = written = 0
+    part, part_bytes = [], 0
+    for lines in chunks:
+        ends = np.cumsum(np.fromiter(map(len, lines), np.int64, len(lines)) + 1)
+        first = 0
+        while first < len(lines):
+            offset = ends[first - 1] if first else 0
+            # The lines up to the one reaching max_file_bytes go to the current file.
+            stop = min(int(np.searchsorted(ends, offset + max_file_bytes - part_bytes)) + 1, len(lines))
+            part.append(('\n'.join(lines[first:stop]) + '\n').encode())
+            part_bytes += int(ends[stop - 1] - offset)
+            first = stop
+            if part_bytes >= max_file_bytes:
+                suffix = f'-{files}' if files else ''
+                storage.write_file(storage.join(directory, f'{name}{suffix}{extension}'), b''.join(part), _aws_manager)
+                files, written = files + 1, written + part_bytes
+                part, part_bytes = [], 0
+    if part:
+        suffix = f'-{files}' if files else ''
+        storage.write_file(storage.join(directory, f'{name}{suffix}{extension}'), b''.join(part), _aws_manager)
+        files, written = files + 1, written + part_bytes
+    return files, written
+
+
+def format_events(fields):
+    '''
+    Formats events as JSON lines. fields maps each key, in order, to the JSON-encoded values of the events, and the
+    lines are built with numpy a field at a time rather than an event at a time.
+    '''
+    lines = '{'
+    for i, (key, values) in enumerate(fields.items()):
+        lines = lines + (',' if i else '') + f'"{key}":' + np.asarray(values, dtype=object)
+    return lines + '}'
+
+
+def event_lines(events, rows):
+    '''
+    Returns the JSON lines of the events at the given rows.
+    '''
+    songs, users = _catalog['songs'], _catalog['users']
+    song, user = events['song'][rows], events['user'][rows]
+    guest, is_song = events['guest'][rows], events['is_song'][rows]
+    return format_events({
+        'artist': np.where(is_song, songs['artist_json'][song], 'null'),
+        'auth': np.where(guest, '"Logged Out"', '"Logged In"'),
+        'firstName': np.where(guest, 'null', users['first_name'][user]),
+        'gender': np.where(guest, 'null', users['gender'][user]),
+        'itemInSession': events['item'][rows].astype(str),
+        'lastName': np.where(guest, 'null', users['last_name'][user]),
+        'length': np.where(is_song, songs['duration_json'][song], 'null'),
+        'level': np.where(guest, '"free"', users['level'][user]),
+        'location': np.where(guest, 'null', users['location'][user]),
+        'method': np.where(is_song, '"PUT"', '"GET"'),
+        'page': np.where(is_song, '"NextSong"', events['page'][rows]),
+        'registration': np.where(guest, 'null', users['registration'][user]),
+        'sessionId': events['session_id'][rows].astype(str),
+        'song': np.where(is_song, songs['title_json'][song], 'null'),
+        'status': '200',
+        'ts': events['ts'][rows].astype(str),
+        'userAgent': users['user_agent'][user],
+        'userId': np.where(guest, '""', '"' + (user + 1).astype(str).astype(object) + '"'),
+    })
+
+
+def generate_events(day, sessions, seed, log_data, max_file_bytes):
+    '''
+    Generates the event log of one day, sorted by timestamp, and writes it under log_data/year/month.
+    Returns the number of events, files and bytes written.
+    '''
+    rng = np.random.default_rng(seed)
+    songs, users = _catalog['songs'], _catalog['users']
+    date = START_DATE + timedelta(days=day)
+
+    session_users = rng.choice(len(users['weights']), size=sessions, p=users['weights'])
+    guest_sessions = rng.random(sessions) < GUEST_SESSION_RATE
+    session_lengths = np.where(guest_sessions, rng.integers(1, 3, sessions), rng.geometric(1 / EVENTS_PER_SESSION, sessions))
+    session_starts = int(date.timestamp() * 1000) + rng.integers(0, MS_PER_DAY, sessions)
+    session_ids = day * sessions + np.arange(sessions)
+
+    total = int(session_lengths.sum())
+    event_sessions = np.repeat(np.arange(sessions), session_lengths)
+    first_events = np.repeat(np.cumsum(session_lengths) - session_lengths, session_lengths)
+    items = np.arange(total) - first_events
+    guests = guest_sessions[event_sessions]
+    is_song = (rng.random(total) < SONG_EVENT_RATE) & ~guests
+    event_songs = rng.choice(len(songs['weights']), size=total, p=songs['weights'])
+
+    # Each event starts when the previous event of its session ends.
+    gaps = np.where(is_song, songs['duration'][event_songs] * 1000, rng.integers(5000, 60000, total)).astype(np.int64)
+    offsets = np.cumsum(gaps) - gaps
+    ts = session_starts[event_sessions] + offsets - offsets[first_events]
+    pages = np.where(guests, rng.choice(json_array(GUEST_PAGES), total), rng.choice(json_array(USER_PAGES), total))
+    events = {'song': event_songs, 'user': session_users[event_sessions], 'guest': guests, 'is_song': is_song,
+              'item': items, 'page': pages, 'session_id': session_ids[event_sessions], 'ts': ts}
+
+    order = np.argsort(ts, kind='stable')
+    chunks = (event_lines(events, order[first:first + EVENT_CHUNK]) for first in range(0, total, EVENT_CHUNK))
+    directory = storage.join(log_data, f'{date:%Y}', f'{date:%m}')
+    files, written = write_parts(chunks, directory, f'{date:%Y-%m-%d}-events', '.json', max_file_bytes)
+    return total, files, written
+
+
+def generate_songs(start, stop, songs_per_file, song_data):
+    '''
+    Writes the metadata of songs start to stop under song_data, songs_per_file songs per file.
+    Returns the number of songs, files and bytes written.
+    '''
+    songs, artists = _catalog['songs'], _catalog['artists']
+    files = written = 0
+    for first in range(start, stop, songs_per_file):
+        lines = []
+        for song in range(first, min(first + songs_per_file, stop)):
+            artist = songs['artist'][song]
+            has_location = not np.isnan(artists['latitude'][artist])
+            lines.append(json.dumps({
+                'num_songs': 1, 'artist_id': artists['id'][artist],
+                'artist_latitude': float(artists['latitude'][artist]) if has_location else None,
+                'artist_longitude': float(artists['longitude'][artist]) if has_location else None,
+                'artist_location': str(artists['location'][artist]), 'artist_name': artists['name'][artist],
+                'song_id': songs['id'][song], 'title': songs['title'][song],
+                'duration': float(songs['duration'][song]), 'year': int(songs['year'][song])}))
+        song_id = songs['id'][first]
+        data = ('\n'.join(lines) + '\n').encode()
+        storage.write_file(storage.join(song_data, song_id[2], song_id[3], song_id[4], f'TR{song_id[2:]}.json'), data, _aws_manager)
+        files, written = files + 1, written + len(data)
+    return stop - start, files, written
+
+
+def run_generator(scale=1, days=DAYS, users=None, songs=None, artists=None, sessions=None, song_skew=1.0,
+                  user_skew=1.2, songs_per_file=1, max_file_mb=128, workers=None, seed=0, target='local'):
+    '''
+    Generates synthetic Sparkify data at the given multiple of the sample size, and writes it to the
+    LOG_DATA and SONG_DATA locations of the [LOCAL] section of dwh.cfg, or of the [S3] section when target is s3.
+    '''
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+
+    section = 'S3' if target == 's3' else 'LOCAL'
+    LOG_DATA               = config.get(section, "LOG_DATA")
+    SONG_DATA              = config.get(section, "SONG_DATA")
+    WORKERS                = workers or os.cpu_count()
+
+    users = users or SAMPLE_SIZE['users'] * scale
+    songs = songs or SAMPLE_SIZE['songs'] * scale
+    artists = artists or SAMPLE_SIZE['artists'] * scale
+    sessions_per_day = max(1, (sessions or SAMPLE_SIZE['sessions'] * scale) // days)
+
+    start = perf_counter()
+    print(f"Generating {users} users, {songs} songs and {artists} artists...")
+    catalog = generate_catalog(users, songs, artists, song_skew, user_skew, seed)
+
+    with ProcessPoolExecutor(WORKERS, initializer=_init_worker, initargs=(catalog, CONFIG_FILE)) as executor:
+        songs_per_job = -(-songs // (WORKERS * 4))
+        chunk = -(-songs_per_job // songs_per_file) * songs_per_file
+        song_jobs = [executor.submit(generate_songs, first, min(first + chunk, songs), songs_per_file, SONG_DATA)
+                     for first in range(0, songs, chunk)]
+        event_jobs = [executor.submit(generate_events, day, sessions_per_day, seed + 1 + day, LOG_DATA, max_file_mb * 2**20)
+                      for day in range(days)]
+        song_totals = np.sum([job.result() for job in song_jobs], axis=0)
+        event_totals = np.sum([job.result() for job in event_jobs], axis=0)
+
+    elapsed = perf_counter() - start
+    print(f"{song_totals[0]} songs in {song_totals[1]} files ({song_totals[2] / 2**20:.1f} MiB) written to {SONG_DATA}")
+    print(f"{event_totals[0]} events in {event_totals[1]} files ({event_totals[2] / 2**20:.1f} MiB) written to {LOG_DATA}")
+    print(f"Finished in {elapsed:.1f}s ({(song_totals[2] + event_totals[2]) / 2**20 / elapsed:.1f} MiB/s)\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates synthetic Sparkify event logs and song metadata.")
+    parser.add_argument('--scale', type=int, default=1, help="multiple of the sample data size")
+    parser.add_argument('--days', type=int, default=DAYS, help="number of days of event logs, starting on 2018-11-01")
+    parser.add_argument('--users', type=int, help="number of users, overrides the scale")
+    parser.add_argument('--songs', type=int, help="number of songs, overrides the scale")
+    parser.add_argument('--artists', type=int, help="number of artists, overrides the scale")
+    parser.add_argument('--sessions', type=int, help="total number of sessions, overrides the scale")
+    parser.add_argument('--song-skew', type=float, default=1.0, help="Zipf exponent of song popularity")
+    parser.add_argument('--user-skew', type=float, default=1.2, help="Zipf exponent of user activity")
+    parser.add_argument('--songs-per-file', type=int, default=1, help="songs per song_data file, 1 like the sample data")
+    parser.add_argument('--max-file-mb', type=int, default=128, help="maximum size of an event log file")
+    parser.add_argument('--workers', type=int, help="number of processes, defaults to the CPU count")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--target', choices=['local', 's3'], default='local',
+                        help="write to the [LOCAL] or the [S3] data locations of dwh.cfg")
+    args = parser.parse_args()
+    run_generator(args.scale, args.days, args.users, args.songs, args.artists, args.sessions, args.song_skew,
+                  args.user_skew, args.songs_per_file, args.max_file_mb, args.workers, args.seed, args.target)
@@ -0,0 +1,94 @@
+import re
+from time import perf_counter
+
+from backends import STAGING_TABLES
+from profiling import execute
+from sql_queries import create_table_queries
+
+CREATE_TABLE = re.compile(r'CREATE TABLE IF NOT EXISTS (\w+)', re.IGNORECASE)
+
+# Tables written by every load. The staging tables are left out, since the next load truncates them, and so are
+# the control tables, which stay small enough to be scanned whole.
+LOADED_TABLES = [CREATE_TABLE.search(query).group(1) for query in create_table_queries
+                 if CREATE_TABLE.search(query).group(1) not in STAGING_TABLES]
+
+table_health_select = ("""SELECT "table", tbl_rows, estimated_visible_rows, unsorted, stats_off
+                          FROM svv_table_info
+                          WHERE schema = 'public'
+""")
+
+
+def get_table_health(cur, tables):
+    '''
+    Returns the percentage of stale statistics, unsorted rows and deleted rows of each table, from SVV_TABLE_INFO.
+    Empty tables are left out.
+    '''
+    cur.execute(table_health_select)
+    wanted = {table.lower(): table for table in tables}
+    health = {}
+    for table, rows, visible_rows, unsorted, stats_off in cur.fetchall():
+        if table not in wanted or not rows:
+            continue
+        health[wanted[table]] = {'stats_off': float(stats_off or 0),
+                                 'unsorted': float(unsorted or 0),
+                                 'deleted': 100.0 * (rows - (visible_rows or rows)) / rows}
+    return health
+
+
+def plan_maintenance(health, stats_off_pct, unsorted_pct, deleted_pct):
+    '''
+    Returns the maintenance statements of each table whose health crosses a threshold.
+
+    - ANALYZE when the statistics are more than stats_off_pct stale
+    - VACUUM SORT ONLY when more than unsorted_pct of the rows are unsorted
+    - VACUUM DELETE ONLY when more than deleted_pct of the rows are deleted but not reclaimed
+    - VACUUM FULL when both vacuum thresholds are crossed
+
+    Vacuuming comes first, so ANALYZE collects the statistics of the vacuumed table.
+    '''
+    plans = {}
+    for table, table_health in health.items():
+        statements = []
+        needs_sort = table_health['unsorted'] > unsorted_pct
+        needs_delete = table_health['deleted'] > deleted_pct
+        if needs_sort and needs_delete:
+            statements.append(f"VACUUM FULL {table}")
+        elif needs_sort:
+            statements.append(f"VACUUM SORT ONLY {table}")
+        elif needs_delete:
+            statements.append(f"VACUUM DELETE ONLY {table}")
+        if table_health['stats_off'] > stats_off_pct:
+            statements.append(f"ANALYZE {table}")
+        if statements:
+            plans[table] = statements
+    return plans
+
+
+def run_maintenance(backend, tables, stats_off_pct, unsorted_pct, deleted_pct, profiler=None):
+    '''
+    Runs ANALYZE and VACUUM on the tables that need it, skipping the healthy ones.
+    Returns the time spent on each maintained table.
+    '''
+    conn = backend.connect()
+    # VACUUM can't run inside a transaction block.
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        health = get_table_health(cur, tables)
+        plans = plan_maintenance(health, stats_off_pct, unsorted_pct, deleted_pct)
+        timings = {}
+        for table in tables:
+            if table not in plans:
+                print(f"  {table} is healthy, skipped")
+                continue
+            start = perf_counter()
+            for statement in plans[table]:
+                execute(cur, statement, profiler)
+            timings[table] = perf_counter() - start
+            table_health = health[table]
+            print(f"  {table}: {', '.join(statement.rsplit(' ', 1)[0] for statement in plans[table])} "
+                  f"in {timings[table]:.1f}s (stats off {table_health['stats_off']:.0f}%, "
+                  f"unsorted {table_health['unsorted']:.0f}%, deleted {table_health['deleted']:.0f}%)")
+    finally:
+        conn.close()
+    return timings
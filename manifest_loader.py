@@ -0,0 +1,123 @@
+import heapq
+import json
+import math
+from collections import namedtuple
+from datetime import datetime
+
+# Number of slices per node for each Redshift node type.
+SLICES_PER_NODE = {
+    'dc2.large': 2,
+    'dc2.8xlarge': 16,
+    'ds2.xlarge': 2,
+    'ds2.8xlarge': 16,
+    'ra3.xlplus': 2,
+    'ra3.4xlarge': 4,
+    'ra3.16xlarge': 16,
+}
+
+slice_count_select = "SELECT COUNT(*) FROM stv_slices"
+
+ManifestBatch = namedtuple('ManifestBatch', ['name', 'files', 'bytes'])
+
+
+def get_slice_count(node_type, num_nodes, cur=None):
+    '''
+    Returns the number of slices of the cluster.
+
+    The count is derived from the node type and number of nodes when the node type is known,
+    otherwise it is queried from STV_SLICES through the given cursor.
+    '''
+    if node_type in SLICES_PER_NODE:
+        return SLICES_PER_NODE[node_type] * int(num_nodes)
+    if cur is None:
+        raise ValueError(f"Unknown node type '{node_type}' and no cursor to query the slice count with.")
+    cur.execute(slice_count_select)
+    return cur.fetchone()[0]
+
+
+def plan_batches(objects, slice_count, files_per_slice):
+    '''
+    Groups (s3_uri, size) objects into batches of at most slice_count * files_per_slice files.
+
+    The room in each batch is a multiple of the slice count. Files are handed out largest first
+    to the batch with the fewest bytes that still has room, so every batch ends up with a similar
+    number of files and of bytes.
+    '''
+    if not objects:
+        return []
+    num_batches = math.ceil(len(objects) / (slice_count * files_per_slice))
+    batch_size = slice_count * math.ceil(len(objects) / num_batches / slice_count)
+
+    batches = [[] for _ in range(num_batches)]
+    heap = [(0, i) for i in range(num_batches)]
+    for uri, size in sorted(objects, key=lambda obj: obj[1], reverse=True):
+        total, i = heapq.heappop(heap)
+        batches[i].append((uri, size))
+        if len(batches[i]) < batch_size:
+            heapq.heappush(heap, (total + size, i))
+    return [batch for batch in batches if batch]
+
+
+def batch_imbalance(batches):
+    '''
+    Returns the ratio between the largest and the smallest batch in bytes (1.0 is perfectly balanced).
+    '''
+    sizes = [sum(size for _, size in batch) for batch in batches]
+    if not sizes or max(sizes) == 0:
+        return 1.0
+    return max(sizes) / min(sizes) if min(sizes) else math.inf
+
+
+def build_manifest(objects):
+    '''
+    Returns the Redshift COPY manifest listing the given (s3_uri, size) objects.
+    '''
+    return {'entries': [{'url': uri, 'mandatory': True, 'meta': {'content_length': size}}
+                        for uri, size in objects]}
+
+
+class ManifestLoader:
+    '''
+    Splits the files of a staging table into slice-balanced batches and loads each batch with a manifest COPY.
+
+    Manifests are written under manifest_prefix, an S3 location the cluster can read from.
+    '''
+    def __init__(self, aws_manager, manifest_prefix, slice_count, files_per_slice, parallel=True):
+        self._aws_manager = aws_manager
+        self._manifest_prefix = manifest_prefix.rstrip('/')
+        self._slice_count = slice_count
+        self._files_per_slice = files_per_slice
+        self._parallel = parallel
+        self._run_id = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        self.batches = {}
+
+    def build_copies(self, name, objects, copy_from):
+        '''
+        Writes one manifest per batch of objects and returns the graph entries of their COPYs.
+
+        Batches have no dependencies between them, unless the loader is not parallel, in which
+        case each batch waits for the previous one.
+        '''
+        entries = {}
+        previous = []
+        for i, batch in enumerate(plan_batches(objects, self._slice_count, self._files_per_slice)):
+            batch_name = f'{name}:batch{i:04d}'
+            manifest_uri = f'{self._manifest_prefix}/{self._run_id}/{batch_name.replace(":", "-")}.manifest'
+            self._aws_manager.put_s3_object(manifest_uri, json.dumps(build_manifest(batch)))
+
+            self.batches[batch_name] = ManifestBatch(batch_name, len(batch), sum(size for _, size in batch))
+            entries[batch_name] = (copy_from(manifest_uri, manifest=True), previous)
+            if not self._parallel:
+                previous = [batch_name]
+        return entries
+
+    def report(self, name, elapsed):
+        '''
+        Prints the files, bytes and throughput of a finished batch. Returns False for any other query.
+        '''
+        batch = self.batches.get(name)
+        if batch is None:
+            return False
+        throughput = batch.bytes / elapsed / 2**20 if elapsed else 0
+        print(f"  {name} finished in {elapsed:.1f}s ({batch.files} files, {batch.bytes / 2**20:.1f} MiB, {throughput:.1f} MiB/s)")
+        return True
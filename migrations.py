@@ -0,0 +1,471 @@
+import argparse
+import configparser
+import hashlib
+import json
+import re
+from collections import namedtuple
+
+from backends import get_backend
+from profiling import execute
+from sql_queries import (create_table_queries, create_control_table_queries, create_table_backfills,
+                         schema_versions_table_create, schema_version_select, schema_ddl_select, schema_version_insert,
+                         table_designs_select, table_design_delete)
+
+CONFIG_FILE = 'dwh.cfg'
+
+# A change to one table. Transactional changes are applied together in a single transaction,
+# the others (ALTER COLUMN ... ENCODE) can't run in a transaction block and are applied after it commits.
+SchemaChange = namedtuple('SchemaChange', ['table', 'description', 'statements', 'transactional'])
+
+# A table's physical design. diststyle is 'all', 'even' or 'key', sortkey a list of columns
+# and encodings maps a column to its compression encoding.
+TableDesign = namedtuple('TableDesign', ['table', 'diststyle', 'distkey', 'sortkey', 'encodings'])
+
+table_columns_select = ("""SELECT table_name, column_name, data_type, character_maximum_length
+                           FROM information_schema.columns
+                           WHERE table_schema = current_schema()
+                           ORDER BY table_name, ordinal_position
+""")
+
+# Redshift only: the distribution style, distribution key, sort key and encoding of every table.
+table_diststyles_select = ("""SELECT c.relname, c.reldiststyle
+                              FROM pg_class c
+                              JOIN pg_namespace n ON n.oid = c.relnamespace
+                              WHERE n.nspname = current_schema() AND c.relkind = 'r'
+""")
+
+table_keys_select = ("""SELECT tablename, "column", encoding, distkey, sortkey
+                        FROM pg_table_def
+                        WHERE schemaname = current_schema()
+""")
+
+# PG_CLASS.RELDISTSTYLE values. The AUTO styles are 10 (ALL), 11 (EVEN) and 12 (KEY).
+DISTSTYLES = {0: 'even', 1: 'key', 8: 'all', 10: 'auto', 11: 'auto', 12: 'auto'}
+
+# Type names as reported by INFORMATION_SCHEMA on Redshift, Postgres and DuckDB, mapped to the names used in the DDL.
+TYPE_ALIASES = {'int': 'integer', 'int4': 'integer', 'int8': 'bigint', 'float': 'double', 'float8': 'double',
+                'double precision': 'double', 'character varying': 'varchar', 'character': 'char', 'bpchar': 'char',
+                'timestamp without time zone': 'timestamp'}
+
+COLUMN_ATTRIBUTES = re.compile(r'\s+(?:PRIMARY KEY|REFERENCES\s+\w+\s*\(\w+\)|sortkey|distkey)\b', re.IGNORECASE)
+TYPE_LENGTH = re.compile(r'^\s*([^(]+?)\s*(?:\((\d+)\))?\s*$')
+CREATE_TABLE = re.compile(r'CREATE TABLE IF NOT EXISTS (\w+)\s*\(', re.IGNORECASE)
+COLUMN_TYPE = re.compile(r'^(\w+)\s+(\w+(?:\(\d+\))?)((?:\s+IDENTITY\(\d+,\s*\d+\))?)', re.IGNORECASE)
+REFERENCES = re.compile(r'\bREFERENCES\s+(\w+)\s*\((\w+)\)', re.IGNORECASE)
+PHYSICAL_ATTRIBUTES = re.compile(r'\s+(?:sortkey|distkey|encode\s+\w+)\b', re.IGNORECASE)
+IDENTITY = re.compile(r'\bIDENTITY\((\d+),\s*(\d+)\)', re.IGNORECASE)
+
+
+def parse_table_ddl(query):
+    '''
+    Parses a CREATE TABLE statement of sql_queries.py into its table name and column definitions.
+
+    Returns a dict with the table, the (name, type, definition) of each column, the primary key and
+    identity columns, the columns referencing other tables as {column: referenced table} and
+    {column: referenced column}, and the table attributes following the column definitions.
+    '''
+    match = CREATE_TABLE.search(query)
+    body_start = match.end()
+    depth, position = 1, body_start
+    while depth:
+        depth += {'(': 1, ')': -1}.get(query[position], 0)
+        position += 1
+    body = query[body_start:position - 1]
+
+    definitions, depth, current = [], 0, ''
+    for char in body:
+        depth += {'(': 1, ')': -1}.get(char, 0)
+        if char == ',' and depth == 0:
+            definitions.append(current.strip())
+            current = ''
+        else:
+            current += char
+    definitions.append(current.strip())
+
+    table = {'table': match.group(1), 'columns': [], 'primary_key': None, 'identity': None, 'references': {},
+             'referenced_columns': {}, 'attributes': ' '.join(query[position:].rstrip().rstrip(';').split())}
+    for definition in definitions:
+        definition = ' '.join(definition.split())
+        name, column_type, identity = COLUMN_TYPE.match(definition).groups()
+        table['columns'].append((name, column_type, definition))
+        if re.search(r'\bPRIMARY KEY\b', definition, re.IGNORECASE):
+            table['primary_key'] = name
+        if identity:
+            table['identity'] = name
+        reference = REFERENCES.search(definition)
+        if reference:
+            table['references'][name] = reference.group(1)
+            table['referenced_columns'][name] = reference.group(2)
+    return table
+
+
+def render_table_ddl(table, design, name=None, indent=4, attributes_indent=0):
+    '''
+    Returns the CREATE TABLE statement of the parsed table with the given design, optionally under another name.
+    Column definitions after the first are indented by indent spaces, and the table attributes by attributes_indent.
+    '''
+    columns = []
+    for column, _, definition in table['columns']:
+        definition = PHYSICAL_ATTRIBUTES.sub('', definition)
+        encoding = design.encodings.get(column.lower())
+        if encoding:
+            definition = COLUMN_TYPE.sub(lambda match: f'{match.group(0)} encode {encoding}', definition, count=1)
+        columns.append(definition)
+
+    attributes = f'diststyle {design.diststyle}'
+    if design.diststyle == 'key':
+        attributes += f' distkey ({design.distkey})'
+    if design.sortkey:
+        attributes += f" compound sortkey ({', '.join(design.sortkey)})"
+    return (f"CREATE TABLE IF NOT EXISTS {name or table['table']} (" + (',\n' + ' ' * indent).join(columns)
+            + f")\n{' ' * attributes_indent}{attributes};")
+
+
+def get_identity_seed(cur, table):
+    '''
+    Returns the next value of the identity column of a parsed table, after the largest one it holds,
+    or None if the table has no identity column.
+    '''
+    if not table['identity']:
+        return None
+    definition = next(definition for column, _, definition in table['columns'] if column == table['identity'])
+    seed, step = map(int, IDENTITY.search(definition).groups())
+    cur.execute(f"SELECT MAX({table['identity']}) FROM {table['table']}")
+    largest = cur.fetchone()[0]
+    return seed if largest is None else largest + step
+
+
+def keep_identity(ddl, identity_seed):
+    '''
+    Returns a CREATE TABLE statement whose IDENTITY column accepts the copied values and continues from identity_seed.
+    Redshift only allows inserting into an identity column declared GENERATED BY DEFAULT.
+    '''
+    return IDENTITY.sub(lambda match: f'GENERATED BY DEFAULT AS IDENTITY({identity_seed}, {match.group(2)})', ddl)
+
+
+def normalize_type(column_type, length=None):
+    '''
+    Returns a column type as (name, length), the length being None when it is not declared.
+    '''
+    match = TYPE_LENGTH.match(column_type)
+    name, declared_length = match.groups() if match else (column_type, None)
+    name = name.lower()
+    length = length or declared_length
+    return TYPE_ALIASES.get(name, name), int(length) if length else None
+
+
+def normalize_ddl(queries):
+    '''
+    Returns the DDL of a schema with the whitespace of every statement collapsed, one statement per line.
+    '''
+    return '\n'.join(' '.join(query.split()) for query in queries)
+
+
+def schema_version(queries):
+    '''
+    Returns the version of a schema: a hash of its DDL, ignoring whitespace.
+    '''
+    return hashlib.sha1(normalize_ddl(queries).encode()).hexdigest()[:16]
+
+
+def get_declared_design(table):
+    '''
+    Returns the TableDesign declared by the DDL of a parsed table.
+    Only the encodings given with ENCODE are returned, since Redshift chooses the others.
+    '''
+    distkey, sortkey, encodings = None, [], {}
+    for column, _, definition in table['columns']:
+        if re.search(r'\bdistkey\b', definition, re.IGNORECASE):
+            distkey = column.lower()
+        if re.search(r'\bsortkey\b', definition, re.IGNORECASE):
+            sortkey = [column.lower()]
+        encoding = re.search(r'\bencode\s+(\w+)', definition, re.IGNORECASE)
+        if encoding:
+            encodings[column.lower()] = encoding.group(1).lower()
+
+    attributes = table['attributes']
+    match = re.search(r'\bdistkey\s*\((\w+)\)', attributes, re.IGNORECASE)
+    if match:
+        distkey = match.group(1).lower()
+    match = re.search(r'\bsortkey\s*\(([^)]*)\)', attributes, re.IGNORECASE)
+    if match:
+        sortkey = [column.strip().lower() for column in match.group(1).split(',')]
+    match = re.search(r'\bdiststyle\s+(\w+)', attributes, re.IGNORECASE)
+    diststyle = match.group(1).lower() if match else ('key' if distkey else 'auto')
+    return TableDesign(table['table'].lower(), diststyle, distkey, sortkey, encodings)
+
+
+def design_keys(design):
+    return design.diststyle, design.distkey, design.sortkey
+
+
+def get_recorded_designs(cur, columns):
+    '''
+    Returns the TableDesign of every table as declared by the DDL recorded with the last migration,
+    or an empty dict if none was recorded yet.
+    '''
+    if 'ddl' not in columns.get('etl_schema_versions', {}):
+        return {}
+    cur.execute(schema_ddl_select)
+    row = cur.fetchone()
+    if row is None:
+        return {}
+    designs = {}
+    for query in row[0].split('\n'):
+        if CREATE_TABLE.search(query):
+            design = get_declared_design(parse_table_ddl(query))
+            designs[design.table] = design
+    return designs
+
+
+def get_tuned_designs(cur, columns):
+    '''
+    Returns the TableDesign applied by table_tuning.py to every tuned table, or an empty dict if none was tuned.
+    '''
+    if 'etl_table_designs' not in columns:
+        return {}
+    cur.execute(table_designs_select)
+    return {table: TableDesign(table, diststyle, distkey, sortkey.split(',') if sortkey else [],
+                               json.loads(encodings or '{}'))
+            for table, diststyle, distkey, sortkey, encodings in cur.fetchall()}
+
+
+def get_catalog(cur, physical_design=False):
+    '''
+    Returns the live columns of every table of the current schema as {table: {column: (type, length)}}.
+
+    With physical_design, which only Redshift has, the live TableDesign of every table is returned as well.
+    '''
+    cur.execute(table_columns_select)
+    columns = {}
+    for table, column, data_type, length in cur.fetchall():
+        columns.setdefault(table.lower(), {})[column.lower()] = normalize_type(data_type, length)
+    if not physical_design:
+        return columns, {}
+
+    cur.execute(table_diststyles_select)
+    diststyles = {table.strip(): DISTSTYLES.get(diststyle, 'even') for table, diststyle in cur.fetchall()}
+    cur.execute(table_keys_select)
+    keys = {}
+    for table, column, encoding, is_distkey, position in cur.fetchall():
+        keys.setdefault(table, []).append((column, encoding, is_distkey, position))
+    designs = {}
+    for table, table_keys in keys.items():
+        distkey = next((column for column, _, is_distkey, _ in table_keys if is_distkey), None)
+        sortkey = [column for column, _, _, position in sorted(table_keys, key=lambda key: key[3]) if position > 0]
+        encodings = {column: 'raw' if encoding == 'none' else encoding for column, encoding, _, _ in table_keys}
+        designs[table] = TableDesign(table, diststyles.get(table, 'even'), distkey, sortkey, encodings)
+    return columns, designs
+
+
+def deep_copy_statements(table, columns, physical_design=False, identity_seed=None, retyped=(), design=None):
+    '''
+    Returns the statements rebuilding a table with its declared DDL, or with the given TableDesign, and copying
+    the given columns into it. The retyped columns are cast to their declared type. A rebuild also fully sorts
+    and compacts the table.
+
+    With an identity_seed, as given by get_identity_seed, the identity values are copied too, so the
+    surrogate keys don't change, and new ones continue from the seed. Otherwise they are generated.
+    A table left over by a failed rebuild is dropped first.
+
+    On Redshift, the foreign keys referencing the table are dropped with it and added again to the new table.
+    '''
+    name = table['table']
+    if design is None:
+        ddl = CREATE_TABLE.sub(f'CREATE TABLE IF NOT EXISTS {name}__migrated (', table['query'], count=1)
+    else:
+        ddl = render_table_ddl(table, design, f'{name}__migrated')
+    if identity_seed is None:
+        columns = [column for column in columns if column != (table['identity'] or '').lower()]
+    elif physical_design:
+        ddl = keep_identity(ddl, identity_seed)
+    else:
+        # The local backends turn IDENTITY into an identity that accepts inserted values.
+        ddl = IDENTITY.sub(lambda match: f'IDENTITY({identity_seed}, {match.group(2)})', ddl)
+    types = {column.lower(): column_type for column, column_type, _ in table['columns']}
+    values = ', '.join(f'CAST({column} AS {types[column]})' if column in retyped else column for column in columns)
+    columns = ', '.join(columns)
+    statements = [f"DROP TABLE IF EXISTS {name}__migrated",
+                  ddl,
+                  f"INSERT INTO {name}__migrated ({columns}) SELECT {values} FROM {name}",
+                  f"DROP TABLE {name}{' CASCADE' if physical_design else ''}",
+                  f"ALTER TABLE {name}__migrated RENAME TO {name}"]
+    if physical_design:
+        for referencing in map(parse_table_ddl, create_table_queries + create_control_table_queries):
+            for column, referenced in referencing['references'].items():
+                if referenced.lower() == name.lower() and referencing['table'].lower() != name.lower():
+                    statements.append(f"ALTER TABLE {referencing['table']} ADD FOREIGN KEY ({column}) "
+                                      f"REFERENCES {name} ({referencing['referenced_columns'][column]})")
+    return statements
+
+
+def plan_migration(queries, columns, designs, physical_design=False, allow_drop=False, recorded_designs=None,
+                   cur=None, tuned_designs=None):
+    '''
+    Returns the SchemaChanges bringing the live catalog to the DDL declared by the CREATE TABLE queries.
+
+    - a missing table is created, and filled by its create_table_backfills queries
+    - a missing column is added with ALTER TABLE ... ADD COLUMN
+    - a column whose type changed deep copies the table, keeping its rows, and its identity values when
+      a cursor is given to find where they continue
+    - a distribution style, distribution key or sort key changed in the DDL since the last migration, as
+      given by recorded_designs, deep copies the table too. Keys chosen by Redshift for an AUTO table, or set
+      by table_tuning.py, are not changes to the DDL, so they are kept. A table rebuilt for another reason keeps
+      the design table_tuning.py applied to it, as given by tuned_designs, and a change of keys in the DDL
+      discards that design.
+    - a changed encoding is altered in place
+    - a column that is no longer declared is only dropped with allow_drop
+
+    Raises a ValueError when a deep copy would lose columns that are no longer declared, unless allow_drop is set.
+    '''
+    recorded_designs = recorded_designs or {}
+    tuned_designs = tuned_designs or {}
+    changes = []
+    for query in queries:
+        table = dict(parse_table_ddl(query), query=query)
+        name = table['table'].lower()
+        if name not in columns:
+            changes.append(SchemaChange(table['table'], 'create table', [query] + create_table_backfills.get(name, []),
+                                        True))
+            continue
+
+        live_columns = columns[name]
+        declared = [(column.lower(), normalize_type(column_type), definition)
+                    for column, column_type, definition in table['columns']]
+        missing = [(column, definition) for column, _, definition in declared if column not in live_columns]
+        retyped = [column for column, (type_name, length), _ in declared if column in live_columns
+                   and (live_columns[column][0] != type_name
+                        or None not in (length, live_columns[column][1]) and live_columns[column][1] != length)]
+        extra = [column for column in live_columns if column not in {column for column, _, _ in declared}]
+
+        declared_design = get_declared_design(table)
+        live_design = designs.get(name)
+        recorded_design = recorded_designs.get(name)
+        rekeyed = (physical_design and live_design is not None and recorded_design is not None
+                   and declared_design.diststyle != 'auto'
+                   and design_keys(recorded_design) != design_keys(declared_design)
+                   and design_keys(live_design) != design_keys(declared_design))
+        tuned_design = tuned_designs.get(name) if physical_design and not rekeyed else None
+        # An added identity column can't be filled in for the existing rows, so the table is rebuilt instead.
+        new_identity = (table['identity'] or '').lower() in {column for column, _ in missing}
+
+        if retyped or rekeyed or new_identity:
+            if extra and not allow_drop:
+                raise ValueError(f"Rebuilding {name} would drop its undeclared column(s) {', '.join(extra)}. "
+                                 f"Run with --allow-drop to drop them.")
+            reasons = ([f"retype {', '.join(retyped)}"] if retyped else []) + (["change keys"] if rekeyed else []) \
+                + ([f"add identity {table['identity']}"] if new_identity else [])
+            common = [column for column, _, _ in declared if column in live_columns]
+            copy_identity = cur is not None and (table['identity'] or '').lower() in common
+            identity_seed = get_identity_seed(cur, table) if copy_identity else None
+            statements = deep_copy_statements(table, common, physical_design, identity_seed, retyped, tuned_design)
+            if rekeyed and name in tuned_designs:
+                statements.append(table_design_delete.format(table=name))
+            changes.append(SchemaChange(table['table'], f"deep copy ({'; '.join(reasons)})", statements, True))
+            continue
+
+        for column, definition in missing:
+            changes.append(SchemaChange(table['table'], f"add column {column}",
+                                        [f"ALTER TABLE {table['table']} ADD COLUMN "
+                                         + COLUMN_ATTRIBUTES.sub('', definition)], True))
+        for column in extra:
+            if allow_drop:
+                changes.append(SchemaChange(table['table'], f"drop column {column}",
+                                            [f"ALTER TABLE {table['table']} DROP COLUMN {column}"], True))
+            else:
+                print(f"  {table['table']}.{column} is no longer declared, kept. Run with --allow-drop to drop it.")
+        # The encodings of a tuned table are those table_tuning.py chose.
+        if physical_design and live_design is not None and tuned_design is None:
+            for column, encoding in declared_design.encodings.items():
+                if live_design.encodings.get(column) != encoding:
+                    changes.append(SchemaChange(table['table'], f"encode {column} {encoding}",
+                                                [f"ALTER TABLE {table['table']} ALTER COLUMN {column} ENCODE {encoding}"],
+                                                False))
+    return changes
+
+
+def migrate_schema(cur, conn, physical_design=False, allow_drop=False, dry_run=False, profiler=None):
+    '''
+    Migrates the live schema to the DDL declared in sql_queries.py, keeping the loaded rows.
+
+    The transactional changes and their row in etl_schema_versions are applied in a single transaction,
+    so a failed migration leaves the schema untouched. Returns the planned SchemaChanges.
+    '''
+    queries = create_table_queries + create_control_table_queries
+    version = schema_version(queries)
+    try:
+        execute(cur, schema_versions_table_create, profiler)
+        columns, designs = get_catalog(cur, physical_design)
+        recorded_designs = get_recorded_designs(cur, columns)
+        tuned_designs = get_tuned_designs(cur, columns)
+        changes = plan_migration(queries, columns, designs, physical_design, allow_drop, recorded_designs, cur,
+                                 tuned_designs)
+        cur.execute(schema_version_select)
+        row = cur.fetchone()
+        current_version = row[0] if row else None
+
+        for change in changes:
+            print(f"  {change.table}: {change.description}{'' if change.transactional else ' (after commit)'}")
+        if dry_run:
+            print(f"Dry run, {len(changes)} change(s) not applied.")
+            conn.rollback()
+            return changes
+
+        for change in changes:
+            if change.transactional:
+                for statement in change.statements:
+                    execute(cur, statement, profiler)
+        if changes or version != current_version:
+            cur.execute(schema_version_insert, (version, '\n'.join(f"{change.table}: {change.description}"
+                                                                   for change in changes), normalize_ddl(queries)))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    deferred = [change for change in changes if not change.transactional]
+    if deferred:
+        conn.autocommit = True
+        try:
+            for change in deferred:
+                for statement in change.statements:
+                    execute(cur, statement, profiler)
+        finally:
+            conn.autocommit = False
+    if changes or version != current_version:
+        print(f"Schema migrated to version {version} with {len(changes)} change(s).")
+    else:
+        print(f"Schema is up to date (version {version}).")
+    return changes
+
+
+def run_migration(backend=None, allow_drop=False, dry_run=False):
+    '''
+    Migrates the schema of the Redshift cluster, unless another execution backend is given.
+    '''
+    if backend is None:
+        config = configparser.ConfigParser()
+        config.read(CONFIG_FILE)
+        backend = get_backend(config)
+
+    conn = backend.connect()
+    cur = conn.cursor()
+    try:
+        print("Migrating schema.")
+        migrate_schema(cur, conn, backend.name == 'redshift', allow_drop, dry_run)
+        print("Finished!\n")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrates the warehouse schema to the DDL declared in sql_queries.py.")
+    parser.add_argument('--backend', choices=['redshift', 'duckdb', 'postgres'],
+                        help="execution backend, defaults to BACKEND in the [ETL] section of dwh.cfg")
+    parser.add_argument('--allow-drop', action='store_true', help="drop the columns that are no longer declared")
+    parser.add_argument('--dry-run', action='store_true', help="print the planned changes without applying them")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    run_migration(get_backend(config, args.backend), args.allow_drop, args.dry_run)
@@ -0,0 +1,132 @@
+import json
+import threading
+from datetime import datetime
+from time import perf_counter
+
+last_query_id_select = "SELECT pg_last_query_id()"
+
+# System table queries, run once per stage over the query ids of the stage's statements.
+
+load_commits_select = ("""SELECT query,
+                                 COUNT(DISTINCT filename) AS files,
+                                 SUM(lines_scanned)       AS lines_scanned,
+                                 SUM(errors)              AS errors
+                          FROM stl_load_commits
+                          WHERE query IN ({query_ids})
+                          GROUP BY query
+""")
+
+query_summary_select = ("""SELECT query,
+                                  COUNT(*)                                           AS steps,
+                                  MAX(maxtime)                                       AS max_step_time_us,
+                                  SUM(rows)                                          AS rows,
+                                  SUM(bytes)                                         AS bytes,
+                                  MAX(workmem)                                       AS max_workmem,
+                                  SUM(CASE WHEN is_diskbased = 't' THEN 1 ELSE 0 END) AS diskbased_steps
+                           FROM svl_query_summary
+                           WHERE query IN ({query_ids})
+                           GROUP BY query
+""")
+
+load_errors_select = ("""SELECT query,
+                                TRIM(filename)   AS filename,
+                                line_number,
+                                TRIM(colname)    AS colname,
+                                err_code,
+                                TRIM(err_reason) AS err_reason
+                         FROM stl_load_errors
+                         WHERE query IN ({query_ids})
+""")
+
+SYSTEM_TABLE_QUERIES = {'load_commits': load_commits_select,
+                        'query_summary': query_summary_select,
+                        'load_errors': load_errors_select}
+
+
+def describe_statement(statement):
+    '''
+    Returns a short name for a statement run outside the query graphs, e.g. 'DROP TABLE IF EXISTS dimUser'.
+    '''
+    return ' '.join(statement.split('(')[0].split())
+
+
+def execute(cur, statement, profiler=None, name=None):
+    '''
+    Runs a statement on the cursor, recording it with the profiler if one is given.
+    '''
+    if profiler is None:
+        cur.execute(statement)
+    else:
+        profiler.execute(cur, statement, name or describe_statement(statement))
+
+
+class QueryProfiler:
+    '''
+    Records the wall time, rows affected and Redshift query id of every statement run through it.
+
+    Statements are grouped in stages. When a stage ends, the rows of STL_LOAD_COMMITS,
+    SVL_QUERY_SUMMARY and STL_LOAD_ERRORS matching the stage's query ids are collected with it.
+    Safe to use from the scheduler's worker threads.
+    '''
+    def __init__(self):
+        self.started_at = datetime.utcnow().isoformat()
+        self.stages = {}
+        self._stage = None
+        self._stage_start = None
+        self._lock = threading.Lock()
+
+    def start_stage(self, stage):
+        self._stage = stage
+        self._stage_start = perf_counter()
+        self.stages[stage] = {'elapsed': None, 'statements': []}
+
+    def execute(self, cur, statement, name):
+        '''
+        Runs a statement on the cursor and records it under the current stage.
+        '''
+        started_at = datetime.utcnow().isoformat()
+        start = perf_counter()
+        cur.execute(statement)
+        elapsed = perf_counter() - start
+        rows = cur.rowcount
+
+        cur.execute(last_query_id_select)
+        query_id = cur.fetchone()[0]
+
+        with self._lock:
+            self.stages[self._stage]['statements'].append({'name': name, 'started_at': started_at, 'elapsed': elapsed,
+                                                           'rows': rows, 'query_id': query_id})
+
+    def end_stage(self, cur):
+        '''
+        Closes the current stage and collects the system table rows of its statements.
+        '''
+        stage = self.stages[self._stage]
+        stage['elapsed'] = perf_counter() - self._stage_start
+        query_ids = sorted({statement['query_id'] for statement in stage['statements'] if statement['query_id'] is not None})
+        for key, query in SYSTEM_TABLE_QUERIES.items():
+            stage[key] = []
+            if not query_ids:
+                continue
+            cur.execute(query.format(query_ids=', '.join(str(int(query_id)) for query_id in query_ids)))
+            columns = [column[0] for column in cur.description]
+            stage[key] = [dict(zip(columns, row)) for row in cur.fetchall()]
+        self._stage = None
+
+    def write(self, path):
+        '''
+        Writes every stage to a JSON metrics file.
+        '''
+        with open(path, 'w') as f:
+            json.dump({'started_at': self.started_at, 'stages': self.stages}, f, indent=2, default=str)
+
+    def print_summary(self):
+        print(f"{'stage':<13}{'statement':<60}{'seconds':>10}{'rows':>12}{'query id':>10}")
+        for stage_name, stage in self.stages.items():
+            for statement in sorted(stage['statements'], key=lambda statement: statement['started_at']):
+                print(f"{stage_name:<13}{statement['name'][:58]:<60}{statement['elapsed']:>10.3f}"
+                      f"{statement['rows']:>12}{str(statement['query_id']):>10}")
+            errors = len(stage.get('load_errors', []))
+            if stage['elapsed'] is not None:
+                print(f"{stage_name:<13}{'total' + (f' ({errors} load errors)' if errors else ''):<60}{stage['elapsed']:>10.3f}")
+        print()
@@ -1,5 +1,6 @@
 #!/bin/bash 
 
 python set_up_aws_resources.py
-python create_tables.py
-python etl.py
+python compaction.py
+python etl.py "$@"
+python export.py --changed-only
@@ -0,0 +1,151 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from time import perf_counter, sleep
+
+from connections import backoff_delay, is_transient
+from profiling import execute
+
+
+def discard_connection(conn):
+    '''
+    Closes a connection that failed for good, instead of returning it to the idle pool of its ConnectionManager.
+    '''
+    try:
+        conn.discard() if hasattr(conn, 'discard') else conn.close()
+    except Exception:
+        pass
+
+
+def validate_graph(graph):
+    '''
+    Checks that every dependency in the graph is declared and that the graph has no cycles.
+
+    The graph maps a query name to a (query, dependencies) tuple.
+    '''
+    for name, (_, dependencies) in graph.items():
+        for dependency in dependencies:
+            if dependency not in graph:
+                raise ValueError(f"Query '{name}' depends on unknown query '{dependency}'.")
+
+    remaining = {name: set(dependencies) for name, (_, dependencies) in graph.items()}
+    while remaining:
+        ready = [name for name, dependencies in remaining.items() if not dependencies]
+        if not ready:
+            raise ValueError(f"Circular dependency between queries: {', '.join(sorted(remaining))}")
+        for name in ready:
+            del remaining[name]
+        for dependencies in remaining.values():
+            dependencies.difference_update(ready)
+
+
+def execute_query(connect, name, query, profiler=None, query_groups=None, max_retries=0, retry_backoff=1.0):
+    '''
+    Runs a single query on a connection from connect and commits it.
+    The query may also be a list of statements, which are committed together.
+    If a profiler is given, every statement is recorded with it.
+
+    With query_groups, the connection is first tagged with the query group it returns for the query name,
+    e.g. to run COPYs on their own WLM queue. Transient failures (see connections.is_transient), including
+    a failure to connect, are retried up to max_retries times on a new connection, with jittered exponential
+    backoff from retry_backoff seconds. A failure of the commit itself is not retried: the transaction may
+    have committed before the connection was lost, and running an INSERT again would duplicate its rows.
+    The connection is closed after a success, which returns it to the idle pool of a ConnectionManager,
+    and discarded after a failure, since it may be broken.
+    Returns the wall time of the successful attempt in seconds.
+    '''
+    attempt = 0
+    while True:
+        conn = None
+        committing = False
+        try:
+            conn = connect()
+            if query_groups is not None:
+                conn.set_query_group(query_groups(name))
+            start = perf_counter()
+            cur = conn.cursor()
+            try:
+                statements = [query] if isinstance(query, str) else query
+                for i, statement in enumerate(statements):
+                    execute(cur, statement, profiler, name if len(statements) == 1 else f'{name}[{i}]')
+                committing = True
+                conn.commit()
+            except Exception:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+                raise
+            finally:
+                try:
+                    cur.close()
+                except Exception:
+                    pass
+            elapsed = perf_counter() - start
+        except Exception as e:
+            if conn is not None:
+                discard_connection(conn)
+            if attempt >= max_retries or committing or not is_transient(e):
+                raise
+            delay = backoff_delay(attempt, retry_backoff)
+            print(f"  {name} failed ({str(e).strip().splitlines()[0]}), retrying in {delay:.1f}s")
+            sleep(delay)
+            attempt += 1
+            continue
+        conn.close()
+        return elapsed
+
+
+def run_query_graph(graph, connect, max_concurrency=4, on_complete=None, profiler=None, query_groups=None,
+                    max_retries=0, retry_backoff=1.0):
+    '''
+    Runs every query in the graph, starting each one as soon as all of its dependencies have finished.
+
+    - graph maps a query name to a (query, dependencies) tuple
+    - connect is a callable returning a DB-API connection, such as the connect of a backend, whose
+      ConnectionManager pools the connections between queries
+    - max_concurrency bounds both the number of running queries and of connections in use
+    - on_complete, if given, is called with (name, elapsed) after each query commits
+    - profiler, if given, records every statement (see profiling.QueryProfiler)
+    - query_groups, max_retries and retry_backoff are passed on to execute_query
+
+    If a query fails, no further queries are started and the error is raised once the
+    queries already running have finished. Returns a dict of query name to wall time.
+    '''
+    validate_graph(graph)
+    if max_concurrency < 1:
+        raise ValueError("max_concurrency must be at least 1.")
+
+    waiting_on = {name: set(dependencies) for name, (_, dependencies) in graph.items()}
+    timings = {}
+    running = {}
+    error = None
+
+    # Every worker holds at most one connection at a time.
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        while waiting_on or running:
+            if error is None:
+                ready = [name for name, dependencies in waiting_on.items() if not dependencies]
+                for name in ready:
+                    del waiting_on[name]
+                    query = graph[name][0]
+                    running[executor.submit(execute_query, connect, name, query, profiler, query_groups,
+                                            max_retries, retry_backoff)] = name
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    timings[name] = future.result()
+                except Exception as e:
+                    if error is None:
+                        error = e
+                    continue
+                for dependencies in waiting_on.values():
+                    dependencies.discard(name)
+                if on_complete is not None:
+                    on_complete(name, timings[name])
+
+    if error is not None:
+        raise error
+    return timings
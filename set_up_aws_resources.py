@@ -1,22 +1,54 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
 from aws_manager import AWSManager
 
-def set_up_aws_resources():
+
+def set_up_iam_role(aws_manager):
     '''
-    - Creates the required IAM role to access data from S3
-    - Creates a new Redshift Cluster
+    Creates the IAM role, attaches its policy and returns its ARN.
     '''
-    aws_manager = AWSManager()
-    
-    print("Creating IAM role")
     aws_manager.create_iam_role()
-    
-    print("Attaching policy to IAM role\n")
     aws_manager.attach_policy()
-    
-    print("Creating Redshift Cluster. This might take a few minutes...")
-    aws_manager.create_cluster()
+    return aws_manager.get_iam_role_arn()
+
+
+def set_up_aws_resources(aws_manager=None):
+    '''
+    - Creates the required IAM role to access data from S3
+    - Creates a new Redshift Cluster, or restores it from the snapshot set by SNAPSHOT_IDENTIFIER in dwh.cfg
+    - Resumes the cluster if it is paused
+
+    The IAM role, the snapshot lookup and the check for an existing cluster run concurrently.
+    Returns the number of seconds it took for the cluster to become available.
+    '''
+    aws_manager = aws_manager or AWSManager()
+    start = perf_counter()
+
+    print("Creating IAM role, attaching its policy and looking for an existing cluster or snapshot")
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        iam_role = executor.submit(set_up_iam_role, aws_manager)
+        snapshot = executor.submit(aws_manager.find_cluster_snapshot)
+        status = executor.submit(aws_manager.get_cluster_status)
+        iam_role, snapshot, status = iam_role.result(), snapshot.result(), status.result()
+    print(f"Done in {perf_counter() - start:.1f}s.\n")
+
+    if status == 'paused':
+        print("Resuming paused Redshift Cluster. This might take a few minutes...")
+        aws_manager.resume_cluster()
+    elif status is not None:
+        print(f"Cluster already exists ({status}).")
+    elif snapshot is not None:
+        print(f"Restoring Redshift Cluster from snapshot {snapshot}. This might take a few minutes...")
+        aws_manager.restore_cluster(snapshot, iam_role)
+    else:
+        print("Creating Redshift Cluster. This might take a few minutes...")
+        aws_manager.create_cluster(iam_role)
     aws_manager.wait_for_cluster_creation()
-    print("Success! Cluster created.\n")
-    
+
+    elapsed = perf_counter() - start
+    print(f"Success! Cluster available after {elapsed:.1f}s.\n")
+    return elapsed
+
 if __name__ == '__main__':
-    set_up_aws_resources()
\ No newline at end of file
+    set_up_aws_resources()
@@ -1,5 +1,4 @@
 import configparser
-import boto3
 from aws_manager import AWSManager
 
 # CONFIG
@@ -9,12 +8,23 @@ config.read(CONFIG_FILE)
 aws_manager = AWSManager()
 
 REGION_NAME = aws_manager.get_region_name()
-IAM_ROLE_NAME = aws_manager.get_cluster_iam_role()
 
 LOG_DATA = config.get("S3", "LOG_DATA")
 LOG_JSONPATH = config.get("S3", "LOG_JSONPATH")
 SONG_DATA = config.get("S3", "SONG_DATA")
 
+_iam_role = None
+
+def get_iam_role():
+    '''
+    Returns the IAM role of the cluster used by the COPY queries.
+    It is only looked up when a COPY is first built, so that importing this module makes no AWS calls.
+    '''
+    global _iam_role
+    if _iam_role is None:
+        _iam_role = aws_manager.get_cluster_iam_role()
+    return _iam_role
+
 # DROP TABLES
 
 staging_events_table_drop = "DROP TABLE IF EXISTS staging_events"
@@ -24,6 +34,10 @@ user_table_drop = "DROP TABLE IF EXISTS dimUser"
 song_table_drop = "DROP TABLE IF EXISTS dimSong"
 artist_table_drop = "DROP TABLE IF EXISTS dimArtist"
 time_table_drop = "DROP TABLE IF EXISTS dimTime"
+song_lookup_table_drop = "DROP TABLE IF EXISTS song_lookup"
+hourly_plays_table_drop = "DROP TABLE IF EXISTS agg_hourly_plays"
+daily_song_plays_table_drop = "DROP TABLE IF EXISTS agg_daily_song_plays"
+daily_user_plays_table_drop = "DROP TABLE IF EXISTS agg_daily_user_plays"
 
 # CREATE TABLES
 
@@ -61,6 +75,19 @@ staging_songs_table_create = ("""CREATE TABLE IF NOT EXISTS staging_songs
                                   year int)
 """)
 
+# Columns of the staging tables, in table order, for tools that write or read staging data outside of Redshift.
+
+staging_table_columns = {
+    'staging_events': [('artist', 'varchar'), ('auth', 'varchar'), ('firstname', 'varchar'), ('gender', 'varchar'),
+                       ('iteminsession', 'int'), ('lastname', 'varchar'), ('length', 'float'), ('level', 'varchar'),
+                       ('location', 'varchar'), ('method', 'varchar'), ('page', 'varchar'), ('registration', 'bigint'),
+                       ('sessionid', 'int'), ('song', 'varchar'), ('status', 'int'), ('ts', 'bigint'),
+                       ('useragent', 'varchar'), ('userid', 'int')],
+    'staging_songs':  [('artist_id', 'varchar'), ('artist_latitude', 'float'), ('artist_location', 'varchar'),
+                       ('artist_longitude', 'float'), ('artist_name', 'varchar'), ('duration', 'float'),
+                       ('num_songs', 'int'), ('song_id', 'varchar'), ('title', 'varchar'), ('year', 'int')],
+}
+
 songplay_table_create = ("""CREATE TABLE IF NOT EXISTS factSongplay (songplay_id int IDENTITY(0,1) PRIMARY KEY,
                                                                      start_time timestamp NOT NULL REFERENCES dimTime (start_time),
                                                                      user_id int NOT NULL REFERENCES dimUser (user_id) sortkey,
@@ -68,15 +95,20 @@ songplay_table_create = ("""CREATE TABLE IF NOT EXISTS factSongplay (songplay_id
                                                                      song_id varchar REFERENCES dimSong (song_id),
                                                                      artist_id varchar REFERENCES dimArtist (artist_id),
                                                                      session_id int,
+                                                                     item_in_session int,
                                                                      location varchar,
-                                                                     user_agent varchar NOT NULL);
+                                                                     user_agent varchar NOT NULL,
+                                                                     loaded_at timestamp DEFAULT getdate());
 """)
 
+# last_ts is the ts of the event a user's row was taken from, so an older event arriving late can't replace it.
+
 user_table_create = ("""CREATE TABLE IF NOT EXISTS dimUser (user_id int PRIMARY KEY sortkey,
                                                             first_name varchar,
                                                             last_name varchar,
                                                             gender varchar,
-                                                            level varchar)
+                                                            level varchar,
+                                                            last_ts bigint)
                         diststyle all;
 """)
 
@@ -105,37 +137,259 @@ time_table_create = ("""CREATE TABLE IF NOT EXISTS dimTime (start_time timestamp
                                                             weekday int NOT NULL);
 """)
 
+# Maps the key of every song to its song and artist, so events are matched to songs with a single
+# equality join. Small enough to be copied to every node, and sorted on the key for a merge join.
+
+song_lookup_table_create = ("""CREATE TABLE IF NOT EXISTS song_lookup (song_key varchar(32) PRIMARY KEY sortkey,
+                                                                       song_id varchar NOT NULL,
+                                                                       artist_id varchar NOT NULL)
+                               diststyle all;
+""")
+
+# AGGREGATES
+# Summary tables of factSongplay for the dashboards, queried through aggregates.py.
+# Song plays without a level are counted under 'unknown'.
+
+hourly_plays_table_create = ("""CREATE TABLE IF NOT EXISTS agg_hourly_plays (play_hour timestamp NOT NULL sortkey,
+                                                                             level varchar NOT NULL,
+                                                                             plays bigint NOT NULL)
+                                diststyle all;
+""")
+
+daily_song_plays_table_create = ("""CREATE TABLE IF NOT EXISTS agg_daily_song_plays (play_date date NOT NULL,
+                                                                                   song_id varchar NOT NULL,
+                                                                                   plays bigint NOT NULL)
+                                    compound sortkey (play_date, song_id);
+""")
+
+daily_user_plays_table_create = ("""CREATE TABLE IF NOT EXISTS agg_daily_user_plays (play_date date NOT NULL,
+                                                                                   user_id int NOT NULL,
+                                                                                   level varchar NOT NULL,
+                                                                                   plays bigint NOT NULL)
+                                    compound sortkey (play_date, user_id);
+""")
+
+# CONTROL TABLES
+# Bookkeeping for incremental loads: the S3 objects already ingested and the high-water mark of event timestamps.
+
+loaded_files_table_drop = "DROP TABLE IF EXISTS etl_loaded_files"
+watermark_table_drop = "DROP TABLE IF EXISTS etl_watermark"
+schema_versions_table_drop = "DROP TABLE IF EXISTS etl_schema_versions"
+aggregate_watermark_table_drop = "DROP TABLE IF EXISTS etl_aggregate_watermark"
+table_designs_table_drop = "DROP TABLE IF EXISTS etl_table_designs"
+
+loaded_files_table_create = ("""CREATE TABLE IF NOT EXISTS etl_loaded_files (s3_key varchar(1024) PRIMARY KEY sortkey,
+                                                                             staging_table varchar(64) NOT NULL,
+                                                                             loaded_at timestamp NOT NULL DEFAULT getdate())
+                                diststyle all;
+""")
+
+watermark_table_create = ("""CREATE TABLE IF NOT EXISTS etl_watermark (name varchar(64) PRIMARY KEY,
+                                                                       value bigint NOT NULL)
+                             diststyle all;
+""")
+
+# Every schema version applied by migrations.py, identified by a hash of the declared DDL.
+# The DDL itself is kept too, so that later migrations tell a changed declaration from a changed table.
+
+schema_versions_table_create = ("""CREATE TABLE IF NOT EXISTS etl_schema_versions (version varchar(64) NOT NULL,
+                                                                               applied_at timestamp NOT NULL DEFAULT getdate(),
+                                                                               changes varchar(65535),
+                                                                               ddl varchar(65535))
+                                   diststyle all;
+""")
+
+# The design applied to each table by table_tuning.py, so that a migration rebuilding a tuned table keeps it.
+# sort_key lists the sort key columns separated by commas, and encodings is a JSON object of the column encodings.
+
+table_designs_table_create = ("""CREATE TABLE IF NOT EXISTS etl_table_designs (table_name varchar(128) PRIMARY KEY,
+                                                                               dist_style varchar(16) NOT NULL,
+                                                                               dist_key varchar(128),
+                                                                               sort_key varchar(1024),
+                                                                               encodings varchar(65535),
+                                                                               applied_at timestamp NOT NULL DEFAULT getdate())
+                                 diststyle all;
+""")
+
+# The load currently emptying and filling the staging tables, etl.py or a batch of streaming.py, if any.
+# It is locked while a load takes it, so that two loads can't take it together, and it is not dropped
+# with the other tables, so that a full refresh can't take it from a running load.
+
+load_lock_table_create = ("""CREATE TABLE IF NOT EXISTS etl_load_lock (owner varchar(256) NOT NULL,
+                                                                       acquired_at timestamp NOT NULL)
+                             diststyle all;
+""")
+
+load_lock_table_lock = "LOCK etl_load_lock"
+load_lock_select = "SELECT owner, acquired_at, getdate()::timestamp FROM etl_load_lock"
+load_lock_delete = "DELETE FROM etl_load_lock"
+load_lock_insert = "INSERT INTO etl_load_lock (owner, acquired_at) VALUES (%s, getdate()::timestamp)"
+load_lock_release = "DELETE FROM etl_load_lock WHERE owner = %s"
+
+# The loaded_at of the last song play added to the aggregates.
+
+aggregate_watermark_table_create = ("""CREATE TABLE IF NOT EXISTS etl_aggregate_watermark (refreshed_through timestamp NOT NULL)
+                                       diststyle all;
+""")
+
+EVENTS_WATERMARK = 'staging_events.ts'
+
+loaded_files_select = ("""SELECT s3_key FROM etl_loaded_files WHERE staging_table = %s""")
+
+watermark_select = (f"""SELECT value FROM etl_watermark WHERE name = '{EVENTS_WATERMARK}'""")
+
+schema_version_select = ("""SELECT version FROM etl_schema_versions ORDER BY applied_at DESC LIMIT 1""")
+
+schema_ddl_select = ("""SELECT ddl FROM etl_schema_versions WHERE ddl IS NOT NULL ORDER BY applied_at DESC LIMIT 1""")
+
+schema_version_insert = ("""INSERT INTO etl_schema_versions (version, changes, ddl) VALUES (%s, %s, %s)""")
+
+table_designs_select = ("""SELECT table_name, dist_style, dist_key, sort_key, encodings FROM etl_table_designs""")
+
+table_design_delete = ("""DELETE FROM etl_table_designs WHERE table_name = '{table}'""")
+
+table_design_insert = ("""INSERT INTO etl_table_designs (table_name, dist_style, dist_key, sort_key, encodings)
+                          VALUES (%s, %s, %s, %s, %s)
+""")
+
 # STAGING TABLES
 
-staging_events_copy = (f"""COPY staging_events FROM '{LOG_DATA}'
-                           credentials 'aws_iam_role={IAM_ROLE_NAME}'
-                           FORMAT AS json '{LOG_JSONPATH}'
-                           compupdate off region '{REGION_NAME}';
+staging_events_copy_template = ("""COPY staging_events FROM '{source}'
+                                   credentials 'aws_iam_role={iam_role}'
+                                   FORMAT AS json '{jsonpath}' {manifest}
+                                   compupdate off region '{region}';
+""")
+
+staging_songs_copy_template = (""" COPY staging_songs FROM '{source}'
+                                   credentials 'aws_iam_role={iam_role}'
+                                   json 'auto' {manifest}
+                                   compupdate off region '{region}';
+""")
+
+def staging_events_copy_from(source, manifest=False):
+    return staging_events_copy_template.format(source=source, iam_role=get_iam_role(), jsonpath=LOG_JSONPATH,
+                                               region=REGION_NAME, manifest='manifest' if manifest else '')
+
+def staging_songs_copy_from(source, manifest=False):
+    return staging_songs_copy_template.format(source=source, iam_role=get_iam_role(),
+                                              region=REGION_NAME, manifest='manifest' if manifest else '')
+
+def __getattr__(name):
+    # The whole-prefix COPYs need the IAM role, so they are only built when first accessed.
+    if name == 'staging_events_copy':
+        return staging_events_copy_from(LOG_DATA)
+    if name == 'staging_songs_copy':
+        return staging_songs_copy_from(SONG_DATA)
+    if name == 'copy_table_queries':
+        return [staging_events_copy_from(LOG_DATA), staging_songs_copy_from(SONG_DATA)]
+    if name == 'IAM_ROLE_NAME':
+        return get_iam_role()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Files written by compaction.py hold the staging columns in table order, already converted to their column types.
+
+compacted_copy_template = ("""COPY {table} FROM '{source}'
+                              credentials 'aws_iam_role={iam_role}'
+                              {format_options} {manifest};
 """)
 
-staging_songs_copy = (f""" COPY staging_songs FROM '{SONG_DATA}'
-                           credentials 'aws_iam_role={IAM_ROLE_NAME}'
-                           json 'auto'
-                           compupdate off region '{REGION_NAME}';
+COMPACTED_FORMAT_OPTIONS = {
+    'parquet': f"FORMAT AS PARQUET region '{REGION_NAME}'",
+    'json': f"json 'auto' GZIP compupdate off region '{REGION_NAME}'",
+    'csv': f"CSV GZIP EMPTYASNULL compupdate off region '{REGION_NAME}'",
+}
+
+def compacted_copy_from(table, compaction_format):
+    '''
+    Returns a COPY query builder, like staging_events_copy_from, for compacted files of the given format.
+    '''
+    def copy_from(source, manifest=False):
+        return compacted_copy_template.format(table=table, source=source, iam_role=get_iam_role(),
+                                              format_options=COMPACTED_FORMAT_OPTIONS[compaction_format],
+                                              manifest='manifest' if manifest else '')
+    return copy_from
+
+staging_events_truncate = "TRUNCATE staging_events"
+staging_songs_truncate = "TRUNCATE staging_songs"
+
+# SONG LOOKUP
+# Songs are matched to events on a hash of their title, artist name and duration, normalized the same
+# way on both sides: trimmed, lower case and rounded to the second. A missing part leaves the key NULL.
+
+def song_key(title, artist, duration):
+    return (f"MD5(LOWER(TRIM({title})) || '|' || LOWER(TRIM({artist})) || '|' "
+            f"|| CAST(CAST(ROUND({duration}) AS bigint) AS varchar))")
+
+STAGING_SONG_KEY = song_key('title', 'artist_name', 'duration')
+EVENT_SONG_KEY = song_key('e.song', 'e.artist', 'e.length')
+
+# Songs sharing a key would duplicate the events matching them, so only the first song_id is kept.
+song_lookup_insert_template = ("""INSERT INTO song_lookup (song_key, song_id, artist_id)
+                                  WITH keyed_songs AS (
+                                      {keyed_songs}
+                                  ), ranked_songs AS (
+                                      SELECT row_number() OVER (PARTITION BY song_key ORDER BY song_id) AS song_rank,
+                                             song_key,
+                                             song_id,
+                                             artist_id
+                                      FROM keyed_songs
+                                      WHERE song_key IS NOT NULL
+                                  )
+                                  SELECT r.song_key,
+                                         r.song_id,
+                                         r.artist_id
+                                  FROM ranked_songs r
+                                  WHERE r.song_rank = 1
+""")
+
+song_lookup_insert = song_lookup_insert_template.format(keyed_songs=f"""SELECT {STAGING_SONG_KEY} AS song_key,
+                                             song_id,
+                                             artist_id
+                                      FROM staging_songs""")
+
+# Fills song_lookup from the songs already loaded when the table is added to an existing warehouse,
+# since the incremental loads only add the songs of newly staged files.
+song_lookup_backfill = song_lookup_insert_template.format(keyed_songs=f"""SELECT {song_key('s.title', 'a.name', 's.duration')} AS song_key,
+                                             s.song_id,
+                                             s.artist_id
+                                      FROM dimSong s
+                                      JOIN dimArtist a ON a.artist_id = s.artist_id""")
+
+song_lookup_merge = song_lookup_insert + """                                    AND NOT EXISTS (SELECT 1 FROM song_lookup l WHERE l.song_key = r.song_key)
+"""
+
+# The match rate of the staged events, against how many a join on the song title alone would have
+# matched, and how many rows its duplicate titles would have added.
+song_match_select = (f"""SELECT COUNT(*),
+                                COUNT(l.song_id),
+                                (SELECT COUNT(*) FROM staging_events e
+                                 WHERE e.page = 'NextSong' AND EXISTS (SELECT 1 FROM dimSong s WHERE s.title = e.song)),
+                                (SELECT COUNT(*) FROM staging_events e
+                                 LEFT JOIN dimSong s ON s.title = e.song
+                                 WHERE e.page = 'NextSong')
+                         FROM staging_events e
+                         LEFT JOIN song_lookup l ON l.song_key = {EVENT_SONG_KEY}
+                         WHERE e.page = 'NextSong'
 """)
 
 # FINAL TABLES
 
-songplay_table_insert = ("""INSERT INTO factSongplay (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
+songplay_table_insert = (f"""INSERT INTO factSongplay (start_time, user_id, level, song_id, artist_id, session_id, item_in_session, location, user_agent)
                             SELECT '1970-01-01'::date + e.ts/1000 * interval '1 second',
                                     e.userId,
                                     e.level,
                                     s.song_id,
                                     s.artist_id,
                                     e.sessionId,
+                                    e.itemInSession,
                                     e.location,
                                     e.userAgent
                             FROM staging_events e
-                            LEFT JOIN staging_songs s ON s.title = e.song
+                            LEFT JOIN song_lookup s ON s.song_key = {EVENT_SONG_KEY}
                             WHERE e.page = 'NextSong'
 """)
 
-user_table_insert = ("""INSERT INTO dimUser (user_id, first_name, last_name, gender, level)
+user_table_insert = ("""INSERT INTO dimUser (user_id, first_name, last_name, gender, level, last_ts)
                         WITH partitioned_data AS (
                             SELECT row_number() OVER (PARTITION by userid ORDER BY ts DESC),
                                     userid,
@@ -151,7 +405,8 @@ user_table_insert = ("""INSERT INTO dimUser (user_id, first_name, last_name, gen
                                firstName,
                                lastName,
                                gender,
-                               level
+                               level,
+                               ts
                         FROM partitioned_data
                         WHERE row_number = 1
 """)
@@ -198,9 +453,289 @@ time_table_insert = ("""INSERT INTO dimTime (start_time, hour, day, week, month,
                         FROM staging_events
 """)
 
+# MERGE QUERIES
+# Used by incremental loads, where the staging tables only hold the newly arrived files.
+
+# A user is only replaced by a newer staged event. Rows loaded before last_ts existed count as older.
+user_table_merge = ["""DELETE FROM dimUser
+                       USING staging_events e
+                       WHERE dimUser.user_id = e.userId
+                         AND (dimUser.last_ts IS NULL OR e.ts > dimUser.last_ts)
+""", user_table_insert + """                          AND NOT EXISTS (SELECT 1 FROM dimUser d WHERE d.user_id = partitioned_data.userid)
+"""]
+
+song_table_merge = ("""INSERT INTO dimSong (song_id, title, artist_id, year, duration)
+                       WITH partitioned_data AS (
+                           SELECT row_number() OVER (PARTITION by song_id),
+                                  song_id,
+                                  title,
+                                  artist_id,
+                                  year,
+                                  duration
+                           FROM staging_songs
+                           WHERE song_id IS NOT NULL
+                       )
+                       SELECT p.song_id,
+                              p.title,
+                              p.artist_id,
+                              p.year,
+                              p.duration
+                       FROM partitioned_data p
+                       WHERE p.row_number = 1
+                         AND NOT EXISTS (SELECT 1 FROM dimSong d WHERE d.song_id = p.song_id)
+""")
+
+artist_table_merge = ("""INSERT INTO dimArtist (artist_id, name, location, latitude, longitude)
+                         WITH partitioned_data AS (
+                           SELECT row_number() OVER (PARTITION by artist_id),
+                                  artist_id,
+                                  artist_name,
+                                  artist_location,
+                                  artist_latitude,
+                                  artist_longitude
+                           FROM staging_songs
+                           WHERE artist_id IS NOT NULL
+                         )
+                         SELECT p.artist_id,
+                                p.artist_name,
+                                p.artist_location,
+                                p.artist_latitude,
+                                p.artist_longitude
+                         FROM partitioned_data p
+                         WHERE p.row_number = 1
+                           AND NOT EXISTS (SELECT 1 FROM dimArtist d WHERE d.artist_id = p.artist_id)
+""")
+
+time_table_merge = ("""INSERT INTO dimTime (start_time, hour, day, week, month, year, weekday)
+                       SELECT t.start_time,
+                              EXTRACT(hour FROM t.start_time)    AS hour,
+                              EXTRACT(day FROM t.start_time)     AS day,
+                              EXTRACT(week FROM t.start_time)    AS week,
+                              EXTRACT(month FROM t.start_time)   AS month,
+                              EXTRACT(year FROM t.start_time)    AS year,
+                              EXTRACT(weekday FROM t.start_time) AS weekday
+                       FROM (SELECT DISTINCT '1970-01-01'::date + ts/1000 * interval '1 second' AS start_time
+                             FROM staging_events) t
+                       WHERE NOT EXISTS (SELECT 1 FROM dimTime d WHERE d.start_time = t.start_time)
+""")
+
+# Events above the watermark cannot be in factSongplay yet, since the song plays and the watermark are committed
+# together (see etl.build_load_graph), so only late-arriving events are checked for duplicates. A song play is
+# identified by its second, user, session and item in the session. A missing session or item matches another
+# missing one, since NULLs never compare equal.
+# Songs are matched against the whole song_lookup, since staging_songs only holds the newly arrived song files.
+songplay_table_append_template = (f"""INSERT INTO factSongplay (start_time, user_id, level, song_id, artist_id, session_id, item_in_session, location, user_agent)
+                                     SELECT '1970-01-01'::date + e.ts/1000 * interval '1 second',
+                                             e.userId,
+                                             e.level,
+                                             s.song_id,
+                                             s.artist_id,
+                                             e.sessionId,
+                                             e.itemInSession,
+                                             e.location,
+                                             e.userAgent
+                                     FROM staging_events e
+                                     LEFT JOIN song_lookup s ON s.song_key = {EVENT_SONG_KEY}
+                                     WHERE e.page = 'NextSong'
+                                       AND (e.ts > {{watermark}}
+                                            OR NOT EXISTS (SELECT 1 FROM factSongplay f
+                                                           WHERE f.start_time = '1970-01-01'::date + e.ts/1000 * interval '1 second'
+                                                             AND f.user_id = e.userId
+                                                             AND COALESCE(f.session_id, -1) = COALESCE(e.sessionId, -1)
+                                                             AND COALESCE(f.item_in_session, -1) = COALESCE(e.itemInSession, -1)))
+""")
+
+watermark_update_template = [f"""DELETE FROM etl_watermark WHERE name = '{EVENTS_WATERMARK}'""",
+                             f"""INSERT INTO etl_watermark (name, value)
+                                 SELECT '{EVENTS_WATERMARK}', GREATEST(COALESCE(MAX(ts), 0), {{watermark}})
+                                 FROM staging_events
+"""]
+
+LOADED_FILES_BATCH_SIZE = 1000
+
+def songplay_table_append(watermark):
+    return songplay_table_append_template.format(watermark=int(watermark))
+
+def watermark_update(watermark):
+    return [query.format(watermark=int(watermark)) for query in watermark_update_template]
+
+def loaded_files_insert(keys, staging_table):
+    '''
+    Returns the INSERT statements recording the given S3 keys as loaded, in batches of LOADED_FILES_BATCH_SIZE rows.
+    '''
+    queries = []
+    for i in range(0, len(keys), LOADED_FILES_BATCH_SIZE):
+        values = ",\n".join("('{}', '{}')".format(key.replace("'", "''"), staging_table)
+                            for key in keys[i:i + LOADED_FILES_BATCH_SIZE])
+        queries.append(f"INSERT INTO etl_loaded_files (s3_key, staging_table) VALUES\n{values}")
+    return queries
+
+# AGGREGATE REFRESH
+# Each aggregate is refreshed with the song plays loaded since the last refresh: they are summarized
+# into a delta table, whose rows are added to the matching aggregate rows or inserted as new ones.
+
+NEW_SONGPLAYS = ("""f.loaded_at > (SELECT COALESCE(MAX(refreshed_through), CAST('1900-01-01' AS timestamp))
+                                   FROM etl_aggregate_watermark)""")
+
+# Maps each aggregate to its key columns and to the query summarizing the new song plays by that key.
+aggregate_deltas = {
+    'agg_hourly_plays':     (['play_hour', 'level'],
+                             f"""SELECT DATE_TRUNC('hour', f.start_time) AS play_hour,
+                                        COALESCE(f.level, 'unknown') AS level,
+                                        COUNT(*) AS plays
+                                 FROM factSongplay f
+                                 WHERE {NEW_SONGPLAYS}
+                                 GROUP BY DATE_TRUNC('hour', f.start_time), COALESCE(f.level, 'unknown')
+"""),
+    'agg_daily_song_plays': (['play_date', 'song_id'],
+                             f"""SELECT CAST(f.start_time AS date) AS play_date,
+                                        f.song_id,
+                                        COUNT(*) AS plays
+                                 FROM factSongplay f
+                                 WHERE {NEW_SONGPLAYS} AND f.song_id IS NOT NULL
+                                 GROUP BY CAST(f.start_time AS date), f.song_id
+"""),
+    'agg_daily_user_plays': (['play_date', 'user_id', 'level'],
+                             f"""SELECT CAST(f.start_time AS date) AS play_date,
+                                        f.user_id,
+                                        COALESCE(f.level, 'unknown') AS level,
+                                        COUNT(*) AS plays
+                                 FROM factSongplay f
+                                 WHERE {NEW_SONGPLAYS}
+                                 GROUP BY CAST(f.start_time AS date), f.user_id, COALESCE(f.level, 'unknown')
+"""),
+}
+
+def aggregate_refresh(table, keys, delta_select):
+    '''
+    Returns the statements adding the song plays summarized by delta_select to the aggregate table.
+    '''
+    matches = ' AND '.join(f"a.{key} = d.{key}" for key in keys)
+    return [f"CREATE TEMP TABLE {table}_delta AS {delta_select}",
+            f"""UPDATE {table} a SET plays = a.plays + d.plays FROM {table}_delta d WHERE {matches}""",
+            f"""INSERT INTO {table} ({', '.join(keys)}, plays)
+                SELECT {', '.join(f'd.{key}' for key in keys)}, d.plays
+                FROM {table}_delta d
+                WHERE NOT EXISTS (SELECT 1 FROM {table} a WHERE {matches})""",
+            f"DROP TABLE {table}_delta"]
+
+aggregate_watermark_update = ["""DELETE FROM etl_aggregate_watermark""",
+                              """INSERT INTO etl_aggregate_watermark (refreshed_through)
+                                 SELECT MAX(loaded_at) FROM factSongplay HAVING MAX(loaded_at) IS NOT NULL
+"""]
+
+aggregate_refresh_queries = [query for table, (keys, delta_select) in aggregate_deltas.items()
+                             for query in aggregate_refresh(table, keys, delta_select)] + aggregate_watermark_update
+
+# STREAMING QUERIES
+# Used by streaming.py to measure each micro-batch: the staged events, and the song plays loaded after a given time.
+
+staged_events_select = ("""SELECT COUNT(*) FROM staging_events""")
+
+songplays_loaded_since_select = ("""SELECT COUNT(*), MAX(loaded_at) FROM factSongplay WHERE loaded_at > %s""")
+
+# EXPORT QUERIES
+# Used by export.py. The tables are exported as Parquet files; factSongplay and dimTime are partitioned
+# by the year and month of their start time. Maps each partitioned table to its (partition column, expression):
+# dimTime partitions on its own columns, which are kept in the files.
+
+export_tables = ['factSongplay', 'dimUser', 'dimSong', 'dimArtist', 'dimTime']
+
+EXPORT_PARTITIONS = {
+    'factSongplay': [('year', "EXTRACT(year FROM start_time)"), ('month', "EXTRACT(month FROM start_time)")],
+    'dimTime':      [('year', 'year'), ('month', 'month')],
+}
+
+# The months of factSongplay holding song plays loaded since the last export, which are the partitions to export again.
+export_watermark_select = ("""SELECT MAX(loaded_at) FROM factSongplay""")
+
+changed_months_select = ("""SELECT DISTINCT DATE_TRUNC('month', start_time) FROM factSongplay WHERE loaded_at > %s""")
+
+unload_template = ("""UNLOAD ('{select}')
+                      TO '{destination}'
+                      credentials 'aws_iam_role={iam_role}'
+                      FORMAT AS PARQUET {partition_by}
+                      MAXFILESIZE {max_file_mb} MB
+                      PARALLEL ON
+                      MANIFEST VERBOSE
+                      CLEANPATH;
+""")
+
+def export_select(table, columns, months=None):
+    '''
+    Returns the query selecting the columns of a table to export, followed by its partition columns.
+    With months, only the rows of those months of start_time are selected.
+    '''
+    select = ', '.join(columns + [f"{expression} AS {name}" for name, expression in EXPORT_PARTITIONS.get(table, [])
+                                  if expression != name])
+    query = f"SELECT {select} FROM {table}"
+    if months is not None:
+        months = ', '.join(f"CAST('{month:%Y-%m-%d}' AS timestamp)" for month in months)
+        query += f" WHERE DATE_TRUNC('month', start_time) IN ({months})"
+    return query
+
+def table_unload(table, columns, destination, max_file_mb, months=None):
+    '''
+    Returns the UNLOAD of a table to Parquet files under the destination prefix, with a manifest of the files.
+
+    The prefix belongs to a single export run, so it is cleaned first, which also clears the files of an
+    UNLOAD that failed and is retried.
+    '''
+    partitions = EXPORT_PARTITIONS.get(table)
+    partition_by = ''
+    if partitions:
+        partition_by = f"PARTITION BY ({', '.join(name for name, _ in partitions)})"
+        if any(name == expression for name, expression in partitions):
+            partition_by += ' INCLUDE'
+    return unload_template.format(select=export_select(table, columns, months).replace("'", "''"),
+                                  destination=destination, iam_role=get_iam_role(), partition_by=partition_by,
+                                  max_file_mb=max_file_mb)
+
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
-copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [user_table_insert, song_table_insert, artist_table_insert, time_table_insert, songplay_table_insert]
\ No newline at end of file
+create_table_queries = [staging_events_table_create, staging_songs_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, song_lookup_table_create, songplay_table_create, hourly_plays_table_create, daily_song_plays_table_create, daily_user_plays_table_create]
+drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, song_lookup_table_drop, hourly_plays_table_drop, daily_song_plays_table_drop, daily_user_plays_table_drop]
+insert_table_queries = [user_table_insert, song_table_insert, artist_table_insert, time_table_insert, song_lookup_insert, songplay_table_insert]
+create_control_table_queries = [loaded_files_table_create, watermark_table_create, schema_versions_table_create, aggregate_watermark_table_create, table_designs_table_create, load_lock_table_create]
+drop_control_table_queries = [loaded_files_table_drop, watermark_table_drop, schema_versions_table_drop, aggregate_watermark_table_drop, table_designs_table_drop]
+truncate_staging_queries = [staging_events_truncate, staging_songs_truncate]
+
+# Queries filling a table from the other tables when a migration adds it to an existing warehouse.
+create_table_backfills = {'song_lookup': [song_lookup_backfill]}
+
+# QUERY DEPENDENCIES
+# Maps each load query to the queries that must finish before it can start.
+# Queries without a path between them in this graph are run concurrently by etl.py.
+# A query may be a list of statements, which are run in order and committed together.
+# The COPY queries are built by etl.py from the staging sources of the execution backend,
+# as one whole-prefix COPY or as several per-file or per-batch COPYs.
+
+load_query_graph = {
+    'staging_events_copy':   (None, []),
+    'staging_songs_copy':    (None, []),
+    'user_table_insert':     (user_table_insert, ['staging_events_copy']),
+    'song_table_insert':     (song_table_insert, ['staging_songs_copy']),
+    'artist_table_insert':   (artist_table_insert, ['staging_songs_copy']),
+    'time_table_insert':     (time_table_insert, ['staging_events_copy']),
+    'song_lookup_insert':    (song_lookup_insert, ['staging_songs_copy']),
+    'songplay_table_insert': (songplay_table_insert, ['staging_events_copy', 'song_lookup_insert',
+                                                      'user_table_insert', 'song_table_insert',
+                                                      'artist_table_insert', 'time_table_insert']),
+}
+
+# Incremental loads merge the staged rows instead of inserting them.
+# The watermark of songplay_table_append is filled in by etl.py, which also records the load state in the
+# same transaction as the song plays.
+
+merge_query_graph = {
+    'staging_events_copy':   (None, []),
+    'staging_songs_copy':    (None, []),
+    'user_table_merge':      (user_table_merge, ['staging_events_copy']),
+    'song_table_merge':      (song_table_merge, ['staging_songs_copy']),
+    'artist_table_merge':    (artist_table_merge, ['staging_songs_copy']),
+    'time_table_merge':      (time_table_merge, ['staging_events_copy']),
+    'song_lookup_merge':     (song_lookup_merge, ['staging_songs_copy']),
+    'songplay_table_append': (songplay_table_append_template, ['staging_events_copy', 'song_lookup_merge',
+                                                               'user_table_merge', 'song_table_merge',
+                                                               'artist_table_merge', 'time_table_merge']),
+}
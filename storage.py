@@ -0,0 +1,85 @@
+import os
+import shutil
+
+S3_SCHEME = 's3://'
+
+
+def is_s3(location):
+    return location.startswith(S3_SCHEME)
+
+
+def join(location, *parts):
+    '''
+    Joins path components onto a local directory or an s3:// prefix.
+    '''
+    if is_s3(location):
+        return '/'.join([location.rstrip('/')] + [part.strip('/') for part in parts])
+    return os.path.join(location, *parts)
+
+
+def list_files(location, aws_manager=None):
+    '''
+    Returns the URI (or path) and size in bytes of every file under a local directory or an s3:// prefix, sorted by name.
+    '''
+    if is_s3(location):
+        return sorted(aws_manager.list_s3_objects(location))
+    files = []
+    for root, _, names in os.walk(location):
+        for name in names:
+            path = os.path.join(root, name)
+            files.append((path, os.path.getsize(path)))
+    return sorted(files)
+
+
+def read_file(uri, aws_manager=None):
+    '''
+    Returns the content of a local file or an S3 object as bytes.
+    '''
+    if is_s3(uri):
+        return aws_manager.get_s3_object(uri)
+    with open(uri, 'rb') as f:
+        return f.read()
+
+
+def write_file(uri, data, aws_manager=None):
+    '''
+    Writes bytes to a local file, creating its directory if needed, or to an S3 object.
+    '''
+    if is_s3(uri):
+        aws_manager.put_s3_object(uri, data)
+        return
+    os.makedirs(os.path.dirname(uri) or '.', exist_ok=True)
+    with open(uri, 'wb') as f:
+        f.write(data)
+
+
+def upload_file(path, uri, aws_manager=None):
+    '''
+    Copies a local file to a local path or an S3 object.
+    '''
+    if is_s3(uri):
+        aws_manager.upload_s3_file(path, uri)
+        return
+    os.makedirs(os.path.dirname(uri) or '.', exist_ok=True)
+    shutil.copyfile(path, uri)
+
+
+def exists(uri, aws_manager=None):
+    '''
+    Returns True if a local file or an S3 object exists.
+    '''
+    if is_s3(uri):
+        return uri in dict(aws_manager.list_s3_objects(uri))
+    return os.path.isfile(uri)
+
+
+def delete(location, aws_manager=None):
+    '''
+    Deletes a local file or directory, or every S3 object under an s3:// prefix. Missing locations are ignored.
+    '''
+    if is_s3(location):
+        aws_manager.delete_s3_objects(location)
+    elif os.path.isdir(location):
+        shutil.rmtree(location)
+    elif os.path.exists(location):
+        os.remove(location)
@@ -0,0 +1,347 @@
+import argparse
+import configparser
+import json
+import os
+import signal
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from time import monotonic, perf_counter
+
+from aggregates import refresh_aggregates
+from backends import get_backend
+from etl import (DEFAULT_LOCK_EXPIRY, acquire_load_lock, build_load_graph, get_load_state, get_lock_owner,
+                 load_tables, prepare_tables, release_load_lock, release_lock_after_failure)
+from sql_queries import (truncate_staging_queries, watermark_select, staged_events_select,
+                         songplays_loaded_since_select)
+
+CONFIG_FILE = 'dwh.cfg'
+RECENT_BATCHES = 100     # batches kept in the metrics
+EPOCH = datetime(1970, 1, 1)
+NO_LOAD_TIME = datetime(1900, 1, 1)
+
+
+class MicroBatcher:
+    '''
+    Groups newly arrived files into micro-batches.
+
+    A batch is due as soon as max_files files or max_bytes bytes are pending, or once the oldest pending
+    file has waited max_latency seconds. It takes the pending files in the order they were first seen,
+    up to max_files files and max_bytes bytes. Files first seen together are taken in name order, which is
+    arrival order for the date-named event logs, with the song files first, so the song plays of a batch
+    can match the songs that arrived with them.
+    '''
+    def __init__(self, max_files, max_bytes, max_latency):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self._pending = {}
+
+    def add(self, table, files, now):
+        '''
+        Adds the (uri, size) files of a staging table, seen at the given monotonic time.
+        Files already pending keep the time they were first seen, with their new size.
+        '''
+        for uri, size in files:
+            self._pending[(table, uri)] = (size, self._pending.get((table, uri), (size, now))[1])
+
+    @property
+    def pending_files(self):
+        return len(self._pending)
+
+    def oldest_wait(self, now):
+        return max((now - seen for _, seen in self._pending.values()), default=0.0)
+
+    def next_batch(self, now, flush=False):
+        '''
+        Removes the next batch from the pending files and returns its (table, uri, size, first seen) files,
+        or an empty list if no batch is due. With flush, any pending file is due.
+        '''
+        pending_bytes = sum(size for size, _ in self._pending.values())
+        if not self._pending or not (flush or len(self._pending) >= self.max_files or
+                                     pending_bytes >= self.max_bytes or self.oldest_wait(now) >= self.max_latency):
+            return []
+        batch, batch_bytes = [], 0
+        order = lambda key: (self._pending[key][1], key[0] != 'staging_songs', key[1])
+        for table, uri in sorted(self._pending, key=order):
+            size, seen = self._pending[(table, uri)]
+            if batch and (len(batch) >= self.max_files or batch_bytes + size > self.max_bytes):
+                break
+            batch.append((table, uri, size, seen))
+            batch_bytes += size
+        for table, uri, _, _ in batch:
+            del self._pending[(table, uri)]
+        return batch
+
+    def restore(self, batch):
+        '''
+        Puts the files of a failed batch back, with the time they were first seen.
+        '''
+        for table, uri, size, seen in batch:
+            self._pending[(table, uri)] = (size, seen)
+
+
+class StreamMetrics:
+    '''
+    Throughput and lag of the micro-batches loaded so far.
+
+    - arrival lag: from when a file was first seen to when its batch was committed
+    - event lag: from the newest event loaded to when its batch was committed, the freshness of factSongplay
+
+    Throughput is given over the whole run and over the time spent loading batches.
+    '''
+    def __init__(self):
+        self.started_at = datetime.utcnow().isoformat()
+        self._start = monotonic()
+        self.totals = {'batches': 0, 'failed_batches': 0, 'files': 0, 'bytes': 0, 'events': 0, 'songplays': 0,
+                       'load_seconds': 0.0}
+        self.batches = deque(maxlen=RECENT_BATCHES)
+
+    def record(self, batch):
+        for key in ['files', 'bytes', 'events', 'songplays']:
+            self.totals[key] += batch[key]
+        self.totals['batches'] += 1
+        self.totals['load_seconds'] += batch['elapsed']
+        self.batches.append(batch)
+
+    def record_failure(self):
+        self.totals['failed_batches'] += 1
+
+    def snapshot(self, pending_files=0):
+        uptime = monotonic() - self._start
+        totals = self.totals
+        load_seconds = totals['load_seconds'] or 1e-9
+        arrival_lags = [batch['max_arrival_lag'] for batch in self.batches]
+        return {'started_at': self.started_at, 'uptime': uptime, 'pending_files': pending_files,
+                'totals': dict(totals),
+                'throughput': {'events_per_second': totals['events'] / uptime if uptime else 0.0,
+                               'mib_per_second': totals['bytes'] / 2**20 / uptime if uptime else 0.0,
+                               'load_events_per_second': totals['events'] / load_seconds,
+                               'load_mib_per_second': totals['bytes'] / 2**20 / load_seconds},
+                'lag': {'last_arrival_lag': arrival_lags[-1] if arrival_lags else None,
+                        'max_arrival_lag': max(arrival_lags, default=None),
+                        'last_event_lag': self.batches[-1]['event_lag'] if self.batches else None},
+                'recent_batches': list(self.batches)}
+
+    def write(self, path, pending_files=0):
+        '''
+        Writes the metrics as JSON, replacing the file at once so readers never see a partial one.
+        '''
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.snapshot(pending_files), f, indent=2)
+        os.replace(path + '.tmp', path)
+
+
+def find_new_files(backend, sources, loaded_keys):
+    '''
+    Returns the (uri, size) JSON files of each staging table that were not loaded yet.
+    Other files are ignored, so a writer can write a file under another name and rename it when complete.
+    '''
+    return {table: [(uri, size) for uri, size in backend.list_files(source)
+                    if uri.endswith('.json') and uri not in loaded_keys[table]]
+            for table, source, _ in sources}
+
+
+def run_batch(backend, sources, batch, loaded_keys, last_loaded_at, max_concurrency, manifest_loader=None,
+              copy_query_group=None, lock_owner=None, lock_expiry=DEFAULT_LOCK_EXPIRY):
+    '''
+    Loads a micro-batch under the load lock: empties the staging tables, copies the batch files into them and
+    merges them into the final tables with the queries of an incremental load, then refreshes the aggregates.
+
+    loaded_keys is first replaced with the load state recorded in the database, and the batch files found
+    there are skipped: etl.py may have loaded them, or an earlier batch whose commit succeeded although
+    its connection failed. The batch files are added to loaded_keys as soon as they are committed, so they
+    are not loaded again if a later step fails.
+
+    Returns the batch metrics and the load time of the newest song play, or None and the given load time
+    if every file of the batch was already loaded.
+    '''
+    start = perf_counter()
+    lock_owner = lock_owner or get_lock_owner('streaming.py')
+    acquire_load_lock(backend, lock_owner, lock_expiry)
+    failed = True
+    try:
+        conn = backend.connect()
+        cur = conn.cursor()
+        for query in truncate_staging_queries:
+            cur.execute(query)
+        conn.commit()
+        recorded_keys, watermark = get_load_state(cur)
+        conn.close()
+        loaded_keys.update(recorded_keys)
+        batch = [(table, uri, size, seen) for table, uri, size, seen in batch if uri not in loaded_keys[table]]
+        if not batch:
+            failed = False
+            return None, last_loaded_at
+
+        new_objects = {table: [(uri, size) for batch_table, uri, size, _ in batch if batch_table == table]
+                       for table, _, _ in sources}
+        graph = build_load_graph(False, sources, new_objects, watermark, manifest_loader)
+        load_tables(graph, backend, max_concurrency, manifest_loader, copy_query_group=copy_query_group, quiet=True)
+        committed = monotonic()
+        committed_at = datetime.utcnow()
+        for table, uri, _, _ in batch:
+            loaded_keys[table].add(uri)
+
+        conn = backend.connect()
+        cur = conn.cursor()
+        cur.execute(staged_events_select)
+        events = cur.fetchone()[0]
+        cur.execute(songplays_loaded_since_select, (last_loaded_at,))
+        songplays, newest_loaded_at = cur.fetchone()
+        cur.execute(watermark_select)
+        row = cur.fetchone()
+        watermark = row[0] if row else 0
+        conn.commit()
+        refresh_aggregates(cur, conn)
+        conn.close()
+        failed = False
+    finally:
+        if failed:
+            release_lock_after_failure(backend, lock_owner)
+        else:
+            release_load_lock(backend, lock_owner)
+
+    newest_event = EPOCH + timedelta(milliseconds=int(watermark)) if watermark else None
+    stats = {'committed_at': committed_at.isoformat(), 'files': len(batch), 'bytes': sum(size for _, _, size, _ in batch),
+             'events': events, 'songplays': songplays, 'elapsed': perf_counter() - start,
+             'max_arrival_lag': max(committed - seen for _, _, _, seen in batch),
+             'event_lag': (committed_at - newest_event).total_seconds() if newest_event else None}
+    return stats, newest_loaded_at or last_loaded_at
+
+
+def print_batch(number, stats, pending_files):
+    print(f"Batch {number}: {stats['files']} file(s) ({stats['bytes'] / 2**20:.1f} MiB), {stats['events']} events, "
+          f"{stats['songplays']} song plays in {stats['elapsed']:.1f}s "
+          f"({stats['events'] / (stats['elapsed'] or 1e-9):.0f} events/s), "
+          f"arrival lag {stats['max_arrival_lag']:.1f}s, "
+          f"event lag {'-' if stats['event_lag'] is None else format(stats['event_lag'], '.0f') + 's'}, "
+          f"{pending_files} file(s) pending")
+
+
+def print_summary(metrics, pending_files):
+    snapshot = metrics.snapshot(pending_files)
+    totals, throughput = snapshot['totals'], snapshot['throughput']
+    print(f"Loaded {totals['files']} file(s), {totals['events']} events and {totals['songplays']} song plays "
+          f"in {totals['batches']} batch(es), {totals['failed_batches']} failed, over {snapshot['uptime']:.0f}s "
+          f"({throughput['events_per_second']:.0f} events/s, {throughput['load_events_per_second']:.0f} events/s "
+          f"while loading).\n")
+
+
+def run_streaming(backend=None, drain=False, max_batches=None, metrics_file=None, stop=None):
+    '''
+    Watches the staging sources, LOG_DATA and SONG_DATA, for new files and loads them in micro-batches,
+    until stopped with Ctrl+C, SIGTERM or the stop event.
+
+    The sources are polled every POLL_INTERVAL seconds, and the new files are batched as set in the
+    [STREAMING] section of dwh.cfg: by count (BATCH_MAX_FILES), size (BATCH_MAX_MB) or the time the
+    oldest file has waited (BATCH_MAX_LATENCY). Each batch holds the load lock, so it never runs while
+    etl.py loads. A failed batch is retried at the next poll, except for the files it committed: the
+    song plays of a failed load are rolled back together with the record of its files, and the
+    dimension merges only add or update the rows of the staged data, so loading the files again is safe.
+
+    With drain, the files already there are loaded in as many batches as needed, then the run ends.
+    With max_batches, it ends after that many batches. The throughput and lag metrics are printed for
+    each batch, and written to the metrics file, or to METRICS_FILE in the [STREAMING] section, if set.
+    '''
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+
+    POLL_INTERVAL          = config.getfloat("STREAMING", "POLL_INTERVAL", fallback=5)
+    BATCH_MAX_FILES        = config.getint("STREAMING", "BATCH_MAX_FILES", fallback=100)
+    BATCH_MAX_MB           = config.getfloat("STREAMING", "BATCH_MAX_MB", fallback=64)
+    BATCH_MAX_LATENCY      = config.getfloat("STREAMING", "BATCH_MAX_LATENCY", fallback=60)
+    METRICS_FILE           = metrics_file or config.get("STREAMING", "METRICS_FILE", fallback="")
+    MAX_CONCURRENCY        = config.getint("ETL", "MAX_CONCURRENCY", fallback=4)
+    COPY_QUERY_GROUP       = config.get("CONNECTION", "COPY_QUERY_GROUP", fallback="")
+    LOAD_LOCK_EXPIRY       = config.getfloat("ETL", "LOAD_LOCK_EXPIRY", fallback=DEFAULT_LOCK_EXPIRY)
+
+    if backend is None:
+        backend = get_backend(config)
+    if stop is None:
+        stop = threading.Event()
+
+    lock_owner = get_lock_owner('streaming.py')
+    acquire_load_lock(backend, lock_owner, LOAD_LOCK_EXPIRY)
+    try:
+        conn = backend.connect()
+        cur = conn.cursor()
+        prepare_tables(cur, conn, backend.name == 'redshift')
+        loaded_keys, _ = get_load_state(cur)
+        cur.execute(songplays_loaded_since_select, (NO_LOAD_TIME,))
+        last_loaded_at = cur.fetchone()[1] or NO_LOAD_TIME
+        manifest_loader = backend.get_manifest_loader(cur)
+        conn.commit()
+        conn.close()
+    except Exception:
+        release_lock_after_failure(backend, lock_owner)
+        raise
+    release_load_lock(backend, lock_owner)
+
+    sources = backend.get_staging_sources()
+    batcher = MicroBatcher(BATCH_MAX_FILES, BATCH_MAX_MB * 2**20, BATCH_MAX_LATENCY)
+    metrics = StreamMetrics()
+    print(f"Watching {', '.join(source for _, source, _ in sources)} for new files. Press Ctrl+C to stop.")
+    try:
+        while not stop.is_set():
+            now = monotonic()
+            for table, files in find_new_files(backend, sources, loaded_keys).items():
+                batcher.add(table, files, now)
+            batch = batcher.next_batch(now, flush=drain)
+            if not batch:
+                if drain and not batcher.pending_files:
+                    break
+                # Wake up in time for the latency limit of the oldest pending file.
+                wait = POLL_INTERVAL
+                if batcher.pending_files:
+                    wait = min(wait, max(0.0, BATCH_MAX_LATENCY - batcher.oldest_wait(monotonic())))
+                stop.wait(wait)
+                continue
+
+            try:
+                stats, last_loaded_at = run_batch(backend, sources, batch, loaded_keys, last_loaded_at,
+                                                  MAX_CONCURRENCY, manifest_loader, COPY_QUERY_GROUP or None,
+                                                  lock_owner, LOAD_LOCK_EXPIRY)
+            except Exception as e:
+                # The files committed before the failure are not retried.
+                batcher.restore([(table, uri, size, seen) for table, uri, size, seen in batch
+                                 if uri not in loaded_keys[table]])
+                metrics.record_failure()
+                if drain:
+                    raise
+                print(f"Batch of {len(batch)} file(s) failed ({str(e).strip().splitlines()[0]}), "
+                      f"retrying in {POLL_INTERVAL:g}s")
+                stop.wait(POLL_INTERVAL)
+                continue
+
+            if stats is None:
+                continue
+            metrics.record(stats)
+            print_batch(metrics.totals['batches'], stats, batcher.pending_files)
+            if METRICS_FILE:
+                metrics.write(METRICS_FILE, batcher.pending_files)
+            if max_batches and metrics.totals['batches'] >= max_batches:
+                break
+    except KeyboardInterrupt:
+        print("Stopping.")
+    finally:
+        backend.close()
+    print_summary(metrics, batcher.pending_files)
+    return metrics
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Continuously loads new Sparkify event files in micro-batches.")
+    parser.add_argument('--backend', choices=['redshift', 'duckdb', 'postgres'],
+                        help="execution backend, defaults to BACKEND in the [ETL] section of dwh.cfg")
+    parser.add_argument('--drain', action='store_true', help="load the files already there, then stop")
+    parser.add_argument('--max-batches', type=int, help="stop after this many batches")
+    parser.add_argument('--metrics', help="write the metrics to this JSON file after every batch, "
+                                          "defaults to METRICS_FILE in the [STREAMING] section of dwh.cfg")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    run_streaming(get_backend(config, args.backend), args.drain, args.max_batches, args.metrics, stop)
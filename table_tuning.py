@@ -0,0 +1,310 @@
+import argparse
+import configparser
+import json
+from time import perf_counter
+
+from backends import STAGING_TABLES, RedshiftBackend
+from manifest_loader import get_slice_count
+from migrations import (TableDesign, deep_copy_statements, get_declared_design, get_identity_seed, parse_table_ddl,
+                        render_table_ddl)
+from sql_queries import create_table_queries, table_designs_table_create, table_design_delete, table_design_insert
+
+CONFIG_FILE = 'dwh.cfg'
+
+table_info_select = ("""SELECT "table", diststyle, sortkey1, size, tbl_rows, skew_rows, unsorted, stats_off
+                        FROM svv_table_info
+                        WHERE schema = 'public'
+""")
+
+table_columns_select = ("""SELECT "column", encoding, distkey, sortkey
+                           FROM pg_table_def
+                           WHERE schemaname = 'public' AND tablename = %s
+                           ORDER BY sortkey
+""")
+
+# Number of distinct values and rows of the most frequent value of a column, to estimate the skew of a DISTKEY.
+column_distribution_select = ("""SELECT COUNT(*), MAX(value_rows)
+                                 FROM (SELECT {column}, COUNT(*) AS value_rows FROM {table} GROUP BY {column}) AS v
+""")
+
+# Analytics queries timed before and after the new design is applied.
+REPRESENTATIVE_QUERIES = {
+    'top_songs': ("""SELECT s.title, a.name, COUNT(*) AS plays
+                     FROM factSongplay f
+                     JOIN dimSong s ON s.song_id = f.song_id
+                     JOIN dimArtist a ON a.artist_id = f.artist_id
+                     GROUP BY s.title, a.name
+                     ORDER BY plays DESC
+                     LIMIT 10
+    """),
+    'plays_by_hour': ("""SELECT t.hour, COUNT(*) AS plays
+                         FROM factSongplay f
+                         JOIN dimTime t ON t.start_time = f.start_time
+                         GROUP BY t.hour
+                         ORDER BY t.hour
+    """),
+    'paid_users_last_month': ("""SELECT u.user_id, COUNT(*) AS plays
+                                 FROM factSongplay f
+                                 JOIN dimUser u ON u.user_id = f.user_id
+                                 WHERE f.level = 'paid'
+                                   AND f.start_time >= (SELECT DATEADD(month, -1, MAX(start_time)) FROM factSongplay)
+                                 GROUP BY u.user_id
+                                 ORDER BY plays DESC
+                                 LIMIT 10
+    """),
+    'sessions_per_user': ("""SELECT user_id, COUNT(DISTINCT session_id) AS sessions
+                             FROM factSongplay
+                             GROUP BY user_id
+    """),
+}
+
+def get_table_info(cur):
+    '''
+    Returns the SVV_TABLE_INFO row of every table of the public schema, keyed by table name.
+    '''
+    cur.execute(table_info_select)
+    columns = [column[0] for column in cur.description]
+    return {row[0]: dict(zip(columns, row)) for row in cur.fetchall()}
+
+
+def get_current_design(cur, table, table_info):
+    '''
+    Returns the current TableDesign of a table, read from its SVV_TABLE_INFO row and PG_TABLE_DEF.
+    '''
+    cur.execute(table_columns_select, (table,))
+    columns = cur.fetchall()
+    distkey = next((column for column, _, is_distkey, _ in columns if is_distkey), None)
+    sortkey = [column for column, _, _, position in sorted(columns, key=lambda column: column[3]) if position > 0]
+    # SVV_TABLE_INFO reports e.g. 'ALL', 'EVEN', 'KEY(user_id)' or 'AUTO(ALL)'.
+    diststyle = (table_info.get(table, {}).get('diststyle') or 'even').split('(')[0].lower()
+    encodings = {column: 'raw' if encoding == 'none' else encoding for column, encoding, _, _ in columns}
+    return TableDesign(table, diststyle, distkey, sortkey, encodings)
+
+
+def get_compression(cur, table):
+    '''
+    Returns the encoding recommended by ANALYZE COMPRESSION for each column of the table.
+    '''
+    cur.execute(f"ANALYZE COMPRESSION {table}")
+    return {column: encoding for _, column, encoding, _ in cur.fetchall()}
+
+
+def estimate_distribution_skew(cur, table, column, rows, slice_count):
+    '''
+    Estimates how many times more rows the fullest slice would hold than the average one with the column as DISTKEY.
+
+    Values are assumed to hash evenly, so the skew comes from the most frequent value and from having
+    fewer distinct values than slices.
+    '''
+    if not rows:
+        return 1.0
+    cur.execute(column_distribution_select.format(table=table, column=column))
+    distinct_values, top_value_rows = cur.fetchone()
+    average_slice_rows = rows / slice_count
+    fullest_slice_rows = max(top_value_rows, rows / max(min(distinct_values, slice_count), 1))
+    return max(fullest_slice_rows / average_slice_rows, 1.0)
+
+
+def recommend_designs(tables, table_info, compression, skews, dist_all_max_rows, max_dist_skew):
+    '''
+    Recommends a TableDesign for every parsed table.
+
+    - tables referenced by another table (dimensions) are copied to every node while they are small
+      enough, otherwise distributed and sorted on their primary key
+    - tables referencing others (facts) are distributed on the reference to the largest distributed
+      table, if its skew is acceptable, so that join is collocated. They are sorted on their timestamp.
+    - other tables with a primary key are copied to every node while small
+    - staging tables are spread evenly and left unsorted, since they are scanned whole once per load
+    - other tables without a primary key (aggregates) keep their declared distribution style and sort key
+    - encodings come from ANALYZE COMPRESSION, except that the leading sort key column stays raw so
+      range-restricted scans can skip blocks as precisely as possible
+
+    table_info, compression and skews hold the SVV_TABLE_INFO row, the ANALYZE COMPRESSION result
+    and the {column: estimated skew} of the candidate distribution keys of each table.
+    '''
+    referenced = {reference.lower() for table in tables for reference in table['references'].values()}
+    rows = {name: info['tbl_rows'] for name, info in table_info.items()}
+    designs = {}
+
+    for table in sorted(tables, key=lambda table: bool(table['references'])):
+        name = table['table'].lower()
+        primary_key = table['primary_key'].lower() if table['primary_key'] else None
+        if table['references']:
+            candidates = sorted(((column.lower(), reference.lower()) for column, reference in table['references'].items()
+                                 if designs[reference.lower()].diststyle == 'key'),
+                                key=lambda candidate: rows.get(candidate[1], 0), reverse=True)
+            distkey = next((column for column, _ in candidates
+                            if skews.get(name, {}).get(column, float('inf')) <= max_dist_skew), None)
+            timestamps = [column.lower() for column, column_type, _ in table['columns'] if column_type.lower() == 'timestamp']
+            sortkey = timestamps[:1] or ([primary_key] if primary_key else [])
+            diststyle = 'key' if distkey else 'even'
+        elif primary_key and (name not in referenced or rows.get(name, 0) <= dist_all_max_rows):
+            diststyle, distkey, sortkey = 'all', None, [primary_key]
+        elif primary_key:
+            diststyle, distkey, sortkey = 'key', primary_key, [primary_key]
+        elif name in STAGING_TABLES:
+            diststyle, distkey, sortkey = 'even', None, []
+        else:
+            declared = get_declared_design(table)
+            diststyle, distkey, sortkey = declared.diststyle, declared.distkey, declared.sortkey
+
+        encodings = dict(compression.get(name, {}))
+        if sortkey:
+            encodings[sortkey[0]] = 'raw'
+        designs[name] = TableDesign(name, diststyle, distkey, sortkey, encodings)
+    return designs
+
+
+def alter_statements(current, design):
+    '''
+    Returns the ALTER TABLE statements changing a table from its current design to the new one.
+    Each of them must run outside of a transaction block.
+    '''
+    statements = []
+    if (current.diststyle, current.distkey) != (design.diststyle, design.distkey):
+        if design.diststyle == 'key':
+            statements.append(f"ALTER TABLE {design.table} ALTER DISTSTYLE KEY DISTKEY {design.distkey}")
+        else:
+            statements.append(f"ALTER TABLE {design.table} ALTER DISTSTYLE {design.diststyle.upper()}")
+    if current.sortkey != design.sortkey:
+        sortkey = f"({', '.join(design.sortkey)})" if design.sortkey else 'NONE'
+        statements.append(f"ALTER TABLE {design.table} ALTER SORTKEY {sortkey}")
+    changed = [f"ALTER COLUMN {column} ENCODE {encoding}" for column, encoding in design.encodings.items()
+               if current.encodings.get(column) != encoding and column not in design.sortkey]
+    if changed:
+        statements.append(f"ALTER TABLE {design.table} " + ', '.join(changed))
+    return statements
+
+
+def record_design_statements(design):
+    '''
+    Returns the (statement, parameters) recording a design applied to its table in etl_table_designs,
+    which the schema migration reads to keep the design when it rebuilds the table.
+    '''
+    return [(table_design_delete.format(table=design.table), None),
+            (table_design_insert, (design.table, design.diststyle, design.distkey, ','.join(design.sortkey),
+                                   json.dumps(design.encodings, sort_keys=True)))]
+
+
+def time_queries(cur, queries, repeat=3):
+    '''
+    Returns the best wall time of each query over repeat runs, with the result cache disabled.
+    '''
+    cur.execute("SET enable_result_cache_for_session TO off")
+    timings = {}
+    for name, query in queries.items():
+        elapsed = []
+        for _ in range(repeat):
+            start = perf_counter()
+            cur.execute(query)
+            cur.fetchall()
+            elapsed.append(perf_counter() - start)
+        timings[name] = min(elapsed)
+    return timings
+
+
+def print_comparison(before, after):
+    print(f"{'':<30}{'before':>12}{'after':>12}")
+    for table in sorted(before['tables']):
+        print(f"{table + ' (MB)':<30}{before['tables'][table]['size']:>12}{after['tables'].get(table, {}).get('size', 0):>12}")
+        print(f"{table + ' (skew)':<30}{before['tables'][table]['skew_rows'] or 0:>12.2f}"
+              f"{after['tables'].get(table, {}).get('skew_rows') or 0:>12.2f}")
+    for query in before['queries']:
+        print(f"{query + ' (s)':<30}{before['queries'][query]:>12.3f}{after['queries'][query]:>12.3f}")
+    print()
+
+
+def measure(cur, tables):
+    table_info = get_table_info(cur)
+    return {'tables': {name: table_info[name] for name in tables if name in table_info},
+            'queries': time_queries(cur, REPRESENTATIVE_QUERIES)}
+
+
+def run_tuning(apply=None, output=None):
+    '''
+    Recommends a distribution style, sort key and column encodings for every table of create_table_queries,
+    from the statistics of the loaded tables. Run it after a load.
+
+    With apply='alter' or apply='deep-copy', the recommendations are applied to the tables that differ,
+    and the table sizes and representative query times before and after are compared. A deep copy is
+    the rebuild of migrations.py, which adds the references to a rebuilt table back.
+    Each applied design is recorded in etl_table_designs, in the transaction of a deep copy or right after
+    the ALTER TABLE statements, so that the schema migration keeps it when it rebuilds the table.
+    '''
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+
+    DIST_ALL_MAX_ROWS      = config.getint("TUNING", "DIST_ALL_MAX_ROWS", fallback=3000000)
+    MAX_DIST_SKEW          = config.getfloat("TUNING", "MAX_DIST_SKEW", fallback=1.5)
+
+    backend = RedshiftBackend(config)
+    conn = backend.connect()
+    # ANALYZE COMPRESSION and ALTER TABLE ... ALTER DISTKEY/SORTKEY/ENCODE can't run in a transaction block.
+    conn.autocommit = True
+    cur = conn.cursor()
+    slice_count = get_slice_count(*backend.aws_manager.get_cluster_size(), cur)
+
+    tables = [parse_table_ddl(query) for query in create_table_queries]
+    table_info = get_table_info(cur)
+    compression, skews = {}, {}
+    for table in tables:
+        name = table['table'].lower()
+        rows = table_info.get(name, {}).get('tbl_rows', 0)
+        if rows:
+            compression[name] = get_compression(cur, name)
+        skews[name] = {column.lower(): estimate_distribution_skew(cur, name, column, rows, slice_count)
+                       for column in table['references']}
+    designs = recommend_designs(tables, table_info, compression, skews, DIST_ALL_MAX_ROWS, MAX_DIST_SKEW)
+
+    changes = {}
+    for table in tables:
+        name = table['table'].lower()
+        statements = alter_statements(get_current_design(cur, name, table_info), designs[name])
+        if statements and apply == 'deep-copy':
+            columns = [column.lower() for column, _, _ in table['columns']]
+            statements = deep_copy_statements(table, columns, True, get_identity_seed(cur, table), design=designs[name])
+        changes[name] = statements
+        print(f"{name}: diststyle {designs[name].diststyle}"
+              + (f" distkey {designs[name].distkey}" if designs[name].distkey else '')
+              + (f" sortkey {', '.join(designs[name].sortkey)}" if designs[name].sortkey else '')
+              + (f", {len(statements)} change(s)" if statements else ', already tuned'))
+        print(render_table_ddl(table, designs[name]) + '\n')
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({name: {**design._asdict(), 'changes': changes[name]} for name, design in designs.items()}, f, indent=2)
+        print(f"Recommendations written to {output}\n")
+
+    if apply:
+        cur.execute(table_designs_table_create)
+        before = measure(cur, designs)
+        for name, statements in changes.items():
+            if not statements:
+                continue
+            print(f"Tuning {name}. Please wait...")
+            start = perf_counter()
+            if apply == 'alter':
+                for statement in statements:
+                    cur.execute(statement)
+                statements = []
+            conn.autocommit = False
+            for statement in statements:
+                cur.execute(statement)
+            for statement, parameters in record_design_statements(designs[name]):
+                cur.execute(statement, parameters)
+            conn.commit()
+            conn.autocommit = True
+            print(f"  {name} tuned in {perf_counter() - start:.1f}s")
+        cur.execute("ANALYZE")
+        print_comparison(before, measure(cur, designs))
+        print("The applied designs were recorded in etl_table_designs, so the schema migration keeps them.\n")
+    conn.close()
+    return designs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recommends and applies distribution styles, sort keys and encodings.")
+    parser.add_argument('--apply', choices=['alter', 'deep-copy'], help="apply the recommendations with ALTER TABLE or a deep copy")
+    parser.add_argument('--output', help="write the recommendations to this JSON file")
+    args = parser.parse_args()
+    run_tuning(apply=args.apply, output=args.output)
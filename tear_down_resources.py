@@ -1,14 +1,21 @@
+import argparse
 from aws_manager import AWSManager
 
-def tear_down_resources():
+def tear_down_resources(final_snapshot=False):
     '''
     Cleanup phase - tears down all create AWS resources during this ETL process.
+    With final_snapshot, the cluster is snapshotted before being deleted, so it can be restored later.
     '''
     aws_manager = AWSManager()
     print("Deleting IAM Role & Attached Policy.")
     aws_manager.delete_iam_role()
     print("Deleting Cluster. This may take a few minutes to reflect in your account.")
-    aws_manager.delete_cluster()
-    
+    snapshot_identifier = aws_manager.delete_cluster(final_snapshot)
+    if snapshot_identifier:
+        print(f"Final snapshot: {snapshot_identifier}. Set SNAPSHOT_IDENTIFIER=latest in dwh.cfg to restore from it.")
+
 if __name__ == '__main__':
-    tear_down_resources()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Deletes the Redshift cluster and its IAM role.")
+    parser.add_argument('--snapshot', action='store_true', help="take a final snapshot of the cluster before deleting it")
+    args = parser.parse_args()
+    tear_down_resources(final_snapshot=args.snapshot)
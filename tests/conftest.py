@@ -0,0 +1,66 @@
+import configparser
+import os
+import uuid
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The pipeline modules read dwh.cfg from the working directory when they are imported.
+os.chdir(REPO_ROOT)
+
+
+@pytest.fixture
+def aws_manager(tmp_path, monkeypatch):
+    '''
+    An AWSManager whose AWS calls go to moto, configured by a copy of dwh.cfg with test credentials.
+    '''
+    moto = pytest.importorskip('moto')
+    from aws_manager import AWSManager
+
+    for name in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN']:
+        monkeypatch.setenv(name, 'testing')
+    config = configparser.ConfigParser()
+    config.read(os.path.join(REPO_ROOT, 'dwh.cfg'))
+    config.set('AWS', 'KEY', 'testing')
+    config.set('AWS', 'SECRET', 'testing')
+    config.set('CLUSTER', 'METADATA_CACHE', '')
+    config_file = str(tmp_path / 'dwh.cfg')
+    with open(config_file, 'w') as f:
+        config.write(f)
+    # The IAM role is given an AWS managed policy, which moto only knows when asked to load them.
+    with moto.mock_aws(config={'iam': {'load_aws_managed_policies': True}}):
+        yield AWSManager(config_file)
+
+
+@pytest.fixture
+def postgres_backend(tmp_path, tmp_path_factory):
+    '''
+    A PostgresBackend working in a schema of its own, dropped afterwards, on the server given by the
+    SPARKIFY_TEST_POSTGRES_DSN environment variable, and loading the files of tmp_path. Skipped when it is not set.
+    '''
+    dsn = os.environ.get('SPARKIFY_TEST_POSTGRES_DSN')
+    if not dsn:
+        pytest.skip('SPARKIFY_TEST_POSTGRES_DSN is not set')
+    psycopg2 = pytest.importorskip('psycopg2')
+    from backends import PostgresBackend
+
+    # The server reads the data files itself, and may run as another user.
+    readable = tmp_path
+    while readable != tmp_path_factory.getbasetemp().parent.parent:
+        os.chmod(readable, os.stat(readable).st_mode | 0o055)
+        readable = readable.parent
+
+    schema = f'sparkify_test_{uuid.uuid4().hex[:12]}'
+    admin = psycopg2.connect(dsn)
+    admin.autocommit = True
+    admin.cursor().execute(f'CREATE SCHEMA {schema}')
+    backend = PostgresBackend(f"{dsn} options='-c search_path={schema}'", str(tmp_path / 'log_data'),
+                              str(tmp_path / 'song_data'))
+    try:
+        yield backend
+    finally:
+        backend.close()
+        admin.cursor().execute(f'DROP SCHEMA {schema} CASCADE')
+        admin.close()
+
@@ -0,0 +1,35 @@
+import json
+import os
+
+# Event timestamps of the sample data, in milliseconds: 2018-11-01 00:00:00 UTC.
+START_TS = 1541030400000
+
+
+def make_event(ts, user_id=1, level='free', session_id=1, song='Song A', artist='Artist A', length=200.0,
+               page='NextSong', item_in_session=0):
+    '''
+    Returns an event log record, with the keys of the Sparkify log files.
+    '''
+    return {'artist': artist, 'auth': 'Logged In', 'firstName': 'Lily', 'gender': 'F', 'itemInSession': item_in_session,
+            'lastName': 'Koch', 'length': length, 'level': level, 'location': 'Chicago', 'method': 'PUT',
+            'page': page, 'registration': 1540000000000, 'sessionId': session_id, 'song': song, 'status': 200,
+            'ts': ts, 'userAgent': 'Mozilla/5.0', 'userId': user_id}
+
+
+def make_song(song_id, title, artist_id, artist_name, duration=200.0):
+    '''
+    Returns a song file record, with the keys of the Sparkify song files.
+    '''
+    return {'artist_id': artist_id, 'artist_latitude': None, 'artist_location': '', 'artist_longitude': None,
+            'artist_name': artist_name, 'duration': duration, 'num_songs': 1, 'song_id': song_id, 'title': title,
+            'year': 2000}
+
+
+def write_records(path, records):
+    '''
+    Writes the records as a newline-delimited JSON file, like the Sparkify data files.
+    '''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write('\n'.join(json.dumps(record) for record in records) + '\n')
+    return path
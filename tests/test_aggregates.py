@@ -0,0 +1,91 @@
+import pytest
+
+from aggregates import activity_by_level, aggregates_are_fresh, plays_per_hour, refresh_aggregates, top_songs
+from backends import DuckDBBackend
+from sql_queries import NEW_SONGPLAYS, aggregate_deltas
+
+from tests.sample_data import START_TS, make_event, make_song, write_records
+from tests.test_incremental_load import fetch, run_load
+
+HOUR = 3600 * 1000
+DAY = 24 * HOUR
+
+
+@pytest.fixture(params=['duckdb', 'postgres'])
+def backend(request, tmp_path):
+    '''
+    An empty warehouse on a local directory of log and song files, with two songs.
+    '''
+    write_records(str(tmp_path / 'song_data' / 'A.json'), [make_song('S1', 'Song A', 'AR1', 'Artist A'),
+                                                           make_song('S2', 'Song B', 'AR1', 'Artist A')])
+    if request.param == 'duckdb':
+        pytest.importorskip('duckdb')
+        backend = DuckDBBackend(':memory:', str(tmp_path / 'log_data'), str(tmp_path / 'song_data'))
+    else:
+        backend = request.getfixturevalue('postgres_backend')
+    yield backend
+    if request.param == 'duckdb':
+        backend.close()
+
+
+def load_and_refresh(backend, tmp_path, name, events, refresh=True):
+    write_records(str(tmp_path / 'log_data' / name), events)
+    run_load(backend)
+    if refresh:
+        conn = backend.connect()
+        refresh_aggregates(conn.cursor(), conn)
+        conn.close()
+
+
+def raw_aggregate(table):
+    '''
+    Returns the query summarizing every song play of factSongplay like the aggregate table.
+    '''
+    keys, delta_select = aggregate_deltas[table]
+    return f"SELECT * FROM ({delta_select.replace(NEW_SONGPLAYS, '1 = 1')}) r ORDER BY {', '.join(keys)}"
+
+
+def query(backend, function, *args, **kwargs):
+    conn = backend.connect()
+    try:
+        return function(conn.cursor(), *args, **kwargs)
+    finally:
+        conn.close()
+
+
+def test_refreshed_aggregates_match_the_song_plays(backend, tmp_path):
+    load_and_refresh(backend, tmp_path, '1.json', [make_event(START_TS), make_event(START_TS + 60 * 1000),
+                                                   make_event(START_TS + HOUR, user_id=2, level='paid',
+                                                              song='Song B')])
+    # Plays adding to existing aggregate rows, a new song and level of a user, a new day, and an unknown song.
+    load_and_refresh(backend, tmp_path, '2.json', [make_event(START_TS + 120 * 1000),
+                                                   make_event(START_TS + HOUR + 1000, song='Song B', level='paid'),
+                                                   make_event(START_TS + DAY, user_id=2, level='paid'),
+                                                   make_event(START_TS + DAY + 1000, song='Unknown')])
+
+    for table, (keys, _) in aggregate_deltas.items():
+        columns = ', '.join(keys + ['plays'])
+        assert fetch(backend, f"SELECT {columns} FROM {table} ORDER BY {', '.join(keys)}") == \
+            fetch(backend, raw_aggregate(table)), table
+    assert fetch(backend, "SELECT SUM(plays) FROM agg_hourly_plays") == [(7,)]
+    assert fetch(backend, "SELECT plays FROM agg_daily_song_plays WHERE song_id = 'S1' "
+                          "AND play_date = CAST('2018-11-01' AS date)") == [(3,)]
+
+
+def test_queries_are_routed_to_fresh_aggregates_only(backend, tmp_path):
+    load_and_refresh(backend, tmp_path, '1.json', [make_event(START_TS), make_event(START_TS + HOUR, level='paid')])
+    assert query(backend, aggregates_are_fresh)
+
+    for function, args in [(plays_per_hour, ['2018-11-01']), (top_songs, ['2018-11-01']),
+                           (activity_by_level, ['2018-11-01', '2018-11-02'])]:
+        rows, source = query(backend, function, *args)
+        raw_rows, raw_source = query(backend, function, *args, use_aggregates=False)
+        assert (source, raw_source) == ('aggregate', 'raw')
+        assert rows and rows == raw_rows, function.__name__
+
+    # Song plays loaded since the last refresh are only in factSongplay.
+    load_and_refresh(backend, tmp_path, '2.json', [make_event(START_TS + 2 * HOUR)], refresh=False)
+    assert not query(backend, aggregates_are_fresh)
+    rows, source = query(backend, top_songs, '2018-11-01')
+    assert (rows, source) == ([('Song A', 'Artist A', 3)], 'raw')
+    assert query(backend, top_songs, '2018-11-01', check_freshness=False)[0] == [('Song A', 'Artist A', 2)]
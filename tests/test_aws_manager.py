@@ -0,0 +1,85 @@
+import pytest
+
+import aws_manager as aws_manager_module
+
+IAM_ROLE = 'arn:aws:iam::123456789012:role/myRedshiftRole'
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    '''
+    Records the delays between status polls instead of sleeping.
+    '''
+    delays = []
+    monkeypatch.setattr(aws_manager_module, 'sleep', delays.append)
+    return delays
+
+
+def create_snapshot(aws_manager, snapshot_identifier):
+    aws_manager.create_cluster(IAM_ROLE)
+    aws_manager._redshift.create_cluster_snapshot(SnapshotIdentifier=snapshot_identifier,
+                                                  ClusterIdentifier=aws_manager._DWH_CLUSTER_IDENTIFIER)
+
+
+def test_restore_cluster_from_latest_snapshot(aws_manager, sleeps):
+    assert aws_manager.find_cluster_snapshot() is None
+    aws_manager._SNAPSHOT_IDENTIFIER = 'latest'
+    assert aws_manager.find_cluster_snapshot() is None
+
+    create_snapshot(aws_manager, 'sparkify-1')
+    create_snapshot(aws_manager, 'sparkify-2')
+    assert aws_manager.find_cluster_snapshot() == 'sparkify-2'
+
+    aws_manager.delete_cluster()
+    assert aws_manager.get_cluster(refresh=True) is None
+    aws_manager.restore_cluster('sparkify-2', IAM_ROLE)
+    aws_manager.wait_for_cluster_status('available')
+    assert aws_manager.get_cluster_size() == ('dc2.large', 4)
+
+
+def test_find_cluster_snapshot_by_name(aws_manager):
+    aws_manager._SNAPSHOT_IDENTIFIER = 'nightly'
+    assert aws_manager.find_cluster_snapshot() == 'nightly'
+
+
+def test_wait_for_cluster_size(aws_manager, sleeps, monkeypatch):
+    aws_manager.create_cluster(IAM_ROLE)
+    assert aws_manager.wait_for_cluster_size('dc2.large', 4) >= 0
+    assert not sleeps
+
+    # moto does not implement elastic resize, so the polled metadata goes through one.
+    get_cluster = aws_manager.get_cluster
+    sizes = iter([('available', 4), ('resizing', 4), ('resizing', 2), ('available', 2)])
+
+    def resizing_cluster(refresh=False):
+        status, num_nodes = next(sizes)
+        return dict(get_cluster(refresh), ClusterStatus=status, NumberOfNodes=num_nodes)
+
+    monkeypatch.setattr(aws_manager, 'get_cluster', resizing_cluster)
+    aws_manager.wait_for_cluster_size('dc2.large', 2)
+    assert len(sleeps) == 3
+
+
+def test_wait_backs_off_with_equal_jitter(aws_manager, sleeps, monkeypatch):
+    statuses = iter(['creating'] * 6 + ['available'])
+    monkeypatch.setattr(aws_manager, 'get_cluster', lambda refresh=False: {'ClusterStatus': next(statuses)})
+    aws_manager.wait_for_cluster_status('available')
+
+    assert len(sleeps) == 6
+    for attempt, delay in enumerate(sleeps):
+        cap = min(aws_manager_module.MAX_SLEEP_TIME, aws_manager_module.SLEEP_TIME * 2 ** attempt)
+        assert cap / 2 <= delay <= cap
+
+
+def test_wait_times_out(aws_manager, sleeps, monkeypatch):
+    monkeypatch.setattr(aws_manager, 'get_cluster', lambda refresh=False: {'ClusterStatus': 'resizing'})
+    clock = iter(range(0, 1000, 20))
+    monkeypatch.setattr(aws_manager_module, 'time', lambda: next(clock))
+    with pytest.raises(TimeoutError, match="still 'resizing'"):
+        aws_manager.wait_for_cluster_status('available', timeout=100)
+    assert sleeps and all(delay <= 100 for delay in sleeps)
+
+
+def test_wait_for_missing_cluster(aws_manager, sleeps):
+    with pytest.raises(RuntimeError, match='does not exist'):
+        aws_manager.wait_for_cluster_status('available')
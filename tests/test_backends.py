@@ -0,0 +1,110 @@
+import re
+
+import pytest
+
+from backends import DuckDBBackend, translate_to_duckdb
+from maintenance import get_table_health, run_maintenance
+from sql_queries import songplay_table_create
+
+from tests.sample_data import START_TS, make_event, write_records
+
+
+def normalize(statement):
+    return re.sub(r'\s+', ' ', statement).strip()
+
+
+def test_duckdb_rewrites():
+    rewrites = {
+        "SELECT getdate()": "SELECT current_timestamp",
+        "SELECT ts/1000 FROM staging_events": "SELECT ts//1000 FROM staging_events",
+        "SELECT row_number() OVER (PARTITION BY userid ORDER BY ts DESC), userid FROM staging_events":
+            "SELECT row_number() OVER (PARTITION BY userid ORDER BY ts DESC) AS row_number, userid FROM staging_events",
+        "SELECT row_number() OVER (ORDER BY ts) AS rank FROM staging_events":
+            "SELECT row_number() OVER (ORDER BY ts) AS rank FROM staging_events",
+        "LOCK etl_load_lock": "SELECT COUNT(*) FROM etl_load_lock",
+        "VACUUM DELETE ONLY factSongplay": "VACUUM factSongplay",
+        "VACUUM SORT ONLY factSongplay": "VACUUM factSongplay",
+        "CREATE TABLE IF NOT EXISTS t (a varchar(10) PRIMARY KEY sortkey distkey, b int REFERENCES u (b) encode az64, "
+        "c float) diststyle key compound sortkey (a, b)":
+            "CREATE TABLE IF NOT EXISTS t (a varchar(10) , b int , c double)",
+    }
+    for statement, translated in rewrites.items():
+        assert [normalize(query) for query in translate_to_duckdb(statement)] == [translated]
+
+
+def test_duckdb_identity_column_uses_a_sequence():
+    sequence, create = translate_to_duckdb(songplay_table_create)
+    assert sequence == ('CREATE SEQUENCE IF NOT EXISTS factsongplay_songplay_id_seq '
+                        'INCREMENT BY 1 MINVALUE 0 START WITH 0')
+    assert "songplay_id int DEFAULT nextval('factsongplay_songplay_id_seq')" in create
+    assert 'current_timestamp' in create and 'REFERENCES' not in create
+
+
+@pytest.fixture(params=['duckdb', 'postgres'])
+def backend(request, tmp_path):
+    if request.param == 'duckdb':
+        pytest.importorskip('duckdb')
+        backend = DuckDBBackend(':memory:', str(tmp_path / 'log_data'), str(tmp_path / 'song_data'))
+    else:
+        backend = request.getfixturevalue('postgres_backend')
+    yield backend
+    if request.param == 'duckdb':
+        backend.close()
+
+
+def test_malformed_value_fails_the_copy(backend, tmp_path):
+    conn = backend.connect()
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS staging_events (artist varchar, auth varchar, firstName varchar, "
+                "gender varchar, itemInSession int, lastName varchar, length float, level varchar, "
+                "location varchar, method varchar, page varchar, registration bigint, sessionId int, "
+                "song varchar, status int, ts bigint, userAgent varchar, userId int)")
+    conn.commit()
+    copy_from = dict((table, copy) for table, _, copy in backend.get_staging_sources())['staging_events']
+
+    good = write_records(str(tmp_path / 'log_data' / '1.json'), [dict(make_event(START_TS), userId='')])
+    cur.execute(copy_from(good))
+    conn.commit()
+    cur.execute("SELECT COUNT(*), COUNT(userId) FROM staging_events")
+    assert cur.fetchone() == (1, 0)
+
+    bad = write_records(str(tmp_path / 'log_data' / '2.json'), [dict(make_event(START_TS), userId='guest')])
+    with pytest.raises(Exception):
+        cur.execute(copy_from(bad))
+    conn.rollback()
+    conn.close()
+
+
+def test_duckdb_table_health_follows_the_changes(tmp_path):
+    pytest.importorskip('duckdb')
+    backend = DuckDBBackend(':memory:', str(tmp_path / 'log_data'), str(tmp_path / 'song_data'))
+    conn = backend.connect()
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE plays (id int, plays int)")
+    cur.execute("INSERT INTO plays SELECT range, 1 FROM range(10)")
+    conn.commit()
+    assert get_table_health(cur, ['plays']) == {'plays': {'stats_off': 100.0, 'unsorted': 0.0, 'deleted': 0.0}}
+
+    cur.execute("ANALYZE plays")
+    cur.execute("DELETE FROM plays WHERE id < 2")
+    cur.execute("UPDATE plays SET plays = 2 WHERE id = 9")
+    conn.commit()
+    # The deleted and the updated rows are left behind until a vacuum.
+    assert get_table_health(cur, ['plays']) == {'plays': {'stats_off': 3 / 7 * 100, 'unsorted': 0.0,
+                                                          'deleted': 30.0}}
+    conn.close()
+
+    assert set(run_maintenance(backend, ['plays'], 10, 10, 10)) == {'plays'}
+    conn = backend.connect()
+    assert get_table_health(conn.cursor(), ['plays'])['plays']['stats_off'] == 0.0
+    assert get_table_health(conn.cursor(), ['plays'])['plays']['deleted'] == 0.0
+    conn.close()
+    # A dropped table starts over.
+    conn = backend.connect()
+    cur = conn.cursor()
+    cur.execute("DROP TABLE plays")
+    cur.execute("CREATE TABLE plays (id int, plays int)")
+    cur.execute("SELECT COUNT(*) FROM local_table_changes WHERE table_name = 'plays'")
+    assert cur.fetchone() == (0,)
+    conn.close()
+    backend.close()
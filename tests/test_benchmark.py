@@ -0,0 +1,66 @@
+import json
+
+import pytest
+
+from benchmark import STAGES, find_regressions, run_benchmark
+
+from tests.sample_data import START_TS, make_event, make_song, write_records
+
+HOUR = 3600 * 1000
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    '''
+    A data directory with a few log and song files.
+    '''
+    pytest.importorskip('duckdb')
+    data_dir = tmp_path / 'small'
+    write_records(str(data_dir / 'song_data' / 'A.json'), [make_song('S1', 'Song A', 'AR1', 'Artist A')])
+    write_records(str(data_dir / 'song_data' / 'B.json'), [make_song('S2', 'Song B', 'AR2', 'Artist B')])
+    write_records(str(data_dir / 'log_data' / '1.json'), [make_event(START_TS), make_event(START_TS + HOUR)])
+    write_records(str(data_dir / 'log_data' / '2.json'), [make_event(START_TS + 2 * HOUR, song='Song B',
+                                                                     artist='Artist B')])
+    return str(data_dir)
+
+
+def test_report(data_dir, tmp_path, capsys):
+    output = str(tmp_path / 'report.json')
+    assert run_benchmark([data_dir], output, max_concurrency=2) == []
+    with open(output) as f:
+        report = json.load(f)
+
+    [run] = report['runs']
+    assert run['data'] == data_dir
+    assert run['input_files'] == 4
+    assert set(run['stages']) == set(STAGES)
+    assert run['rows']['factSongplay'] == 3 and run['rows']['dimSong'] == 2
+    assert {build: stats['rows'] for build, stats in run['fact_builds'].items()} == {'title_join': 3, 'song_lookup': 3}
+    assert set(run['analytics_queries']) == {'freshness_check', 'plays_per_hour', 'top_songs', 'activity_by_level'}
+    assert f"Report written to {output}" in capsys.readouterr().out
+
+
+def test_regressions_against_a_baseline(data_dir, tmp_path, capsys):
+    output = str(tmp_path / 'report.json')
+    run_benchmark([data_dir], output, max_concurrency=2)
+    with open(output) as f:
+        baseline = json.load(f)
+    # Every stage was instant in the baseline, and the copy stage was not measured.
+    baseline['runs'][0]['stages'] = {stage: 1e-9 for stage in STAGES if stage != 'copy'}
+    baseline_file = str(tmp_path / 'baseline.json')
+    with open(baseline_file, 'w') as f:
+        json.dump(baseline, f)
+
+    regressions = run_benchmark([data_dir], str(tmp_path / 'new_report.json'), max_concurrency=2,
+                                baseline=baseline_file)
+    assert [regression.split(':')[0] for regression in regressions] == [f"{data_dir} {stage}" for stage in STAGES
+                                                                        if stage != 'copy']
+    assert capsys.readouterr().out.count('Regression: ') == len(STAGES) - 1
+
+
+def test_find_regressions():
+    report = {'runs': [{'data': 'small', 'stages': {'copy': 1.3, 'insert': 1.1, 'drop': 0.1}},
+                       {'data': 'new', 'stages': {'copy': 9.0}}]}
+    baseline = {'runs': [{'data': 'small', 'stages': {'copy': 1.0, 'insert': 1.0, 'create': 0.1}}]}
+    assert find_regressions(report, baseline, 0.2) == ['small copy: 1.000s -> 1.300s']
+    assert find_regressions(report, baseline, 0.5) == []
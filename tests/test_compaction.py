@@ -0,0 +1,92 @@
+import gzip
+import json
+import os
+
+import pytest
+
+import compaction
+import sql_queries
+import storage
+from tests.sample_data import START_TS, make_event, write_records
+
+# Small enough that every few raw files close a chunk.
+CHUNK_MB = 2000 / 2**20
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    source = str(tmp_path / 'log_data')
+    for n in range(10):
+        events = [make_event(START_TS + n * 1000 + i, user_id=n) for i in range(3)]
+        write_records(os.path.join(source, f'events-{n:02d}.json'), events)
+    return source, str(tmp_path / 'compacted')
+
+
+def run_compaction(source, destination):
+    return compaction.compact('staging_events', source, destination, 'json', CHUNK_MB, workers=1)
+
+
+def read_chunks(destination):
+    records = []
+    for uri, _ in storage.list_files(os.path.join(destination, 'staging_events')):
+        with gzip.open(uri, 'rt') as f:
+            records.extend(json.loads(line) for line in f)
+    return records
+
+
+def test_rerun_compacts_only_new_files(dirs):
+    source, destination = dirs
+    stats = run_compaction(source, destination)
+    assert stats['input_files'] == 10
+    assert stats['output_files'] > 1
+    assert len(read_chunks(destination)) == 30
+
+    assert run_compaction(source, destination)['input_files'] == 0
+    write_records(os.path.join(source, 'events-10.json'), [make_event(START_TS + 99000, user_id=10)])
+    assert run_compaction(source, destination)['input_files'] == 1
+    assert len(read_chunks(destination)) == 31
+
+
+def test_failed_run_does_not_duplicate_records(dirs, monkeypatch):
+    source, destination = dirs
+    upload_file = storage.upload_file
+    uploads = []
+
+    def failing_upload(path, uri, aws_manager=None):
+        upload_file(path, uri, aws_manager)
+        uploads.append(uri)
+        if len(uploads) == 2:
+            raise OSError('connection reset')
+
+    # The second chunk is copied, but the run fails before recording it.
+    monkeypatch.setattr(storage, 'upload_file', failing_upload)
+    with pytest.raises(OSError):
+        run_compaction(source, destination)
+    monkeypatch.setattr(storage, 'upload_file', upload_file)
+
+    stats = run_compaction(source, destination)
+    assert 0 < stats['input_files'] < 10
+    records = read_chunks(destination)
+    assert len(records) == 30
+    assert len({(record['userid'], record['ts']) for record in records}) == 30
+
+
+def test_state_is_consolidated_and_pruned(dirs):
+    source, destination = dirs
+    run_compaction(source, destination)
+    state_dir = os.path.join(destination, compaction.STATE_DIR, 'staging_events')
+    assert os.listdir(state_dir) == [compaction.STATE_FILE]
+
+    os.remove(os.path.join(source, 'events-00.json'))
+    run_compaction(source, destination)
+    compacted = compaction.read_compacted_sources(state_dir)
+    assert len(compacted) == 9
+    assert os.path.join(source, 'events-00.json') not in compacted
+
+
+@pytest.mark.parametrize('compaction_format', sorted(sql_queries.COMPACTED_FORMAT_OPTIONS))
+def test_compacted_copy_names_the_bucket_region(compaction_format, monkeypatch):
+    monkeypatch.setattr(sql_queries, '_iam_role', 'arn:aws:iam::123456789012:role/myRedshiftRole')
+    copy = sql_queries.compacted_copy_from('staging_events', compaction_format)('s3://sparkify/compacted/', manifest=True)
+    assert f"region '{sql_queries.REGION_NAME}'" in copy
+    assert copy.rstrip().endswith('manifest;')
@@ -0,0 +1,108 @@
+import pytest
+
+from connections import backoff_delay, is_transient
+from scheduler import run_query_graph
+
+psycopg2 = pytest.importorskip('psycopg2')
+
+# Fails with the given SQLSTATE the first `failures` times it runs, counting its runs in attempts_seq.
+FAIL_FIRST = """DO $$ BEGIN
+                    IF nextval('attempts_seq') <= {failures} THEN
+                        RAISE EXCEPTION '{message}' USING ERRCODE = '{sqlstate}';
+                    END IF;
+                END $$"""
+KILL_FIRST = "SELECT CASE WHEN nextval('attempts_seq') = 1 THEN pg_terminate_backend(pg_backend_pid()) END"
+INSERT = "INSERT INTO songs_played VALUES (1)"
+
+
+@pytest.fixture
+def backend(postgres_backend):
+    conn = postgres_backend.connect()
+    cur = conn.cursor()
+    cur.execute("CREATE SEQUENCE attempts_seq")
+    cur.execute("CREATE TABLE songs_played (song_id int)")
+    conn.commit()
+    conn.close()
+    return postgres_backend
+
+
+def fetch(backend, query):
+    conn = backend.connect()
+    cur = conn.cursor()
+    cur.execute(query)
+    value = cur.fetchone()[0]
+    conn.close()
+    return value
+
+
+def run_insert(backend, first_statement, connect=None, max_retries=3):
+    graph = {'insert': ([first_statement, INSERT], [])}
+    run_query_graph(graph, connect or backend.connect, max_retries=max_retries, retry_backoff=0)
+
+
+def test_transient_failure_is_retried(backend):
+    run_insert(backend, FAIL_FIRST.format(failures=2, message='could not serialize access', sqlstate='40001'))
+    assert fetch(backend, "SELECT last_value FROM attempts_seq") == 3
+    assert fetch(backend, "SELECT COUNT(*) FROM songs_played") == 1
+
+
+def test_lost_connection_is_retried(backend):
+    run_insert(backend, KILL_FIRST)
+    assert fetch(backend, "SELECT last_value FROM attempts_seq") == 2
+    assert fetch(backend, "SELECT COUNT(*) FROM songs_played") == 1
+
+
+def test_other_failures_are_not_retried(backend):
+    with pytest.raises(psycopg2.Error, match='division by zero'):
+        run_insert(backend, FAIL_FIRST.format(failures=1, message='division by zero', sqlstate='22012'))
+    assert fetch(backend, "SELECT last_value FROM attempts_seq") == 1
+
+
+def test_retries_are_bounded(backend):
+    with pytest.raises(psycopg2.Error):
+        run_insert(backend, FAIL_FIRST.format(failures=5, message='deadlock detected', sqlstate='40P01'),
+                   max_retries=2)
+    assert fetch(backend, "SELECT last_value FROM attempts_seq") == 3
+    assert fetch(backend, "SELECT COUNT(*) FROM songs_played") == 0
+
+
+class LostAtCommit:
+    '''
+    A connection whose commit goes through, but whose answer is lost.
+    '''
+    def __init__(self, conn):
+        self._conn = conn
+
+    def commit(self):
+        self._conn.commit()
+        raise psycopg2.OperationalError('server closed the connection unexpectedly')
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def test_failure_at_commit_is_not_retried(backend):
+    with pytest.raises(psycopg2.OperationalError):
+        run_insert(backend, "SELECT 1", connect=lambda: LostAtCommit(backend.connect()))
+    assert fetch(backend, "SELECT COUNT(*) FROM songs_played") == 1
+
+
+def test_wlm_cancellations_are_transient(backend):
+    conn = backend.connect()
+    cur = conn.cursor()
+    errors = []
+    for message in ["Query (1234) cancelled on user's request and ran out of wlm queues for restarts.",
+                    'Query (1234) cancelled by WLM abort action of Query Monitoring Rule',
+                    'canceling statement due to statement timeout']:
+        with pytest.raises(psycopg2.Error) as error:
+            cur.execute(FAIL_FIRST.format(failures=100, message=message.replace("'", "''"), sqlstate='57014'))
+        conn.rollback()
+        errors.append(error.value)
+    conn.close()
+    assert [is_transient(error) for error in errors] == [True, True, False]
+
+
+def test_backoff_delay_has_a_floor():
+    for attempt in range(8):
+        cap = min(30.0, 2 ** attempt)
+        assert all(cap / 2 <= backoff_delay(attempt, 1.0) <= cap for _ in range(50))
@@ -0,0 +1,97 @@
+import pytest
+
+from backends import DuckDBBackend
+from data_quality import run_quality_checks
+
+from tests.sample_data import START_TS, make_event, make_song, write_records
+from tests.test_incremental_load import run_load
+
+DAY = 24 * 3600 * 1000
+
+
+@pytest.fixture(params=['duckdb', 'postgres'])
+def backend(request, tmp_path):
+    '''
+    A warehouse with one day of song plays loaded, and the events of the next day staged and loaded.
+    '''
+    write_records(str(tmp_path / 'song_data' / 'A.json'), [make_song('S1', 'Song A', 'AR1', 'Artist A')])
+    if request.param == 'duckdb':
+        pytest.importorskip('duckdb')
+        backend = DuckDBBackend(':memory:', str(tmp_path / 'log_data'), str(tmp_path / 'song_data'))
+    else:
+        backend = request.getfixturevalue('postgres_backend')
+    write_records(str(tmp_path / 'log_data' / '1.json'), [make_event(START_TS)])
+    run_load(backend)
+    write_records(str(tmp_path / 'log_data' / '2.json'), [make_event(START_TS + DAY, user_id=2)])
+    run_load(backend)
+    yield backend
+    if request.param == 'duckdb':
+        backend.close()
+
+
+def execute(backend, *queries):
+    conn = backend.connect()
+    cur = conn.cursor()
+    for query in queries:
+        cur.execute(query)
+    conn.commit()
+    conn.close()
+
+
+def check(backend, scoped=True):
+    conn = backend.connect()
+    try:
+        report = run_quality_checks(conn.cursor(), scoped=scoped)
+    finally:
+        conn.close()
+    return {(c['table'], c['check'], c['column']): c for c in report['checks']}, report
+
+
+def test_checks_pass_on_a_clean_load(backend):
+    checks, report = check(backend)
+    assert report['passed'], [c for c in checks.values() if not c['passed']]
+    # Only the song plays and timestamps of the staged day are read.
+    assert report['row_counts']['factSongplay'] == 1
+    assert report['row_counts']['dimTime'] == 1
+    assert check(backend, scoped=False)[1]['row_counts']['factSongplay'] == 2
+
+
+def test_scoped_checks_read_only_the_staged_rows(backend):
+    # A duplicate timestamp and an orphan song play of the previous day, outside the staged range.
+    execute(backend,
+            "INSERT INTO dimTime (start_time, hour, day, week, month, year, weekday) "
+            "SELECT start_time, hour, day, week, month, year, weekday FROM dimTime "
+            "WHERE start_time < '2018-11-02'",
+            "UPDATE factSongplay SET user_id = 99 WHERE start_time < '2018-11-02'")
+    checks, report = check(backend)
+    assert report['passed']
+
+    checks, report = check(backend, scoped=False)
+    assert not checks[('dimTime', 'unique_keys', 'start_time')]['passed']
+    assert not checks[('factSongplay', 'foreign_keys', 'user_id')]['passed']
+
+
+def test_scoped_checks_catch_the_staged_rows(backend):
+    execute(backend,
+            "INSERT INTO dimTime (start_time, hour, day, week, month, year, weekday) "
+            "SELECT start_time, hour, day, week, month, year, weekday FROM dimTime "
+            "WHERE start_time >= '2018-11-02'",
+            "INSERT INTO dimUser (user_id, first_name, last_name, gender, level) "
+            "VALUES (2, 'Lily', 'Koch', 'F', 'paid')",
+            "UPDATE factSongplay SET song_id = 'S9' WHERE start_time >= '2018-11-02'")
+    checks, report = check(backend)
+    assert not checks[('dimTime', 'unique_keys', 'start_time')]['passed']
+    assert checks[('dimUser', 'unique_keys', 'user_id')]['value'] == 1
+    assert not checks[('factSongplay', 'foreign_keys', 'song_id')]['passed']
+
+
+def test_song_plays_without_a_session_are_reconciled(backend, tmp_path):
+    write_records(str(tmp_path / 'log_data' / '3.json'), [make_event(START_TS + 2 * DAY, session_id=None),
+                                                          make_event(START_TS + 2 * DAY, item_in_session=1)])
+    run_load(backend)
+    checks, report = check(backend)
+    assert checks[('factSongplay', 'row_counts', None)]['rows'] == 2
+    assert checks[('factSongplay', 'row_counts', None)]['value'] == 0
+
+    execute(backend, "DELETE FROM factSongplay WHERE session_id IS NULL")
+    assert check(backend)[0][('factSongplay', 'row_counts', None)]['value'] == 1
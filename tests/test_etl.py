@@ -0,0 +1,86 @@
+import pytest
+
+import etl
+from backends import DuckDBBackend
+
+from tests.sample_data import START_TS, make_event, make_song, write_records
+
+
+class FakeAWSManager:
+    '''
+    Stands in for the AWSManager of the redshift backend, recording the resizes of its cluster.
+    '''
+    def __init__(self, node_type, num_nodes):
+        self.size = (node_type, num_nodes)
+        self.resizes = []
+
+    def get_cluster_size(self):
+        return self.size
+
+    def resize_cluster(self, node_type=None, num_nodes=None):
+        if (node_type, num_nodes) == self.size:
+            return False
+        self.resizes.append((node_type, num_nodes))
+        self.size = (node_type, num_nodes)
+        return True
+
+    def wait_for_cluster_size(self, node_type, num_nodes):
+        assert self.size == (node_type, num_nodes)
+
+
+@pytest.fixture
+def backend(tmp_path):
+    '''
+    A local warehouse on a log and a song file, whose cluster is resized by a FakeAWSManager.
+    '''
+    pytest.importorskip('duckdb')
+    write_records(str(tmp_path / 'song_data' / 'A.json'), [make_song('S1', 'Song A', 'AR1', 'Artist A')])
+    write_records(str(tmp_path / 'log_data' / '1.json'), [make_event(START_TS)])
+    backend = DuckDBBackend(':memory:', str(tmp_path / 'log_data'), str(tmp_path / 'song_data'))
+    backend.aws_manager = FakeAWSManager('ra3.xlplus', 2)
+    yield backend
+    backend.close()
+
+
+def fetch(backend, query):
+    conn = backend.connect()
+    cur = conn.cursor()
+    cur.execute(query)
+    rows = cur.fetchall()
+    conn.close()
+    return rows
+
+
+def test_cluster_is_resized_for_the_load_and_back(backend, monkeypatch, capsys):
+    sizes = []
+    load_tables = etl.load_tables
+
+    def recording_load_tables(*args, **kwargs):
+        sizes.append(backend.aws_manager.size)
+        return load_tables(*args, **kwargs)
+
+    monkeypatch.setattr(etl, 'load_tables', recording_load_tables)
+    etl.run_etl(backend=backend, load_num_nodes=4, maintenance=False, quality=False)
+
+    assert sizes == [('ra3.xlplus', 4)]
+    assert backend.aws_manager.resizes == [('ra3.xlplus', 4), ('ra3.xlplus', 2)]
+    assert fetch(backend, "SELECT COUNT(*) FROM factSongplay") == [(1,)]
+    assert 'Load window:' in capsys.readouterr().out
+
+
+def test_cluster_is_resized_back_when_the_load_fails(backend, monkeypatch):
+    def failing_load_tables(*args, **kwargs):
+        raise RuntimeError('COPY failed')
+
+    monkeypatch.setattr(etl, 'load_tables', failing_load_tables)
+    with pytest.raises(RuntimeError, match='COPY failed'):
+        etl.run_etl(backend=backend, load_num_nodes=4, load_node_type='ra3.4xlarge', maintenance=False,
+                    quality=False)
+    assert backend.aws_manager.resizes == [('ra3.4xlarge', 4), ('ra3.xlplus', 2)]
+    assert fetch(backend, "SELECT COUNT(*) FROM etl_load_lock") == [(0,)]
+
+
+def test_resizing_requires_an_aws_manager(backend):
+    del backend.aws_manager
+    with pytest.raises(ValueError, match='requires the redshift backend'):
+        etl.run_etl(backend=backend, load_num_nodes=4)
@@ -0,0 +1,100 @@
+import json
+import os
+from datetime import datetime
+
+import pytest
+
+import export
+import sql_queries
+import storage
+from backends import DuckDBBackend
+from migrations import migrate_schema
+
+IAM_ROLE = 'arn:aws:iam::123456789012:role/myRedshiftRole'
+
+
+def test_table_unload_renders_a_partitioned_parquet_unload(monkeypatch):
+    monkeypatch.setattr(sql_queries, '_iam_role', IAM_ROLE)
+    months = [datetime(2018, 11, 1), datetime(2018, 12, 1)]
+    unload = sql_queries.table_unload('factSongplay', ['songplay_id', 'start_time'], 's3://sparkify/runs/1/factSongplay/',
+                                      256, months)
+    assert ' '.join(unload.split()) == (
+        "UNLOAD ('SELECT songplay_id, start_time, EXTRACT(year FROM start_time) AS year, "
+        "EXTRACT(month FROM start_time) AS month FROM factSongplay "
+        "WHERE DATE_TRUNC(''month'', start_time) IN (CAST(''2018-11-01'' AS timestamp), "
+        "CAST(''2018-12-01'' AS timestamp))') "
+        "TO 's3://sparkify/runs/1/factSongplay/' "
+        f"credentials 'aws_iam_role={IAM_ROLE}' "
+        "FORMAT AS PARQUET PARTITION BY (year, month) MAXFILESIZE 256 MB PARALLEL ON MANIFEST VERBOSE CLEANPATH;")
+
+    # dimTime's partitions are columns of the table, which are kept in the files.
+    unload = sql_queries.table_unload('dimTime', ['start_time', 'year', 'month'], 's3://sparkify/dimTime/', 64)
+    assert "UNLOAD ('SELECT start_time, year, month FROM dimTime')" in unload
+    assert 'PARTITION BY (year, month) INCLUDE' in unload
+    assert "WHERE" not in unload
+
+
+@pytest.fixture
+def backend(tmp_path):
+    pytest.importorskip('duckdb')
+    pytest.importorskip('pyarrow')
+    backend = DuckDBBackend(':memory:', str(tmp_path / 'log_data'), str(tmp_path / 'song_data'))
+    conn = backend.connect()
+    migrate_schema(conn.cursor(), conn)
+    conn.close()
+    yield backend
+    backend.close()
+
+
+def add_song_plays(backend, start_times, loaded_at):
+    conn = backend.connect()
+    cur = conn.cursor()
+    for start_time in start_times:
+        cur.execute("INSERT INTO factSongplay (start_time, user_id, user_agent, loaded_at) "
+                    "VALUES (%s, 1, 'Mozilla/5.0', %s)", (start_time, loaded_at))
+    conn.commit()
+    conn.close()
+
+
+def read_manifest(destination):
+    with open(os.path.join(destination, export.MANIFEST_FILE)) as f:
+        return json.load(f)
+
+
+def songplay_urls(manifest):
+    return [entry['url'] for entry in manifest['tables']['factSongplay']['entries']]
+
+
+def test_changed_months_replace_their_files_after_the_manifest(backend, tmp_path, monkeypatch):
+    destination = str(tmp_path / 'export')
+    add_song_plays(backend, ['2018-10-05', '2018-11-05'], '2018-11-06')
+    export.export_tables_to(backend, destination)
+    first = read_manifest(destination)
+    assert len(songplay_urls(first)) == 2
+
+    # A failed export leaves the previous manifest, and every file it lists, in place.
+    add_song_plays(backend, ['2018-11-20'], '2018-11-21')
+    stream_table = export.stream_table
+
+    def failing_stream_table(conn, table, *args, **kwargs):
+        entries = stream_table(conn, table, *args, **kwargs)
+        if table == 'dimUser':
+            raise RuntimeError('connection lost')
+        return entries
+
+    monkeypatch.setattr(export, 'stream_table', failing_stream_table)
+    with pytest.raises(RuntimeError):
+        export.export_tables_to(backend, destination, changed_only=True)
+    assert read_manifest(destination) == first
+    assert all(os.path.exists(url) for url in songplay_urls(first))
+
+    monkeypatch.setattr(export, 'stream_table', stream_table)
+    stats = export.export_tables_to(backend, destination, changed_only=True)
+    assert {table_stats['table']: table_stats['records'] for table_stats in stats}['factSongplay'] == 2
+
+    second = read_manifest(destination)
+    october, november = sorted(songplay_urls(second), key=lambda url: 'month=11' in url)
+    assert october == [url for url in songplay_urls(first) if 'month=10' in url][0]
+    assert 'month=11' in november and november not in songplay_urls(first)
+    listed = {entry['url'] for table in second['tables'].values() for entry in table['entries']}
+    assert {uri for uri, _ in storage.list_files(destination)} == listed | {os.path.join(destination, 'manifest.json')}
@@ -0,0 +1,60 @@
+import json
+import os
+import re
+
+import pytest
+
+pytest.importorskip('numpy')
+
+import generate_data
+import storage
+
+MAX_FILE_BYTES = 20000
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    monkeypatch.setattr(generate_data, '_catalog', generate_data.generate_catalog(50, 300, 100, 1.0, 1.2, 0))
+    monkeypatch.setattr(generate_data, '_aws_manager', None)
+
+
+def part_number(uri):
+    '''
+    Returns the position of a file among the parts of its day: events.json comes first, then events-1.json.
+    '''
+    return int(re.search(r'-events(?:-(\d+))?\.json$', uri[0]).group(1) or 0)
+
+
+def generate_day(log_data):
+    total, files, written = generate_data.generate_events(0, 200, 1, log_data, MAX_FILE_BYTES)
+    uris = sorted(storage.list_files(log_data), key=part_number)
+    assert (files, written) == (len(uris), sum(size for _, size in uris))
+    return total, uris
+
+
+def test_events_are_written_in_chunks_to_files_of_bounded_size(catalog, monkeypatch, tmp_path):
+    total, uris = generate_day(str(tmp_path / 'default'))
+    sizes = [size for _, size in uris]
+    assert len(uris) > 1 and all(size >= MAX_FILE_BYTES for size in sizes[:-1])
+
+    events = []
+    for uri, size in uris:
+        with open(uri) as f:
+            lines = f.read().splitlines()
+        events.extend(json.loads(line) for line in lines)
+        # A file ends with the line that took it past MAX_FILE_BYTES.
+        assert size - len(lines[-1]) - 1 < MAX_FILE_BYTES
+    assert len(events) == total
+    assert [event['ts'] for event in events] == sorted(event['ts'] for event in events)
+    assert all(event['song'] and event['length'] > 0 and event['method'] == 'PUT'
+               for event in events if event['page'] == 'NextSong')
+    guests = [event for event in events if event['auth'] == 'Logged Out']
+    assert guests and all(event['userId'] == '' and event['firstName'] is None for event in guests)
+
+    # Chunks smaller than a file, and not dividing the events evenly, write the same files.
+    monkeypatch.setattr(generate_data, 'EVENT_CHUNK', 37)
+    assert generate_day(str(tmp_path / 'small_chunks')) == (total, [(uri.replace('default', 'small_chunks'), size)
+                                                                    for uri, size in uris])
+    for uri, _ in uris:
+        with open(uri) as f, open(uri.replace('default', 'small_chunks')) as g:
+            assert f.read() == g.read(), os.path.basename(uri)
@@ -0,0 +1,132 @@
+import pytest
+
+from backends import DuckDBBackend
+from etl import build_load_graph, get_load_state, load_tables, prepare_tables
+
+from tests.sample_data import START_TS, make_event, make_song, write_records
+
+HOUR = 3600 * 1000
+
+
+@pytest.fixture
+def backend(tmp_path):
+    pytest.importorskip('duckdb')
+    write_records(str(tmp_path / 'song_data' / 'A.json'), [make_song('S1', 'Song A', 'AR1', 'Artist A')])
+    backend = DuckDBBackend(':memory:', str(tmp_path / 'log_data'), str(tmp_path / 'song_data'))
+    yield backend
+    backend.close()
+
+
+def run_load(backend, extra_statements=()):
+    '''
+    Loads the new files like an incremental run of etl.py. extra_statements are added to the transaction
+    of the song plays, e.g. to make it fail.
+    '''
+    conn = backend.connect()
+    cur = conn.cursor()
+    prepare_tables(cur, conn)
+    loaded_keys, watermark = get_load_state(cur)
+    conn.close()
+
+    sources = backend.get_staging_sources()
+    new_objects = {table: [(uri, size) for uri, size in backend.list_files(source) if uri not in loaded_keys[table]]
+                   for table, source, _ in sources}
+    graph = build_load_graph(False, sources, new_objects, watermark)
+    query, dependencies = graph['songplay_table_append']
+    graph['songplay_table_append'] = (query + list(extra_statements), dependencies)
+    load_tables(graph, backend, 2, quiet=True)
+
+
+def fetch(backend, query):
+    conn = backend.connect()
+    cur = conn.cursor()
+    cur.execute(query)
+    rows = cur.fetchall()
+    conn.close()
+    return rows
+
+
+def test_new_files_are_appended_once(backend, tmp_path):
+    write_records(str(tmp_path / 'log_data' / '1.json'), [make_event(START_TS), make_event(START_TS + HOUR)])
+    run_load(backend)
+    run_load(backend)
+    write_records(str(tmp_path / 'log_data' / '2.json'), [make_event(START_TS + 2 * HOUR)])
+    run_load(backend)
+
+    assert fetch(backend, "SELECT COUNT(*), COUNT(song_id) FROM factSongplay") == [(3, 3)]
+    assert fetch(backend, "SELECT value FROM etl_watermark") == [(START_TS + 2 * HOUR,)]
+
+
+def test_failed_load_state_rolls_back_the_song_plays(backend, tmp_path):
+    write_records(str(tmp_path / 'log_data' / '1.json'), [make_event(START_TS), make_event(START_TS + HOUR)])
+    with pytest.raises(Exception):
+        run_load(backend, ["INSERT INTO missing_table VALUES (1)"])
+    assert fetch(backend, "SELECT COUNT(*) FROM factSongplay") == [(0,)]
+    assert fetch(backend, "SELECT COUNT(*) FROM etl_loaded_files") == [(0,)]
+
+    # The next run loads the same file again, without duplicating its song plays.
+    run_load(backend)
+    assert fetch(backend, "SELECT COUNT(*) FROM factSongplay") == [(2,)]
+
+
+def test_late_events_do_not_replace_a_newer_user_level(backend, tmp_path):
+    write_records(str(tmp_path / 'log_data' / '2.json'), [make_event(START_TS + 2 * HOUR, level='paid')])
+    run_load(backend)
+    # A late file with an older event of the same user, and of a new user.
+    write_records(str(tmp_path / 'log_data' / '1.json'), [make_event(START_TS, level='free'),
+                                                          make_event(START_TS, user_id=2, level='free')])
+    run_load(backend)
+    assert fetch(backend, "SELECT user_id, level FROM dimUser ORDER BY user_id") == [(1, 'paid'), (2, 'free')]
+
+    write_records(str(tmp_path / 'log_data' / '3.json'), [make_event(START_TS + 3 * HOUR, level='free')])
+    run_load(backend)
+    assert fetch(backend, "SELECT user_id, level FROM dimUser ORDER BY user_id") == [(1, 'free'), (2, 'free')]
+    # The late song play is still appended to factSongplay.
+    assert fetch(backend, "SELECT COUNT(*) FROM factSongplay") == [(4,)]
+
+
+def test_song_lookup_is_backfilled_when_added(backend, tmp_path):
+    write_records(str(tmp_path / 'song_data' / 'B.json'), [make_song('S2', 'Song B', 'AR1', 'Artist A'),
+                                                           make_song('S0', 'Song B', 'AR1', 'Artist A')])
+    write_records(str(tmp_path / 'log_data' / '1.json'), [make_event(START_TS)])
+    run_load(backend)
+    # A warehouse from before song_lookup: the migration of the next run adds it.
+    conn = backend.connect()
+    conn.cursor().execute("DROP TABLE song_lookup")
+    conn.commit()
+    conn.close()
+
+    write_records(str(tmp_path / 'log_data' / '2.json'), [make_event(START_TS + HOUR, song='Song B'),
+                                                          make_event(START_TS + 2 * HOUR, song=' song a ')])
+    run_load(backend)
+    assert fetch(backend, "SELECT song_id FROM song_lookup ORDER BY song_id") == [('S0',), ('S1',)]
+    assert fetch(backend, "SELECT song_id FROM factSongplay ORDER BY start_time") == [('S1',), ('S0',), ('S1',)]
+
+
+def test_replayed_late_events_are_not_appended_again(backend, tmp_path):
+    write_records(str(tmp_path / 'log_data' / '2.json'), [make_event(START_TS + 2 * HOUR)])
+    run_load(backend)
+    # Two distinct plays in the same second, and a play without a session.
+    late_events = [make_event(START_TS, item_in_session=1), make_event(START_TS, item_in_session=2),
+                   make_event(START_TS + HOUR, session_id=None)]
+    write_records(str(tmp_path / 'log_data' / '1.json'), late_events)
+    run_load(backend)
+    assert fetch(backend, "SELECT COUNT(*) FROM factSongplay") == [(4,)]
+
+    write_records(str(tmp_path / 'log_data' / '1_replayed.json'), late_events)
+    run_load(backend)
+    assert fetch(backend, "SELECT COUNT(*) FROM factSongplay") == [(4,)]
+
+
+def test_only_listed_json_files_are_loaded(backend, tmp_path):
+    write_records(str(tmp_path / 'log_data' / '1.json'), [make_event(START_TS)])
+    write_records(str(tmp_path / 'log_data' / '2.json.tmp'), [make_event(START_TS + HOUR)])
+    run_load(backend)
+    assert fetch(backend, "SELECT COUNT(*) FROM factSongplay") == [(1,)]
+    assert fetch(backend, "SELECT s3_key FROM etl_loaded_files WHERE staging_table = 'staging_events'") == [
+        (str(tmp_path / 'log_data' / '1.json'),)]
+
+    # The file is renamed once complete, and loaded by the next run.
+    (tmp_path / 'log_data' / '2.json.tmp').rename(tmp_path / 'log_data' / '2.json')
+    run_load(backend)
+    assert fetch(backend, "SELECT COUNT(*) FROM factSongplay") == [(2,)]
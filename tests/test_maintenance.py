@@ -0,0 +1,51 @@
+from maintenance import LOADED_TABLES, get_table_health, plan_maintenance
+
+THRESHOLDS = {'stats_off_pct': 10, 'unsorted_pct': 20, 'deleted_pct': 5}
+
+
+def health(stats_off=0.0, unsorted=0.0, deleted=0.0):
+    return {'stats_off': stats_off, 'unsorted': unsorted, 'deleted': deleted}
+
+
+def test_each_threshold_picks_its_maintenance():
+    plans = plan_maintenance({'healthy': health(stats_off=10, unsorted=20, deleted=5),
+                              'stale': health(stats_off=10.5),
+                              'unsorted': health(unsorted=21),
+                              'deleted': health(deleted=6),
+                              'both': health(unsorted=50, deleted=50),
+                              'all': health(stats_off=80, unsorted=50, deleted=50)}, **THRESHOLDS)
+    assert plans == {'stale': ['ANALYZE stale'],
+                     'unsorted': ['VACUUM SORT ONLY unsorted'],
+                     'deleted': ['VACUUM DELETE ONLY deleted'],
+                     'both': ['VACUUM FULL both'],
+                     # The statistics are collected once the table is vacuumed.
+                     'all': ['VACUUM FULL all', 'ANALYZE all']}
+
+
+class HealthCursor:
+    '''
+    Returns the given SVV_TABLE_INFO rows: (table, tbl_rows, estimated_visible_rows, unsorted, stats_off).
+    '''
+    def __init__(self, rows):
+        self._rows = rows
+
+    def execute(self, query):
+        pass
+
+    def fetchall(self):
+        return self._rows
+
+
+def test_table_health_counts_the_deleted_rows():
+    cur = HealthCursor([('factsongplay', 1000, 900, 12.5, None),
+                        ('dimuser', 0, 0, None, None),
+                        ('dimsong', 10, None, None, 3.0),
+                        ('etl_loaded_files', 10, 5, 0, 50)])
+    assert get_table_health(cur, ['factSongplay', 'dimUser', 'dimSong']) == {
+        'factSongplay': {'stats_off': 0.0, 'unsorted': 12.5, 'deleted': 10.0},
+        'dimSong': {'stats_off': 3.0, 'unsorted': 0.0, 'deleted': 0.0}}
+
+
+def test_only_the_loaded_final_tables_are_maintained():
+    assert 'factSongplay' in LOADED_TABLES and 'agg_hourly_plays' in LOADED_TABLES
+    assert not [table for table in LOADED_TABLES if table.startswith(('staging_', 'etl_'))]
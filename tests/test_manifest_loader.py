@@ -0,0 +1,83 @@
+import json
+
+import pytest
+
+from manifest_loader import ManifestLoader, batch_imbalance, get_slice_count, plan_batches
+
+BUCKET = 'sparkify-test'
+
+
+def copy_from(source, manifest=False):
+    return f"COPY staging_events FROM '{source}' {'manifest' if manifest else ''}"
+
+
+@pytest.fixture
+def objects(aws_manager):
+    '''
+    Uploads 100 log files of uneven sizes, a few of them much larger than the others, and lists them.
+    '''
+    aws_manager._s3.create_bucket(Bucket=BUCKET, CreateBucketConfiguration={'LocationConstraint': 'us-west-2'})
+    for i in range(100):
+        size = 50000 if i % 25 == 0 else 1000 + (i * 7919) % 9000
+        aws_manager.put_s3_object(f's3://{BUCKET}/log_data/{i:03d}-events.json', b'x' * size)
+    return aws_manager.list_s3_objects(f's3://{BUCKET}/log_data/')
+
+
+def read_manifests(aws_manager, copies):
+    manifests = {}
+    for name, (query, _) in copies.items():
+        uri = query.split("'")[1]
+        assert query.endswith('manifest')
+        manifests[name] = json.loads(aws_manager.get_s3_object(uri))['entries']
+    return manifests
+
+
+def test_manifest_batches_cover_every_file_once(aws_manager, objects):
+    loader = ManifestLoader(aws_manager, f's3://{BUCKET}/manifests', slice_count=4, files_per_slice=8)
+    copies = loader.build_copies('staging_events_copy', objects, copy_from)
+    manifests = read_manifests(aws_manager, copies)
+
+    # 100 files in batches of at most 4 slices x 8 files.
+    assert len(manifests) == 4
+    listed = [(entry['url'], entry['meta']['content_length']) for entries in manifests.values() for entry in entries]
+    assert sorted(listed) == sorted(objects)
+    assert all(entry['mandatory'] for entries in manifests.values() for entry in entries)
+    # Independent batches run concurrently.
+    assert all(dependencies == [] for _, dependencies in copies.values())
+
+
+def test_manifest_batches_are_balanced(aws_manager, objects):
+    loader = ManifestLoader(aws_manager, f's3://{BUCKET}/manifests', slice_count=4, files_per_slice=8)
+    manifests = read_manifests(aws_manager, loader.build_copies('staging_events_copy', objects, copy_from))
+
+    batches = [[(entry['url'], entry['meta']['content_length']) for entry in entries] for entries in manifests.values()]
+    counts = [len(batch) for batch in batches]
+    # Every batch gets a multiple of the slice count, except the remainder, and similar bytes.
+    assert max(counts) <= 32 and max(counts) - min(counts) <= 4
+    assert batch_imbalance(batches) < 1.1
+    # The recorded batch sizes match their manifests.
+    assert sorted(batch.bytes for batch in loader.batches.values()) == sorted(sum(size for _, size in batch)
+                                                                              for batch in batches)
+
+
+def test_serial_batches_wait_for_each_other(aws_manager, objects):
+    loader = ManifestLoader(aws_manager, f's3://{BUCKET}/manifests', slice_count=4, files_per_slice=8, parallel=False)
+    copies = loader.build_copies('staging_events_copy', objects, copy_from)
+    names = sorted(copies)
+    assert copies[names[0]][1] == []
+    for previous, name in zip(names, names[1:]):
+        assert copies[name][1] == [previous]
+
+
+def test_plan_batches_caps_files_per_batch():
+    objects = [(f'f{i}', 100) for i in range(10)]
+    batches = plan_batches(objects, slice_count=4, files_per_slice=2)
+    assert [len(batch) for batch in batches] == [5, 5]
+    assert plan_batches(objects, slice_count=4, files_per_slice=4) == [sorted(objects, key=lambda obj: obj[0])]
+    assert plan_batches([], 4, 2) == []
+
+
+def test_slice_count():
+    assert get_slice_count('dc2.large', 4) == 8
+    with pytest.raises(ValueError):
+        get_slice_count('unknown.type', 2)
@@ -0,0 +1,150 @@
+import pytest
+
+import sql_queries
+from migrations import TableDesign, get_declared_design, migrate_schema, normalize_type, parse_table_ddl, plan_migration
+
+QUERIES = sql_queries.create_table_queries + sql_queries.create_control_table_queries
+TUNED_USER = TableDesign('dimuser', 'key', 'user_id', ['user_id'], {})
+
+
+def declared_catalog():
+    '''
+    Returns the columns and designs of a warehouse matching the declared DDL.
+    '''
+    tables = [parse_table_ddl(query) for query in QUERIES]
+    columns = {table['table'].lower(): {column.lower(): normalize_type(column_type)
+                                        for column, column_type, _ in table['columns']} for table in tables}
+    designs = {table['table'].lower(): get_declared_design(table) for table in tables}
+    return columns, designs
+
+
+def planned_tables(changes):
+    return {change.table.lower() for change in changes}
+
+
+def test_keys_set_outside_the_ddl_are_kept():
+    columns, declared = declared_catalog()
+    # dimUser was tuned, and Redshift picked a distribution key for the AUTO fact table.
+    live = dict(declared, dimuser=TUNED_USER,
+                factsongplay=declared['factsongplay']._replace(distkey='user_id', sortkey=['start_time']))
+    assert plan_migration(QUERIES, columns, live, True, recorded_designs=declared) == []
+    # Nothing was recorded before the upgrade: the live keys are kept too.
+    assert plan_migration(QUERIES, columns, live, True) == []
+
+
+def test_keys_changed_in_the_ddl_rebuild_the_table():
+    columns, declared = declared_catalog()
+    recorded = dict(declared, dimuser=TUNED_USER)
+    changes = plan_migration(QUERIES, columns, recorded, True, recorded_designs=recorded)
+    assert planned_tables(changes) == {'dimuser'}
+    assert changes[0].description == 'deep copy (change keys)'
+    assert changes[0].statements[0] == 'DROP TABLE IF EXISTS dimUser__migrated'
+
+    # Already rebuilt to the declared keys: nothing to do.
+    assert plan_migration(QUERIES, columns, declared, True, recorded_designs=recorded) == []
+
+
+def test_rebuilt_table_keeps_its_tuned_design():
+    columns, declared = declared_catalog()
+    columns['dimuser'] = dict(columns['dimuser'], level=('integer', None))
+    tuned = {'dimuser': TUNED_USER}
+    live = dict(declared, dimuser=TUNED_USER)
+    [change] = plan_migration(QUERIES, columns, live, True, recorded_designs=declared, tuned_designs=tuned)
+    assert change.description == 'deep copy (retype level)'
+    assert 'diststyle key distkey (user_id) compound sortkey (user_id)' in change.statements[1]
+
+    # Keys changed in the DDL replace the tuned design, which is discarded.
+    recorded = dict(declared, dimuser=declared['dimuser']._replace(diststyle='even'))
+    [change] = plan_migration(QUERIES, columns, live, True, recorded_designs=recorded, tuned_designs=tuned)
+    assert 'diststyle all' in change.statements[1]
+    assert change.statements[-1] == "DELETE FROM etl_table_designs WHERE table_name = 'dimuser'"
+
+
+def fetch(backend, query):
+    conn = backend.connect()
+    cur = conn.cursor()
+    cur.execute(query)
+    rows = cur.fetchall()
+    conn.close()
+    return rows
+
+
+def migrate(backend):
+    conn = backend.connect()
+    try:
+        return migrate_schema(conn.cursor(), conn)
+    finally:
+        conn.close()
+
+
+def test_migration_is_recorded_once(postgres_backend):
+    # etl_schema_versions is created before the others.
+    assert len(migrate(postgres_backend)) == len(QUERIES) - 1
+    assert migrate(postgres_backend) == []
+    [(ddl,)] = fetch(postgres_backend, "SELECT ddl FROM etl_schema_versions")
+    assert 'CREATE TABLE IF NOT EXISTS factSongplay' in ddl
+
+
+def test_deep_copy_keeps_identity_values(postgres_backend):
+    migrate(postgres_backend)
+    conn = postgres_backend.connect()
+    cur = conn.cursor()
+    cur.execute("ALTER TABLE factSongplay ALTER COLUMN session_id TYPE varchar")
+    for session_id in range(3):
+        cur.execute("INSERT INTO factSongplay (start_time, user_id, session_id, user_agent) "
+                    "VALUES ('2018-11-01', 1, %s, 'Mozilla/5.0')", (str(session_id),))
+    cur.execute("DELETE FROM factSongplay WHERE session_id = '0'")
+    # Left over by a failed rebuild.
+    cur.execute("CREATE TABLE factSongplay__migrated (songplay_id int)")
+    conn.commit()
+    conn.close()
+
+    changes = migrate(postgres_backend)
+    assert [change.description for change in changes] == ['deep copy (retype session_id)']
+    assert fetch(postgres_backend, "SELECT songplay_id, session_id FROM factSongplay ORDER BY 1") == [(1, 1), (2, 2)]
+
+    conn = postgres_backend.connect()
+    cur = conn.cursor()
+    cur.execute("INSERT INTO factSongplay (start_time, user_id, session_id, user_agent) "
+                "VALUES ('2018-11-01', 1, 3, 'Mozilla/5.0')")
+    conn.commit()
+    conn.close()
+    assert fetch(postgres_backend, "SELECT MAX(songplay_id) FROM factSongplay") == [(3,)]
+
+
+def test_added_column_keeps_rows(postgres_backend):
+    migrate(postgres_backend)
+    conn = postgres_backend.connect()
+    cur = conn.cursor()
+    cur.execute("INSERT INTO dimUser (user_id, level) VALUES (1, 'paid')")
+    cur.execute("ALTER TABLE dimUser DROP COLUMN last_ts")
+    conn.commit()
+    conn.close()
+
+    changes = migrate(postgres_backend)
+    assert [change.description for change in changes] == ['add column last_ts']
+    assert fetch(postgres_backend, "SELECT user_id, level, last_ts FROM dimUser") == [(1, 'paid', None)]
+
+
+def test_undeclared_column_blocks_a_rebuild(postgres_backend):
+    migrate(postgres_backend)
+    conn = postgres_backend.connect()
+    cur = conn.cursor()
+    cur.execute("ALTER TABLE dimSong ALTER COLUMN year TYPE varchar, ADD COLUMN genre varchar")
+    conn.commit()
+    conn.close()
+    with pytest.raises(ValueError, match='genre'):
+        migrate(postgres_backend)
+
+
+def test_ddl_is_recorded_after_an_upgrade(postgres_backend):
+    migrate(postgres_backend)
+    conn = postgres_backend.connect()
+    cur = conn.cursor()
+    cur.execute("ALTER TABLE etl_schema_versions DROP COLUMN ddl")
+    conn.commit()
+    conn.close()
+
+    changes = migrate(postgres_backend)
+    assert [change.description for change in changes] == ['add column ddl']
+    assert fetch(postgres_backend, "SELECT COUNT(ddl) FROM etl_schema_versions") == [(1,)]
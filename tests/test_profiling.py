@@ -0,0 +1,86 @@
+import json
+
+import pytest
+
+from backends import DuckDBBackend
+from profiling import QueryProfiler, execute
+
+# The local backends report -1 as the query id of every statement.
+QUERY_ID = -1
+
+
+@pytest.fixture(params=['duckdb', 'postgres'])
+def backend(request, tmp_path):
+    '''
+    An empty local database with the stand-ins of the Redshift system tables.
+    '''
+    if request.param == 'duckdb':
+        pytest.importorskip('duckdb')
+        backend = DuckDBBackend(':memory:', str(tmp_path / 'log_data'), str(tmp_path / 'song_data'))
+    else:
+        backend = request.getfixturevalue('postgres_backend')
+    yield backend
+    if request.param == 'duckdb':
+        backend.close()
+
+
+def record_system_rows(cur):
+    '''
+    Fills the system tables with the rows Redshift would have logged for a COPY of two files.
+    '''
+    cur.execute(f"""INSERT INTO stl_load_commits VALUES ({QUERY_ID}, 'log_data/1.json', 3, 0),
+                                                          ({QUERY_ID}, 'log_data/2.json', 2, 1)""")
+    cur.execute(f"""INSERT INTO svl_query_summary VALUES ({QUERY_ID}, 120, 5, 400, 1024, 'f'),
+                                                           ({QUERY_ID}, 80, 5, 600, 2048, 't')""")
+    cur.execute(f"""INSERT INTO stl_load_errors VALUES ({QUERY_ID}, ' log_data/2.json ', 2, ' ts ', 1207,
+                                                          ' Invalid digit ')""")
+
+
+def profile_load(backend):
+    '''
+    Returns a profiler that recorded a load stage of two statements.
+    '''
+    conn = backend.connect()
+    cur = conn.cursor()
+    profiler = QueryProfiler()
+    profiler.start_stage('load')
+    execute(cur, "CREATE TABLE plays (song_id varchar, plays int)", profiler)
+    execute(cur, "INSERT INTO plays VALUES ('S1', 1), ('S2', 2)", profiler, 'insert plays')
+    record_system_rows(cur)
+    profiler.end_stage(cur)
+    conn.close()
+    return profiler
+
+
+def test_stage_collects_its_statements_and_system_table_rows(backend):
+    profiler = profile_load(backend)
+    stage = profiler.stages['load']
+    assert stage['elapsed'] >= sum(statement['elapsed'] for statement in stage['statements'])
+    assert [(statement['name'], statement['rows'], statement['query_id']) for statement in stage['statements']] == [
+        ('CREATE TABLE plays', -1, QUERY_ID), ('insert plays', 2, QUERY_ID)]
+    assert stage['load_commits'] == [{'query': QUERY_ID, 'files': 2, 'lines_scanned': 5, 'errors': 1}]
+    assert stage['query_summary'] == [{'query': QUERY_ID, 'steps': 2, 'max_step_time_us': 120, 'rows': 10,
+                                       'bytes': 1000, 'max_workmem': 2048, 'diskbased_steps': 1}]
+    assert stage['load_errors'] == [{'query': QUERY_ID, 'filename': 'log_data/2.json', 'line_number': 2,
+                                     'colname': 'ts', 'err_code': 1207, 'err_reason': 'Invalid digit'}]
+
+
+def test_report(backend, tmp_path, capsys):
+    profiler = profile_load(backend)
+    profiler.print_summary()
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0].split() == ['stage', 'statement', 'seconds', 'rows', 'query', 'id']
+    assert lines[1].split()[:3] == ['load', 'CREATE', 'TABLE']
+    assert lines[1].split()[-2:] == ['-1', str(QUERY_ID)]
+    assert lines[2].split()[:2] == ['load', 'insert'] and lines[2].split()[-2:] == ['2', str(QUERY_ID)]
+    assert lines[3].split()[:5] == ['load', 'total', '(1', 'load', 'errors)']
+
+    path = tmp_path / 'metrics.json'
+    profiler.write(str(path))
+    with open(path) as f:
+        metrics = json.load(f)
+    assert metrics['started_at'] == profiler.started_at
+    assert [statement['name'] for statement in metrics['stages']['load']['statements']] == ['CREATE TABLE plays',
+                                                                                           'insert plays']
+    assert metrics['stages']['load']['load_commits'][0]['files'] == 2
+    assert metrics['stages']['load']['load_errors'][0]['err_code'] == 1207
@@ -0,0 +1,214 @@
+import threading
+from time import perf_counter, sleep
+
+import pytest
+
+from backends import STAGING_TABLES
+from etl import build_load_graph
+from scheduler import run_query_graph, validate_graph
+
+QUERY_TIME = 0.2
+
+
+class StubCursor:
+    '''
+    Runs a query of the form 'name:seconds' by sleeping, and records when it started and finished.
+    '''
+    def __init__(self, log, lock, fail):
+        self._log = log
+        self._lock = lock
+        self._fail = fail
+
+    def execute(self, query):
+        name, seconds = query.split(':')
+        with self._lock:
+            self._log['running'] = self._log.get('running', 0) + 1
+            self._log['max_running'] = max(self._log.get('max_running', 0), self._log['running'])
+        start = perf_counter()
+        sleep(float(seconds))
+        with self._lock:
+            self._log['running'] -= 1
+            if name in self._fail:
+                raise RuntimeError(f"{name} failed")
+            self._log[name] = (start, perf_counter())
+
+    def close(self):
+        pass
+
+
+class StubConnection:
+    def __init__(self, log, lock, fail=()):
+        self._cursor = StubCursor(log, lock, fail)
+
+    def cursor(self):
+        return self._cursor
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_connect(fail=()):
+    '''
+    Returns a connect callable and the log of the queries run on its connections: the (start, end)
+    of every query by name, and the most queries that were running at the same time.
+    '''
+    log, lock = {}, threading.Lock()
+    return (lambda: StubConnection(log, lock, fail)), log
+
+
+def query_times(log):
+    return {name: times for name, times in log.items() if name not in ('running', 'max_running')}
+
+
+def independent_graph(count):
+    return {f'q{i}': (f'q{i}:{QUERY_TIME}', []) for i in range(count)}
+
+
+def test_queries_start_after_their_dependencies():
+    graph = {'copy_a': (f'copy_a:{QUERY_TIME}', []),
+             'copy_b': ('copy_b:0.05', []),
+             'insert_a': ('insert_a:0.05', ['copy_a']),
+             'insert_b': ('insert_b:0.05', ['copy_b']),
+             'fact': ('fact:0.05', ['insert_a', 'insert_b'])}
+    connect, log = make_connect()
+    timings = run_query_graph(graph, connect, max_concurrency=4)
+
+    assert set(timings) == set(graph)
+    for name, (_, dependencies) in graph.items():
+        for dependency in dependencies:
+            assert log[name][0] >= log[dependency][1], f"{name} started before {dependency} finished"
+    # insert_b does not wait for copy_a, which is still running.
+    assert log['insert_b'][0] < log['copy_a'][1]
+
+
+def test_independent_queries_run_concurrently():
+    connect, _ = make_connect()
+    start = perf_counter()
+    run_query_graph(independent_graph(4), connect, max_concurrency=1)
+    sequential = perf_counter() - start
+
+    connect, log = make_connect()
+    start = perf_counter()
+    run_query_graph(independent_graph(4), connect, max_concurrency=4)
+    concurrent = perf_counter() - start
+
+    assert sequential >= 4 * QUERY_TIME
+    assert concurrent < sequential / 2
+    assert log['max_running'] == 4
+
+
+def test_max_concurrency_bounds_running_queries():
+    connect, log = make_connect()
+    run_query_graph(independent_graph(6), connect, max_concurrency=2)
+    assert len(query_times(log)) == 6
+    assert log['max_running'] == 2
+
+
+def test_failed_query_stops_its_dependents():
+    graph = {'copy': ('copy:0.05', []),
+             'insert': ('insert:0.05', ['copy']),
+             'other': ('other:0.1', [])}
+    connect, log = make_connect(fail={'copy'})
+    with pytest.raises(RuntimeError, match='copy failed'):
+        run_query_graph(graph, connect, max_concurrency=2)
+    assert 'insert' not in log
+    # The query already running when the failure happened was allowed to finish.
+    assert 'other' in log
+
+
+def test_invalid_graphs_are_rejected():
+    with pytest.raises(ValueError, match='unknown query'):
+        validate_graph({'a': ('a:0', ['missing'])})
+    with pytest.raises(ValueError, match='Circular dependency'):
+        validate_graph({'a': ('a:0', ['b']), 'b': ('b:0', ['a'])})
+
+
+class RecordingConnection(StubConnection):
+    '''
+    A StubConnection recording whether it was closed, back to the pool of its manager, or discarded.
+    '''
+    def __init__(self, log, lock, fail, events):
+        super().__init__(log, lock, fail)
+        self._events = events
+
+    def close(self):
+        self._events.append('close')
+
+    def discard(self):
+        self._events.append('discard')
+
+
+def test_connect_failure_is_retried_and_failed_connections_are_discarded():
+    psycopg2 = pytest.importorskip('psycopg2')
+    log, lock, events = {}, threading.Lock(), []
+    failures = [psycopg2.OperationalError('the database system is starting up')]
+
+    def connect():
+        events.append('connect')
+        if failures:
+            raise failures.pop()
+        return RecordingConnection(log, lock, {'bad'}, events)
+
+    run_query_graph({'good': ('good:0', [])}, connect, max_retries=1, retry_backoff=0.01)
+    assert events == ['connect', 'connect', 'close']
+    assert 'good' in log
+
+    events.clear()
+    with pytest.raises(RuntimeError, match='bad failed'):
+        run_query_graph({'bad': ('bad:0', [])}, connect, max_retries=1, retry_backoff=0.01)
+    assert events == ['connect', 'discard']
+
+
+class SqlCursor:
+    '''
+    Records when the first statement of each query of a graph started, and takes a little time over each statement.
+    '''
+    def __init__(self, first_statements, started):
+        self._first_statements = first_statements
+        self._started = started
+
+    def execute(self, statement):
+        if statement in self._first_statements:
+            self._started[self._first_statements[statement]] = perf_counter()
+        sleep(0.01)
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize('full_refresh', [True, False])
+def test_load_graph_runs_the_final_tables_after_their_sources(full_refresh):
+    sources = [(table, f's3://bucket/{table}', lambda uri, manifest=False, table=table: f"COPY {table} FROM '{uri}'")
+               for table in STAGING_TABLES]
+    new_objects = {table: [(f's3://bucket/{table}/1.json', 1), (f's3://bucket/{table}/2.json', 1)]
+                   for table in STAGING_TABLES}
+    graph = build_load_graph(full_refresh, sources, new_objects, 0)
+    first_statements = {query if isinstance(query, str) else query[0]: name for name, (query, _) in graph.items()}
+    assert len(first_statements) == len(graph)
+
+    started, finished = {}, {}
+    connection = StubConnection({}, threading.Lock())
+    connection.cursor = lambda: SqlCursor(first_statements, started)
+    run_query_graph(graph, lambda: connection, max_concurrency=4,
+                    on_complete=lambda name, elapsed: finished.setdefault(name, perf_counter()))
+
+    assert set(finished) == set(graph)
+    for name, (_, dependencies) in graph.items():
+        for dependency in dependencies:
+            assert started[name] >= finished[dependency], f"{name} started before {dependency} finished"
+
+    songplays = 'songplay_table_insert' if full_refresh else 'songplay_table_append'
+    suffix = 'insert' if full_refresh else 'merge'
+    sources_of_songplays = [f'{table}_table_{suffix}' for table in ['user', 'song', 'artist', 'time']]
+    sources_of_songplays += [f'song_lookup_{suffix}']
+    sources_of_songplays += [name for name in graph if name.startswith('staging_events_copy')]
+    assert all(started[songplays] >= finished[name] for name in sources_of_songplays)
+    assert graph[songplays][1] and set(sources_of_songplays) <= set(graph[songplays][1])
+    # The dimensions only wait for the COPYs of their own staging table.
+    assert all(not dependency.startswith('staging_songs') for dependency in graph[f'user_table_{suffix}'][1])
@@ -0,0 +1,82 @@
+import threading
+
+import pytest
+
+import aws_manager as aws_manager_module
+from set_up_aws_resources import set_up_aws_resources
+
+IAM_ROLE = 'arn:aws:iam::123456789012:role/myRedshiftRole'
+
+
+@pytest.fixture
+def set_up(aws_manager, monkeypatch):
+    '''
+    Returns a function running set_up_aws_resources and returning which of the create, restore and resume calls it
+    made. The IAM role setup, the snapshot lookup and the status check wait for each other, so it fails unless
+    they run concurrently.
+    '''
+    monkeypatch.setattr(aws_manager_module, 'sleep', lambda seconds: None)
+
+    def run():
+        calls = []
+        lookups = threading.Barrier(3, timeout=10)
+        with monkeypatch.context() as patch:
+            for name in ['create_cluster', 'restore_cluster', 'resume_cluster']:
+                patch.setattr(aws_manager, name, recorded(getattr(aws_manager, name), calls))
+            for name in ['create_iam_role', 'find_cluster_snapshot', 'get_cluster_status']:
+                patch.setattr(aws_manager, name, after(getattr(aws_manager, name), lookups))
+            set_up_aws_resources(aws_manager)
+        return calls
+    return run
+
+
+def recorded(method, calls):
+    def call(*args):
+        calls.append((method.__name__,) + args)
+        return method(*args)
+    return call
+
+
+def after(method, barrier):
+    def call(*args):
+        barrier.wait()
+        return method(*args)
+    return call
+
+
+def test_fresh_cluster_is_created(aws_manager, set_up, capsys):
+    calls = set_up()
+    iam_role = aws_manager.get_iam_role_arn()
+    assert calls == [('create_cluster', iam_role)]
+    assert aws_manager.get_cluster_status() == 'available'
+    assert aws_manager.get_cluster_iam_role() == iam_role
+    assert 'Creating Redshift Cluster' in capsys.readouterr().out
+
+
+def test_cluster_is_restored_from_the_latest_snapshot(aws_manager, set_up, capsys):
+    aws_manager._SNAPSHOT_IDENTIFIER = 'latest'
+    aws_manager.create_cluster(IAM_ROLE)
+    aws_manager._redshift.create_cluster_snapshot(SnapshotIdentifier='sparkify-1',
+                                                  ClusterIdentifier=aws_manager._DWH_CLUSTER_IDENTIFIER)
+    aws_manager.delete_cluster()
+
+    calls = set_up()
+    assert calls == [('restore_cluster', 'sparkify-1', aws_manager.get_iam_role_arn())]
+    assert aws_manager.get_cluster_status() == 'available'
+    assert 'Restoring Redshift Cluster from snapshot sparkify-1' in capsys.readouterr().out
+
+
+def test_paused_cluster_is_resumed(aws_manager, set_up, capsys):
+    # A paused cluster is resumed even when a snapshot is available.
+    aws_manager._SNAPSHOT_IDENTIFIER = 'nightly'
+    aws_manager.create_cluster(IAM_ROLE)
+    aws_manager.pause_cluster()
+    assert aws_manager.get_cluster_status() == 'paused'
+
+    assert set_up() == [('resume_cluster',)]
+    assert aws_manager.get_cluster_status() == 'available'
+    assert 'Resuming paused Redshift Cluster' in capsys.readouterr().out
+
+    # Once it is available, nothing is created again.
+    assert set_up() == []
+    assert 'Cluster already exists (available)' in capsys.readouterr().out
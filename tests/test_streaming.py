@@ -0,0 +1,128 @@
+import os
+
+import pytest
+
+import streaming
+from backends import DuckDBBackend
+from etl import LoadLockedError, acquire_load_lock, get_load_state, prepare_tables, release_load_lock
+
+from tests.sample_data import START_TS, make_event, make_song, write_records
+
+HOUR = 3600 * 1000
+
+
+@pytest.fixture(params=['duckdb', 'postgres'])
+def backend(request, tmp_path):
+    '''
+    An empty warehouse on a local directory of log and song files.
+    '''
+    write_records(str(tmp_path / 'song_data' / 'A.json'), [make_song('S1', 'Song A', 'AR1', 'Artist A')])
+    os.makedirs(tmp_path / 'log_data')
+    if request.param == 'duckdb':
+        pytest.importorskip('duckdb')
+        backend = DuckDBBackend(':memory:', str(tmp_path / 'log_data'), str(tmp_path / 'song_data'))
+    else:
+        backend = request.getfixturevalue('postgres_backend')
+    conn = backend.connect()
+    prepare_tables(conn.cursor(), conn)
+    conn.close()
+    yield backend
+    if request.param == 'duckdb':
+        backend.close()
+
+
+def write_log(tmp_path, name, *hours):
+    return write_records(str(tmp_path / 'log_data' / name), [make_event(START_TS + hour * HOUR) for hour in hours])
+
+
+def fetch(backend, query):
+    conn = backend.connect()
+    cur = conn.cursor()
+    cur.execute(query)
+    rows = cur.fetchall()
+    conn.close()
+    return rows
+
+
+def load_state(backend):
+    conn = backend.connect()
+    loaded_keys, _ = get_load_state(conn.cursor())
+    conn.close()
+    return loaded_keys
+
+
+def new_batch(backend, loaded_keys):
+    '''
+    Returns every new file as a micro-batch.
+    '''
+    files = streaming.find_new_files(backend, backend.get_staging_sources(), loaded_keys)
+    return [(table, uri, size, 0.0) for table, table_files in files.items() for uri, size in table_files]
+
+
+def run_batch(backend, batch, loaded_keys, lock_owner='streaming.py'):
+    return streaming.run_batch(backend, backend.get_staging_sources(), batch, loaded_keys, streaming.NO_LOAD_TIME, 2,
+                               lock_owner=lock_owner)
+
+
+def test_drain_loads_every_file(backend, tmp_path, monkeypatch):
+    write_log(tmp_path, '1.json', 0, 1)
+    write_log(tmp_path, '2.json', 2)
+    monkeypatch.setattr(backend, 'close', lambda: None)
+    metrics = streaming.run_streaming(backend, drain=True)
+
+    assert metrics.totals['batches'] == 1
+    assert metrics.totals['events'] == 3
+    assert fetch(backend, "SELECT COUNT(*), COUNT(song_id) FROM factSongplay") == [(3, 3)]
+    assert fetch(backend, "SELECT SUM(plays) FROM agg_hourly_plays") == [(3,)]
+    assert fetch(backend, "SELECT COUNT(*) FROM etl_load_lock") == [(0,)]
+
+
+def test_batch_failing_after_its_commit_is_not_loaded_again(backend, tmp_path, monkeypatch):
+    write_log(tmp_path, '1.json', 0, 1)
+    loaded_keys = load_state(backend)
+    batch = new_batch(backend, loaded_keys)
+
+    def failing_refresh(cur, conn, profiler=None):
+        raise RuntimeError('connection lost')
+
+    monkeypatch.setattr(streaming, 'refresh_aggregates', failing_refresh)
+    with pytest.raises(RuntimeError):
+        run_batch(backend, batch, loaded_keys)
+    monkeypatch.undo()
+    # The song plays were committed with the record of their files: they are not retried.
+    assert fetch(backend, "SELECT COUNT(*) FROM factSongplay") == [(2,)]
+    assert all(uri in loaded_keys[table] for table, uri, _, _ in batch)
+    assert new_batch(backend, loaded_keys) == []
+
+    # A batch still holding them, as after a commit lost with its connection, skips them.
+    assert run_batch(backend, batch, {table: set() for table in loaded_keys})[0] is None
+
+    # The next batch refreshes the aggregates with every song play.
+    write_log(tmp_path, '2.json', 2)
+    stats, _ = run_batch(backend, new_batch(backend, loaded_keys), loaded_keys)
+    assert stats['files'] == 1
+    assert fetch(backend, "SELECT COUNT(*) FROM factSongplay") == [(3,)]
+    assert fetch(backend, "SELECT SUM(plays) FROM agg_hourly_plays") == [(3,)]
+
+
+def test_batch_waits_for_the_load_lock(backend, tmp_path):
+    write_log(tmp_path, '1.json', 0)
+    loaded_keys = load_state(backend)
+    batch = new_batch(backend, loaded_keys)
+
+    acquire_load_lock(backend, 'etl.py on another host')
+    with pytest.raises(LoadLockedError, match='etl.py on another host'):
+        run_batch(backend, batch, loaded_keys)
+    with pytest.raises(LoadLockedError):
+        acquire_load_lock(backend, 'etl.py on a third host')
+    assert fetch(backend, "SELECT COUNT(*) FROM factSongplay") == [(0,)]
+
+    release_load_lock(backend, 'etl.py on another host')
+    stats, _ = run_batch(backend, batch, loaded_keys)
+    assert stats['events'] == 1
+
+
+def test_expired_load_lock_is_taken_over(backend):
+    acquire_load_lock(backend, 'etl.py on a dead host')
+    acquire_load_lock(backend, 'streaming.py', expiry=0)
+    assert fetch(backend, "SELECT owner FROM etl_load_lock") == [('streaming.py',)]
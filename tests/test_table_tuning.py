@@ -0,0 +1,96 @@
+import re
+
+import pytest
+
+import sql_queries
+from backends import DuckDBBackend
+from migrations import (TableDesign, deep_copy_statements, get_catalog, get_identity_seed, get_tuned_designs,
+                        migrate_schema, parse_table_ddl)
+from table_tuning import column_distribution_select, estimate_distribution_skew, recommend_designs, record_design_statements
+
+SONGPLAY_DESIGN = TableDesign('factsongplay', 'key', 'user_id', ['start_time'], {'start_time': 'raw', 'level': 'zstd'})
+
+
+class StubCursor:
+    def __init__(self, row):
+        self.row = row
+        self.queries = []
+
+    def execute(self, query):
+        self.queries.append(query)
+
+    def fetchone(self):
+        return self.row
+
+
+def columns(table):
+    return [column.lower() for column, _, _ in table['columns']]
+
+
+def test_deep_copy_keeps_identity_values():
+    table = parse_table_ddl(sql_queries.songplay_table_create)
+    seed = get_identity_seed(StubCursor((41,)), table)
+    assert seed == 42
+    assert get_identity_seed(StubCursor((None,)), table) == 0
+
+    statements = deep_copy_statements(table, columns(table), True, seed, design=SONGPLAY_DESIGN)
+    assert statements[0] == 'DROP TABLE IF EXISTS factSongplay__migrated'
+    assert 'songplay_id int GENERATED BY DEFAULT AS IDENTITY(42, 1) PRIMARY KEY' in statements[1]
+    assert 'diststyle key distkey (user_id) compound sortkey (start_time)' in statements[1]
+    assert statements[2].startswith('INSERT INTO factSongplay__migrated (songplay_id, start_time,')
+    assert statements[2].endswith('FROM factSongplay')
+    assert statements[3:] == ['DROP TABLE factSongplay CASCADE', 'ALTER TABLE factSongplay__migrated RENAME TO factSongplay']
+
+
+def test_deep_copy_of_a_referenced_table_adds_its_references_back():
+    table = parse_table_ddl(sql_queries.user_table_create)
+    design = TableDesign('dimuser', 'key', 'user_id', ['user_id'], {})
+    statements = deep_copy_statements(table, columns(table), True, design=design)
+    assert 'diststyle key distkey (user_id) compound sortkey (user_id)' in statements[1]
+    assert statements[3] == 'DROP TABLE dimUser CASCADE'
+    assert statements[5:] == ['ALTER TABLE factSongplay ADD FOREIGN KEY (user_id) REFERENCES dimUser (user_id)']
+
+
+def test_tables_without_a_primary_key_keep_their_declared_design():
+    tables = [parse_table_ddl(query) for query in sql_queries.create_table_queries]
+    designs = recommend_designs(tables, {}, {}, {}, 3000000, 1.5)
+    assert designs['agg_hourly_plays'][1:4] == ('all', None, ['play_hour'])
+    assert designs['agg_daily_song_plays'][1:4] == ('auto', None, ['play_date', 'song_id'])
+    assert designs['staging_events'][1:4] == ('even', None, [])
+    assert designs['dimuser'][1:4] == ('all', None, ['user_id'])
+
+
+@pytest.fixture(params=['duckdb', 'postgres'])
+def cursor(request, tmp_path):
+    '''
+    A cursor on a migrated warehouse.
+    '''
+    if request.param == 'duckdb':
+        pytest.importorskip('duckdb')
+        backend = DuckDBBackend(':memory:', str(tmp_path / 'log_data'), str(tmp_path / 'song_data'))
+    else:
+        backend = request.getfixturevalue('postgres_backend')
+    conn = backend.connect()
+    migrate_schema(conn.cursor(), conn)
+    yield conn.cursor()
+    conn.close()
+    if request.param == 'duckdb':
+        backend.close()
+
+
+def test_distribution_skew_probe(cursor):
+    for user_id in [1, 1, 1, 2]:
+        cursor.execute("INSERT INTO factSongplay (start_time, user_id, user_agent) "
+                       "VALUES ('2018-11-01', %s, 'Mozilla/5.0')", (user_id,))
+    # The fullest of 2 slices would hold the 3 rows of user 1, against 2 on average.
+    assert estimate_distribution_skew(cursor, 'factSongplay', 'user_id', 4, 2) == 1.5
+    # Redshift, like PostgreSQL before 16, requires an alias on a derived table.
+    assert re.search(r'\)\s+AS\s+\w+$', column_distribution_select.strip())
+
+
+def test_applied_design_is_recorded(cursor):
+    for design in [SONGPLAY_DESIGN._replace(sortkey=[]), SONGPLAY_DESIGN]:
+        for statement, parameters in record_design_statements(design):
+            cursor.execute(statement, parameters)
+    columns, _ = get_catalog(cursor)
+    assert get_tuned_designs(cursor, columns) == {'factsongplay': SONGPLAY_DESIGN}